@@ -13,6 +13,14 @@ def create_app(config_name=None):
     from app.database import init_extensions
     db, login_manager = init_extensions(app)
     
+    # Limites dos caches em memória
+    from app.cache import init_caches
+    init_caches(app)
+    
+    # Agregados diários de dispensação (atualizados a cada flush)
+    from app.rollups import init_rollups
+    init_rollups(app)
+    
     # Criar pasta de uploads
     upload_folder = app.config.get('UPLOAD_FOLDER', 'uploads')
     if not os.path.exists(upload_folder):
@@ -31,6 +39,26 @@ def create_app(config_name=None):
     # ✅ NOVO: Registrar error handlers
     register_error_handlers(app)
     
+    # Log de auditoria gravado em lotes por uma thread (sobe no primeiro registro)
+    from app.audit_log import init_audit_log
+    init_audit_log(app)
+    
+    # Fila de relatórios em segundo plano (PDF/Excel/CSV)
+    from app.report_jobs import init_report_jobs
+    init_report_jobs(app)
+    
+    # Cache de relatórios prontos (chave inclui a versão dos dados)
+    from app.report_cache import init_report_cache
+    init_report_cache(app)
+    
+    # Pool de processos para os PDFs (sobe no primeiro PDF)
+    from app.pdf_render import init_pdf_renderer
+    init_pdf_renderer(app)
+    
+    # Amostrador de status em segundo plano (inicia na primeira requisição)
+    from app.status_sampler import init_status_sampler
+    init_status_sampler(app)
+    
     return app
 
 def register_error_handlers(app):
@@ -0,0 +1,271 @@
+"""
+Gravação do Log de Auditoria em Lotes
+log_action só coloca o registro em um buffer em memória; uma thread por
+processo grava os registros em INSERTs de várias linhas quando o buffer
+chega a AUDIT_BATCH_SIZE ou a cada AUDIT_FLUSH_INTERVAL segundos, em uma
+conexão própria (sem commit extra na sessão da requisição).
+
+Se o banco estiver indisponível, o lote vai para um arquivo local só de
+acréscimo (AUDIT_FALLBACK_FILE, uma linha JSON por registro), regravado
+no banco quando uma gravação voltar a funcionar. Na saída do processo o
+buffer é esvaziado (atexit).
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, or_
+
+from app.database import db
+from app.models import AuditLog
+
+class AuditLogWriter:
+    """Buffer + thread de gravação dos registros de auditoria"""
+    
+    def __init__(self, batch_size=100, flush_interval=2.0, max_buffer=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.fallback_path = None
+        self.enabled = True
+        self._app = None
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config.get('AUDIT_LOG_ASYNC', True) and not app.config.get('TESTING')
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', self.flush_interval)
+        self.max_buffer = app.config.get('AUDIT_MAX_BUFFER', self.max_buffer)
+        self.fallback_path = app.config.get('AUDIT_FALLBACK_FILE')
+    
+    # =================== ENFILEIRAR ===================
+    
+    def enqueue(self, record):
+        """
+        Registrar (dicionário com as colunas de audit_logs)
+        
+        Desativado (AUDIT_LOG_ASYNC=false ou testes), grava na hora; se o
+        banco falhar, o registro vai para o arquivo de contingência.
+        """
+        record.setdefault('created_at', datetime.utcnow())
+        if not self.enabled or self._app is None:
+            if not self._write([record]):
+                self._spill([record])
+            return
+        
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                # Thread atrasada (banco lento): não segurar memória nem a requisição
+                overflow = True
+            else:
+                overflow = False
+                self._buffer.append(record)
+                full = len(self._buffer) >= self.batch_size
+        
+        if overflow:
+            self._spill([record])
+            return
+        
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+    
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+            self._thread.start()
+    
+    # =================== THREAD ===================
+    
+    def _run(self):
+        self.replay_fallback()
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def _take(self):
+        with self._lock:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+    
+    def flush(self):
+        """Gravar tudo o que está no buffer, em lotes de batch_size"""
+        written = 0
+        while True:
+            batch = self._take()
+            if not batch:
+                break
+            if not self._write(batch):
+                self._spill(batch)
+                continue
+            written += len(batch)
+        
+        if written and self.fallback_path and os.path.exists(self.fallback_path):
+            self.replay_fallback()
+        return written
+    
+    def _write(self, batch):
+        """INSERT de várias linhas em uma conexão própria; False se o banco falhar"""
+        try:
+            with self._write_lock, self._app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(AuditLog.__table__.insert(), batch)
+            return True
+        except Exception as e:
+            logging.error(f"Erro ao gravar {len(batch)} registro(s) de auditoria: {e}")
+            return False
+    
+    def _app_context(self):
+        app = current_app._get_current_object() if has_app_context() else self._app
+        return app.app_context()
+    
+    # =================== ARQUIVO DE CONTINGÊNCIA ===================
+    
+    def _spill(self, batch):
+        """Acrescentar o lote ao arquivo local (banco indisponível)"""
+        if not self.fallback_path:
+            logging.error(f"{len(batch)} registro(s) de auditoria perdidos: AUDIT_FALLBACK_FILE não configurado")
+            return
+        
+        lines = [
+            json.dumps(dict(record, created_at=record['created_at'].isoformat()), ensure_ascii=False)
+            for record in batch
+        ]
+        with self._file_lock:
+            os.makedirs(os.path.dirname(self.fallback_path) or '.', exist_ok=True)
+            with open(self.fallback_path, 'a', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+    
+    def replay_fallback(self):
+        """Regravar no banco os registros do arquivo de contingência"""
+        if not self.fallback_path or not self._replay_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._replay()
+        finally:
+            self._replay_lock.release()
+    
+    def _replay(self):
+        replaying = f'{self.fallback_path}.replaying'
+        with self._file_lock:
+            # Arquivo de uma tentativa anterior interrompida vem primeiro
+            if not os.path.exists(replaying):
+                if not os.path.exists(self.fallback_path):
+                    return 0
+                os.replace(self.fallback_path, replaying)
+        
+        records = []
+        with open(replaying, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    record['created_at'] = datetime.fromisoformat(record['created_at'])
+                    records.append(record)
+        
+        for start in range(0, len(records), self.batch_size):
+            if not self._write(records[start:start + self.batch_size]):
+                # Banco caiu de novo: o restante continua no arquivo .replaying
+                if start:
+                    self._rewrite(replaying, records[start:])
+                return start
+        
+        os.remove(replaying)
+        if records:
+            logging.info(f"{len(records)} registro(s) de auditoria regravados do arquivo de contingência")
+        return len(records)
+    
+    def _rewrite(self, path, records):
+        partial = f'{path}.part'
+        with open(partial, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(dict(record, created_at=record['created_at'].isoformat()),
+                                      ensure_ascii=False) + '\n')
+        os.replace(partial, path)
+    
+    # =================== ENCERRAMENTO ===================
+    
+    def shutdown(self, timeout=10):
+        """Parar a thread e gravar o que restou no buffer"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._app is not None:
+            self.flush()
+
+# Instância global do gravador
+audit_writer = AuditLogWriter()
+atexit.register(audit_writer.shutdown)
+
+def init_audit_log(app):
+    """Configurar o gravador (a thread sobe no primeiro registro)"""
+    audit_writer.init_app(app)
+
+# =================== CONSULTA (TELA DE AUDITORIA) ===================
+
+AUDIT_PAGE_SIZE = 50
+
+def encode_cursor(log):
+    """Posição do último registro da página: 'data ISO|id'"""
+    return f'{log.created_at.isoformat()}|{log.id}'
+
+def decode_cursor(value):
+    """(data, id) ou None para cursor ausente/inválido"""
+    try:
+        created_at, log_id = value.split('|')
+        return datetime.fromisoformat(created_at), int(log_id)
+    except (AttributeError, ValueError):
+        return None
+
+class AuditLogPage:
+    """Página de registros por cursor (keyset), do mais recente para o mais antigo"""
+    
+    def __init__(self, items, cursor, next_cursor, total):
+        self.items = items
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.total = total
+        self.has_prev = cursor is not None
+        self.has_next = next_cursor is not None
+
+def audit_log_page(query, cursor=None, per_page=AUDIT_PAGE_SIZE):
+    """
+    Página de AuditLog já filtrada
+    
+    Sem OFFSET: a condição (created_at, id) < cursor usa os índices
+    (..., created_at) e o custo não cresce com o número da página.
+    """
+    total = query.order_by(None).count()
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, log_id = position
+        query = query.filter(or_(
+            AuditLog.created_at < created_at,
+            and_(AuditLog.created_at == created_at, AuditLog.id < log_id)
+        ))
+    
+    logs = query.order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(per_page + 1).all()
+    next_cursor = encode_cursor(logs[per_page - 1]) if len(logs) > per_page else None
+    return AuditLogPage(logs[:per_page], cursor if position else None, next_cursor, total)
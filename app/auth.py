@@ -1,7 +1,8 @@
 from functools import wraps
 from flask import request, jsonify, redirect, url_for, flash, session
 from flask_login import current_user, logout_user
-from app.models import User, AuditLog, db
+from app.models import User, db
+from app.audit_log import audit_writer
 import json
 from datetime import datetime
 
@@ -40,20 +41,18 @@ def staff_required(f):
     return login_required_role('admin', 'pharmacist', 'attendant')(f)
 
 def log_action(action, table_name, record_id=None, old_values=None, new_values=None):
-    """Registra ação no log de auditoria"""
+    """Registra ação no log de auditoria (gravado em lote, fora da transação da requisição)"""
     try:
-        audit_log = AuditLog(
-            user_id=current_user.id if current_user.is_authenticated else None,
-            action=action,
-            table_name=table_name,
-            record_id=record_id,
-            old_values=json.dumps(old_values) if old_values else None,
-            new_values=json.dumps(new_values) if new_values else None,
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent', '')[:500]
-        )
-        db.session.add(audit_log)
-        db.session.commit()
+        audit_writer.enqueue({
+            'user_id': current_user.id if current_user.is_authenticated else None,
+            'action': action,
+            'table_name': table_name,
+            'record_id': record_id,
+            'old_values': json.dumps(old_values) if old_values else None,
+            'new_values': json.dumps(new_values) if new_values else None,
+            'ip_address': request.remote_addr,
+            'user_agent': request.headers.get('User-Agent', '')[:500]
+        })
     except Exception as e:
         # Em caso de erro no log, não queremos quebrar a aplicação
         print(f"Erro ao registrar log de auditoria: {e}")
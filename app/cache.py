@@ -0,0 +1,269 @@
+"""
+Módulo de Cache em Memória
+Caches LRU com expiração (TTL) por processo, com contadores de acerto
+e invalidação automática após o commit das gravações que os afetam
+
+Gravações também publicam eventos por tópico ('medications', 'high_cost',
+...) entregues aos assinantes após o commit; entradas marcadas com o
+tópico (tags) são removidas sem limpar o restante do cache.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# Marcador de "chave ausente" (permite guardar None, [] e {} como resultado)
+MISSING = object()
+
+class TTLCache:
+    """
+    Cache LRU com expiração por entrada, seguro para as threads do Waitress
+    
+    - maxsize: entradas máximas (a menos usada recentemente sai primeiro)
+    - ttl: segundos de validade padrão de cada entrada
+    """
+    
+    def __init__(self, name, maxsize=1024, ttl=60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._generation = 0
+        self._tag_generations = {}
+    
+    def configure(self, maxsize=None, ttl=None):
+        """Ajustar limites (valores None mantêm os atuais)"""
+        with self._lock:
+            if maxsize:
+                self.maxsize = int(maxsize)
+            if ttl is not None:
+                self.ttl = float(ttl)
+            self._trim()
+    
+    def get(self, key, default=MISSING):
+        """Valor da chave ou default se ausente/expirada"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+    
+    def set(self, key, value, ttl=None, generation=None, tags=()):
+        """
+        Gravar valor; com generation, só grava se não houve clear() (nem
+        invalidate_tag() de uma das tags) desde então - evita recolocar no
+        cache um resultado calculado antes da invalidação
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self._current_generation(tags):
+                return
+            self._data[key] = (expires_at, value, frozenset(tags))
+            self._data.move_to_end(key)
+            self._trim()
+    
+    def generation(self, tags=()):
+        """Geração atual, para set(..., generation=) de um valor calculado fora do cache"""
+        with self._lock:
+            return self._current_generation(tags)
+    
+    def get_or_set(self, key, factory, ttl=None, tags=()):
+        """Valor em cache ou resultado de factory() (gravado no cache)"""
+        generation = self.generation(tags)
+        value = self.get(key)
+        if value is MISSING:
+            value = factory()
+            self.set(key, value, ttl, generation=generation, tags=tags)
+        return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self.invalidations += 1
+    
+    def invalidate_tag(self, tag):
+        """Remover só as entradas marcadas com a tag"""
+        with self._lock:
+            for key in [key for key, entry in self._data.items() if tag in entry[2]]:
+                del self._data[key]
+            self._tag_generations[tag] = self._tag_generations.get(tag, 0) + 1
+            self.invalidations += 1
+    
+    def _current_generation(self, tags):
+        return (self._generation,) + tuple(self._tag_generations.get(tag, 0) for tag in tags)
+    
+    def _trim(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits * 100 / lookups, 1) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+# =================== REGISTRO DE CACHES ===================
+
+_caches = {}
+
+def register_cache(name, maxsize=1024, ttl=60):
+    """Criar (ou devolver o já existente) cache com esse nome"""
+    if name not in _caches:
+        _caches[name] = TTLCache(name, maxsize=maxsize, ttl=ttl)
+    return _caches[name]
+
+def get_cache(name):
+    return _caches[name]
+
+def clear_cache(name):
+    _caches[name].clear()
+
+def all_cache_stats():
+    """Estatísticas de todos os caches registrados"""
+    return [cache.stats() for cache in _caches.values()]
+
+# Autocomplete (main.js chama a cada tecla digitada)
+patient_search_cache = register_cache('patient_search', maxsize=2048, ttl=60)
+medication_search_cache = register_cache('medication_search', maxsize=1024, ttl=60)
+
+# Contadores dos dashboards, por tabela (chave: (bloco, dia))
+dashboard_stats_cache = register_cache('dashboard_stats', maxsize=64, ttl=300)
+
+def init_caches(app):
+    """Aplicar limites configurados (config.py) aos caches"""
+    patient_search_cache.configure(
+        maxsize=app.config.get('TYPEAHEAD_CACHE_SIZE'),
+        ttl=app.config.get('TYPEAHEAD_CACHE_TTL')
+    )
+    medication_search_cache.configure(
+        maxsize=app.config.get('TYPEAHEAD_CACHE_SIZE'),
+        ttl=app.config.get('TYPEAHEAD_CACHE_TTL')
+    )
+    dashboard_stats_cache.configure(ttl=app.config.get('DASHBOARD_STATS_TTL'))
+
+# =================== INVALIDAÇÃO APÓS COMMIT ===================
+
+# Classe do modelo -> nomes dos caches afetados por gravações nela
+_model_caches = {}
+
+def invalidate_on_write(model, *cache_names):
+    """Limpar os caches após o commit de qualquer INSERT/UPDATE/DELETE do modelo"""
+    _model_caches.setdefault(model, set()).update(cache_names)
+
+def mark_caches_dirty(session, *cache_names):
+    """
+    Agendar limpeza de caches para o próximo commit da sessão
+    
+    Para gravações que não passam pelo ORM (UPDATE em massa, SQL direto).
+    """
+    session.info.setdefault('dirty_caches', set()).update(cache_names)
+
+# =================== EVENTOS DE GRAVAÇÃO (APÓS COMMIT) ===================
+
+# Classe do modelo -> [(tópico, colunas que o disparam ou None)]
+_model_topics = {}
+
+# Tópico -> funções chamadas com o tópico após o commit
+_subscribers = {}
+
+def publish_on_write(model, topic, columns=None):
+    """
+    Publicar o tópico após o commit de gravações do modelo
+    
+    INSERT e DELETE sempre publicam; UPDATE só quando alguma das colunas
+    mudou (columns=None: qualquer coluna).
+    """
+    _model_topics.setdefault(model, []).append((topic, tuple(columns) if columns else None))
+
+def subscribe(topic, handler):
+    """Registrar handler(topic), chamado após o commit que publicou o tópico"""
+    _subscribers.setdefault(topic, []).append(handler)
+
+def invalidate_tag_on(topic, cache):
+    """Atalho: remover do cache as entradas marcadas com o tópico"""
+    subscribe(topic, cache.invalidate_tag)
+
+def publish(session, *topics):
+    """
+    Publicar tópicos no próximo commit da sessão
+    
+    Para gravações que não passam pelo ORM (UPDATE em massa, SQL direto).
+    """
+    session.info.setdefault('pending_topics', set()).update(topics)
+
+def _changed_topics(instance, is_update):
+    for model, rules in _model_topics.items():
+        if not isinstance(instance, model):
+            continue
+        for topic, columns in rules:
+            if not is_update:
+                yield topic
+                continue
+            attrs = inspect(instance).attrs
+            names = columns or [attr.key for attr in attrs]
+            if any(attrs[name].history.has_changes() for name in names):
+                yield topic
+
+# =================== LISTENERS DA SESSÃO ===================
+
+@event.listens_for(Session, 'after_flush')
+def _collect_dirty_caches(session, flush_context):
+    if _model_caches:
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            for model, cache_names in _model_caches.items():
+                if isinstance(instance, model):
+                    mark_caches_dirty(session, *cache_names)
+    
+    # Histórico das colunas ainda disponível aqui (antes do expire do commit)
+    if _model_topics:
+        for instance in itertools.chain(session.new, session.deleted):
+            publish(session, *_changed_topics(instance, is_update=False))
+        for instance in session.dirty:
+            publish(session, *_changed_topics(instance, is_update=True))
+
+@event.listens_for(Session, 'after_commit')
+def _clear_dirty_caches(session):
+    # Limpar só depois do commit: antes disso outra thread poderia
+    # recolocar no cache o valor antigo, ainda visível no banco
+    for name in session.info.pop('dirty_caches', ()):
+        if name in _caches:
+            _caches[name].clear()
+    
+    for topic in session.info.pop('pending_topics', ()):
+        for handler in _subscribers.get(topic, ()):
+            try:
+                handler(topic)
+            except Exception as e:
+                logging.error(f"Erro no assinante do evento '{topic}': {e}")
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_dirty_caches(session):
+    session.info.pop('dirty_caches', None)
+    session.info.pop('pending_topics', None)
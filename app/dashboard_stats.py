@@ -0,0 +1,226 @@
+"""
+Serviço de Estatísticas dos Dashboards
+Todos os contadores de uma tabela saem de uma única consulta com
+agregação condicional (SUM(CASE WHEN ...)), e cada bloco fica em cache,
+compartilhado entre os dashboards de todos os perfis.
+
+Um dashboard custa 2-3 consultas (uma por tabela) em vez de 10+ COUNTs.
+Cada bloco é marcado com o tópico da sua tabela e removido logo após o
+commit que a altera (publish_on_write em models.py), então o TTL pode
+ser longo sem mostrar números velhos.
+"""
+
+from datetime import date, timedelta
+
+from sqlalchemy import case, func
+
+from app.database import db
+from app.cache import dashboard_stats_cache, invalidate_tag_on
+from app.models import (
+    Patient, Medication, Dispensation, HighCostProcess, User, ProcessStatus
+)
+
+def count_if(condition):
+    """COUNT condicional: SUM(CASE WHEN condição THEN 1 ELSE 0 END)"""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+def _row_to_dict(row):
+    return {key: int(value or 0) for key, value in row._mapping.items()}
+
+class DashboardStatsService:
+    """
+    Contadores dos dashboards agrupados por tabela
+    
+    Cada método *_counts() executa uma consulta; os métodos por perfil
+    (admin_stats, pharmacist_stats, attendant_stats, api_stats) só montam
+    o dicionário que o template espera a partir dos blocos em cache.
+    """
+    
+    # =================== CONSULTAS (UMA POR TABELA) ===================
+    
+    @staticmethod
+    def patient_counts(today):
+        row = db.session.query(
+            func.count(Patient.id).label('total'),
+            count_if(Patient.is_active == True).label('active'),
+            count_if(Patient.source == 'local').label('local'),
+            count_if(Patient.source == 'imported').label('imported'),
+            count_if(Patient.esus_sync_date.isnot(None)).label('synced'),
+            count_if((Patient.source == 'imported') & (Patient.created_at >= today)).label('imported_today')
+        ).one()
+        return _row_to_dict(row)
+    
+    @staticmethod
+    def medication_counts(today):
+        row = db.session.query(
+            func.count(Medication.id).label('total'),
+            count_if(Medication.is_active == True).label('active'),
+            count_if(Medication.current_stock <= Medication.minimum_stock).label('low_stock'),
+            count_if(
+                Medication.expiry_date.isnot(None) & (Medication.expiry_date <= today + timedelta(days=30))
+            ).label('near_expiry'),
+            count_if((Medication.is_active == True) & (Medication.current_stock > 0)).label('available')
+        ).one()
+        return _row_to_dict(row)
+    
+    @staticmethod
+    def high_cost_counts(today):
+        row = db.session.query(
+            func.count(HighCostProcess.id).label('total'),
+            count_if(HighCostProcess.status == ProcessStatus.PENDING).label('pending'),
+            count_if(HighCostProcess.status == ProcessStatus.UNDER_EVALUATION).label('under_evaluation')
+        ).one()
+        return _row_to_dict(row)
+    
+    @staticmethod
+    def user_counts(today):
+        row = db.session.query(
+            func.count(User.id).label('total'),
+            count_if(User.is_active == True).label('active')
+        ).one()
+        return _row_to_dict(row)
+    
+    @staticmethod
+    def medication_alerts(today):
+        """
+        Alertas do farmacêutico: estoque baixo e vencimento em 30 dias
+        (Row com as colunas exibidas - seguro para compartilhar entre threads)
+        """
+        columns = (
+            Medication.id, Medication.commercial_name, Medication.dosage,
+            Medication.batch_number, Medication.current_stock,
+            Medication.minimum_stock, Medication.expiry_date
+        )
+        return {
+            'low_stock': db.session.query(*columns).filter(
+                Medication.current_stock <= Medication.minimum_stock
+            ).limit(5).all(),
+            'near_expiry': db.session.query(*columns).filter(
+                Medication.expiry_date.isnot(None),
+                Medication.expiry_date <= today + timedelta(days=30)
+            ).limit(5).all()
+        }
+    
+    @staticmethod
+    def dispensation_counts(today):
+        """
+        Dispensações de hoje por dispensador (varredura só do dia pelo índice
+        de dispensation_date); o total do dia é a soma
+        """
+        rows = db.session.query(
+            Dispensation.dispenser_id, func.count(Dispensation.id)
+        ).filter(
+            Dispensation.dispensation_date >= today
+        ).group_by(Dispensation.dispenser_id).all()
+        
+        by_dispenser = {dispenser_id: count for dispenser_id, count in rows}
+        return {
+            'today': sum(by_dispenser.values()),
+            'today_by_dispenser': by_dispenser
+        }
+    
+    # Nome do bloco (= tópico de invalidação) -> método que o calcula
+    SECTIONS = {
+        'patients': 'patient_counts',
+        'medications': 'medication_counts',
+        'medication_alerts': 'medication_alerts',
+        'high_cost': 'high_cost_counts',
+        'users': 'user_counts',
+        'dispensations': 'dispensation_counts'
+    }
+    
+    @classmethod
+    def section(cls, name):
+        """
+        Bloco em cache (recalculado após gravação na tabela, após o TTL
+        ou na virada do dia)
+        """
+        today = date.today()
+        return dashboard_stats_cache.get_or_set(
+            (name, today), lambda: getattr(cls, cls.SECTIONS[name])(today), tags=(name,)
+        )
+    
+    # =================== DICIONÁRIOS POR PERFIL ===================
+    
+    @classmethod
+    def admin_stats(cls):
+        patients = cls.section('patients')
+        medications = cls.section('medications')
+        return {
+            'total_patients': patients['active'],
+            'total_users': cls.section('users')['active'],
+            'total_medications': medications['active'],
+            'pending_high_cost': cls.section('high_cost')['pending'],
+            'low_stock_medications': medications['low_stock'],
+            'near_expiry_medications': medications['near_expiry'],
+            'patients_from_esus': patients['imported'],
+            'patients_synced_esus': patients['synced']
+        }
+    
+    @classmethod
+    def pharmacist_stats(cls):
+        high_cost = cls.section('high_cost')
+        return {
+            'pending_evaluations': high_cost['under_evaluation'],
+            'pending_approvals': high_cost['pending'],
+            'low_stock_count': cls.section('medications')['low_stock'],
+            'today_dispensations': cls.section('dispensations')['today']
+        }
+    
+    @classmethod
+    def attendant_stats(cls, user_id):
+        return {
+            'today_dispensations': cls.section('dispensations')['today_by_dispenser'].get(user_id, 0),
+            'total_patients': cls.section('patients')['active'],
+            'available_medications': cls.section('medications')['available']
+        }
+    
+    @classmethod
+    def api_stats(cls, include_evaluations=False):
+        """Contadores de /api/dashboard/stats (sem o status do e-SUS)"""
+        patients = cls.section('patients')
+        return {
+            'today_dispensations': cls.section('dispensations')['today'],
+            'total_patients': patients['active'],
+            'low_stock_medications': cls.section('medications')['low_stock'],
+            'pending_evaluations': cls.section('high_cost')['pending'] if include_evaluations else 0,
+            'esus_imported_today': patients['imported_today']
+        }
+    
+    @classmethod
+    def system_stats(cls):
+        """Resumo de utils.get_system_stats (injetado em todos os templates)"""
+        return {
+            'total_patients': cls.section('patients')['active'],
+            'total_medications': cls.section('medications')['active'],
+            'pending_high_cost': cls.section('high_cost')['pending'],
+            'today_dispensations': cls.section('dispensations')['today']
+        }
+    
+    @classmethod
+    def database_totals(cls):
+        """
+        Totais de admin_system_info (usado pelo amostrador de status)
+        
+        Sem cache: o amostrador já guarda o retrato.
+        """
+        today = date.today()
+        patients = cls.patient_counts(today)
+        medications = cls.medication_counts(today)
+        users = cls.user_counts(today)
+        return {
+            'total_patients': patients['total'],
+            'active_patients': patients['active'],
+            'total_medications': medications['total'],
+            'active_medications': medications['active'],
+            'total_dispensations': db.session.query(func.count(Dispensation.id)).scalar() or 0,
+            'total_high_cost_processes': cls.high_cost_counts(today)['total'],
+            'total_users': users['total'],
+            'active_users': users['active'],
+            'esus_imported_patients': patients['imported'],
+            'esus_synced_patients': patients['synced']
+        }
+
+# Cada bloco sai do cache logo após o commit que altera sua tabela
+for _topic in DashboardStatsService.SECTIONS:
+    invalidate_tag_on(_topic, dashboard_stats_cache)
@@ -3,11 +3,16 @@ Database configuration
 """
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import inspect, text
+import logging
 
 # Instâncias globais
 db = SQLAlchemy()
 login_manager = LoginManager()
 
+# Preenchimentos de dados derivados: [(tabelas/colunas que disparam, função)]
+_backfills = []
+
 def init_extensions(app):
     """Inicializar extensões com a app"""
     db.init_app(app)
@@ -18,4 +23,63 @@ def init_extensions(app):
     login_manager.login_message = 'Faça login para acessar esta página.'
     login_manager.login_message_category = 'info'
     
-    return db, login_manager
\ No newline at end of file
+    return db, login_manager
+
+def register_backfill(triggers, function):
+    """
+    Rodar function() no upgrade_schema quando alguma das tabelas ('tabela')
+    ou colunas ('tabela.coluna') de triggers for criada naquela execução
+    
+    Para dados derivados (agregados, índices) que as telas leem direto:
+    em um banco já existente a tabela nova nasce vazia.
+    """
+    _backfills.append((frozenset(triggers), function))
+
+def upgrade_schema():
+    """
+    Criar tabelas novas e adicionar colunas novas dos modelos em bancos já existentes.
+    
+    db.create_all() não altera tabelas que já existem; aqui cada coluna
+    declarada no modelo e ausente no banco é criada com ALTER TABLE
+    (sempre como NULL, para não falhar em tabelas com dados). Depois
+    rodam os preenchimentos (register_backfill) das tabelas e colunas
+    criadas agora.
+    Deve ser chamado dentro de um app_context.
+    """
+    existing_tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    created = {table.name for table in db.metadata.sorted_tables if table.name not in existing_tables}
+    
+    inspector = inspect(db.engine)
+    added = []
+    
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} NULL"))
+                added.append(f"{table.name}.{column.name}")
+                created.add(f"{table.name}.{column.name}")
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=conn)
+                    added.append(index.name)
+    
+    for item in added:
+        logging.info(f"Esquema atualizado: {item}")
+    
+    for triggers, function in _backfills:
+        if triggers & created:
+            result = function()
+            added.append(f"{function.__name__}: {result}")
+            logging.info(f"Dados derivados preenchidos: {function.__name__} ({result})")
+    
+    return added
@@ -6,11 +6,406 @@ Banco local: MySQL | Banco e-SUS: PostgreSQL
 import mysql.connector
 import psycopg2
 import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
-from flask import current_app
+from flask import current_app, g, has_request_context
 from sqlalchemy import create_engine, text
 from app.database import db
+from app.cache import MISSING, register_cache
+
+# =================== CACHE DE CREDENCIAIS E POOL E-SUS ===================
+
+# Verificação de saúde que falha depois disso conta como e-SUS sem resposta
+# (SELECT 1 responde em milissegundos; conexão velha após restart falha na hora)
+HEALTH_CHECK_SLOW = 1.0  # segundos
+
+# Credenciais lidas da tabela Config ficam em memória até serem invalidadas
+# por save_esus_credentials (evita uma conexão MySQL extra a cada busca)
+_credentials_lock = threading.Lock()
+_credentials_cache = {'loaded': False, 'loaded_at': 0.0, 'value': None}
+
+def invalidate_esus_credentials_cache():
+    """Descarta credenciais em cache e fecha o pool de conexões e-SUS"""
+    with _credentials_lock:
+        _credentials_cache['loaded'] = False
+        _credentials_cache['value'] = None
+    esus_pool.close_all()
+    esus_search_cache.clear()
+    esus_breaker.reset()
+
+class ESUSConnectionPool:
+    """
+    Pool de conexões PostgreSQL com o e-SUS, compartilhado pelo processo.
+    
+    - Checkout com verificação de saúde (SELECT 1) para conexões ociosas
+    - Tamanho máximo configurável (ESUS_POOL_MAX_SIZE)
+    - Descarte de conexões ociosas há mais de ESUS_POOL_IDLE_TIMEOUT segundos
+    
+    Nada que fale com a rede (verificação, conexão, fechamento) roda com o
+    lock adquirido: um socket derrubado sem aviso só atrasa a thread que o
+    pegou, e keepalives/tcp_user_timeout (ESUS_SOCKET_TIMEOUT) limitam essa
+    espera.
+    """
+    
+    def __init__(self, max_size=5, idle_timeout=300, health_check_after=30, socket_timeout=10):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.socket_timeout = socket_timeout
+        self._lock = threading.Condition()
+        self._idle = []  # [(conexão, timestamp do último uso)]
+        self._in_use = 0
+        self._credentials_key = None
+        self._owners = {}  # id(conexão) -> credenciais usadas para abri-la
+    
+    def configure(self, max_size=None, idle_timeout=None, socket_timeout=None):
+        """Atualizar parâmetros do pool a partir da configuração da app"""
+        with self._lock:
+            if max_size:
+                self.max_size = max_size
+            if idle_timeout:
+                self.idle_timeout = idle_timeout
+            if socket_timeout:
+                self.socket_timeout = socket_timeout
+    
+    @staticmethod
+    def _key_for(credentials):
+        return tuple(str(credentials.get(field)) for field in ('dbname', 'user', 'password', 'host', 'port'))
+    
+    @staticmethod
+    def _close_quietly(connections):
+        """Fechar conexões já retiradas do pool (chamar sem o lock)"""
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    
+    def _forget(self, conn):
+        """Retirar a conexão do controle do pool (chamar com o lock adquirido)"""
+        self._owners.pop(id(conn), None)
+        return conn
+    
+    def _take_stale(self):
+        """Retirar conexões ociosas expiradas (chamar com o lock; fechar depois, sem ele)"""
+        now = time.monotonic()
+        fresh = []
+        stale = []
+        for conn, last_used in self._idle:
+            if conn.closed or now - last_used > self.idle_timeout:
+                stale.append(self._forget(conn))
+            else:
+                fresh.append((conn, last_used))
+        self._idle = fresh
+        return stale
+    
+    def _is_healthy(self, conn, last_used):
+        """
+        SELECT 1 em conexões paradas há mais de health_check_after (chamar sem o lock)
+        
+        Falha rápida: conexão velha, descartada. Falha lenta (socket sem
+        resposta até o timeout) é propagada: o e-SUS não está respondendo.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        started = time.monotonic()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            if time.monotonic() - started >= HEALTH_CHECK_SLOW:
+                raise
+            return False
+    
+    @staticmethod
+    def _set_socket_timeout(conn, seconds):
+        """
+        Trocar o tcp_user_timeout/keepalive de uma conexão já aberta (Linux),
+        para limitar a espera ao tempo que resta à requisição
+        """
+        user_timeout = getattr(socket, 'TCP_USER_TIMEOUT', None)
+        keep_idle = getattr(socket, 'TCP_KEEPIDLE', None)
+        if user_timeout is None or conn.closed:
+            return
+        try:
+            sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        except (OSError, ValueError):
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, user_timeout, int(seconds * 1000))
+            if keep_idle is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, keep_idle, max(1, int(seconds)))
+        except OSError:
+            pass  # socket Unix (host local): sem opções TCP
+        finally:
+            sock.close()
+    
+    def _connect_options(self, socket_timeout):
+        """
+        Keepalives e tcp_user_timeout da libpq: leitura ou escrita em um socket
+        que o servidor (ou um firewall) derrubou sem aviso falha em cerca de
+        socket_timeout segundos, e não no timeout TCP do sistema (minutos)
+        """
+        socket_timeout = max(1, int(socket_timeout))
+        return {
+            'keepalives': 1,
+            'keepalives_idle': socket_timeout,
+            'keepalives_interval': max(1, socket_timeout // 3),
+            'keepalives_count': 3,
+            'tcp_user_timeout': socket_timeout * 1000
+        }
+    
+    def acquire(self, credentials, connect_timeout=10, wait_timeout=None, socket_timeout=None):
+        """
+        Obter conexão do pool (ou abrir nova se houver vaga)
+        
+        socket_timeout (segundos) reduz o timeout de socket só deste
+        empréstimo, inclusive da verificação de saúde. Verificação que
+        estoura o timeout levanta o erro da conexão.
+        """
+        key = self._key_for(credentials)
+        wait_timeout = connect_timeout if wait_timeout is None else wait_timeout
+        socket_timeout = min(socket_timeout or self.socket_timeout, self.socket_timeout)
+        deadline = time.monotonic() + wait_timeout
+        
+        while True:
+            to_close = []
+            candidate = None
+            reserved = False
+            with self._lock:
+                # Credenciais mudaram: conexões antigas não servem mais
+                if self._credentials_key != key:
+                    to_close.extend(self._forget(conn) for conn, _ in self._idle)
+                    self._idle = []
+                    self._credentials_key = key
+                
+                to_close.extend(self._take_stale())
+                
+                while True:
+                    # A vaga fica reservada (in_use) durante a verificação ou a conexão
+                    if self._idle:
+                        candidate = self._idle.pop()
+                        self._in_use += 1
+                        reserved = True
+                        break
+                    
+                    if self._in_use < self.max_size:
+                        self._in_use += 1
+                        reserved = True
+                        break
+                    
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+            
+            self._close_quietly(to_close)
+            
+            if not reserved:
+                logging.warning("Pool e-SUS esgotado - nenhuma conexão disponível")
+                return None
+            if candidate is None:
+                break
+            
+            conn, last_used = candidate
+            self._set_socket_timeout(conn, socket_timeout)
+            try:
+                healthy = self._is_healthy(conn, last_used)
+            except Exception:
+                self.release(conn, discard=True)
+                raise
+            if healthy:
+                return conn
+            self.release(conn, discard=True)
+        
+        # Abrir conexão fora do lock para não bloquear outros checkouts
+        try:
+            conn = psycopg2.connect(
+                dbname=credentials['dbname'],
+                user=credentials['user'],
+                password=credentials['password'],
+                host=credentials['host'],
+                port=credentials['port'],
+                connect_timeout=connect_timeout,
+                **self._connect_options(socket_timeout)
+            )
+            conn.set_session(readonly=True, autocommit=True)
+            with self._lock:
+                self._owners[id(conn)] = key
+            return conn
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+    
+    def release(self, conn, discard=False):
+        """Devolver conexão ao pool"""
+        if conn is None:
+            return
+        to_close = []
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+            key_matches = self._owners.get(id(conn)) == self._credentials_key
+            if discard or conn.closed or not key_matches or len(self._idle) >= self.max_size:
+                to_close.append(self._forget(conn))
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+        self._close_quietly(to_close)
+    
+    def close_all(self):
+        """Fechar todas as conexões ociosas (as em uso são fechadas ao voltar)"""
+        with self._lock:
+            to_close = [self._forget(conn) for conn, _ in self._idle]
+            self._idle = []
+            self._credentials_key = None
+            self._lock.notify_all()
+        self._close_quietly(to_close)
+    
+    def stats(self):
+        """Estado atual do pool"""
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'max_size': self.max_size,
+                'idle_timeout': self.idle_timeout,
+                'socket_timeout': self.socket_timeout
+            }
+
+# Instância global do pool e-SUS
+esus_pool = ESUSConnectionPool()
+
+class ESUSCircuitBreaker:
+    """
+    Disjuntor das chamadas ao e-SUS, compartilhado pelo processo.
+    
+    - closed: chamadas normais; failure_threshold falhas seguidas abrem o circuito
+    - open: chamadas falham na hora (sem esperar connect_timeout) por reset_timeout segundos
+    - half_open: passada a espera, uma única chamada de teste decide se fecha ou reabre
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._rejected = 0
+        self._last_error = None
+    
+    def configure(self, failure_threshold=None, reset_timeout=None):
+        with self._lock:
+            if failure_threshold:
+                self.failure_threshold = failure_threshold
+            if reset_timeout:
+                self.reset_timeout = reset_timeout
+    
+    def allow_request(self):
+        """True se a chamada pode ir ao e-SUS agora"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.CLOSED:
+                return True
+            
+            if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_started = None
+            
+            if self._state == self.HALF_OPEN:
+                # Só uma chamada de teste por vez (uma perdida libera após reset_timeout)
+                if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                    self._probe_started = now
+                    return True
+            
+            self._rejected += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logging.info("Circuito e-SUS fechado - conexão restabelecida")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_started = None
+    
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failures += 1
+            self._last_error = str(error) if error else None
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logging.warning(
+                        f"Circuito e-SUS aberto após {self._failures} falha(s) - "
+                        f"novas chamadas falham na hora por {self.reset_timeout}s"
+                    )
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+    
+    def reset(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_started = None
+            self._last_error = None
+    
+    @property
+    def is_open(self):
+        """Circuito aberto e ainda dentro da espera (chamadas seriam rejeitadas)"""
+        with self._lock:
+            return self._state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+    
+    def stats(self):
+        with self._lock:
+            retry_in = 0
+            if self._state == self.OPEN:
+                retry_in = max(0, round(self.reset_timeout - (time.monotonic() - self._opened_at), 1))
+            return {
+                'state': self._state,
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'retry_in': retry_in,
+                'rejected': self._rejected,
+                'last_error': self._last_error
+            }
+
+# Instância global do disjuntor e-SUS
+esus_breaker = ESUSCircuitBreaker()
+
+# Erros que indicam e-SUS inacessível/lento (QueryCanceledError é subclasse de OperationalError)
+ESUS_FAILURE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def esus_budget_remaining():
+    """
+    Segundos que ainda podem ser gastos com o e-SUS nesta requisição
+    (ESUS_REQUEST_BUDGET); None fora de uma requisição (scripts, CLI)
+    """
+    if not has_request_context():
+        return None
+    budget = current_app.config.get('ESUS_REQUEST_BUDGET', 5)
+    return budget - g.get('esus_time_spent', 0.0)
+
+def _charge_esus_budget(elapsed):
+    if has_request_context():
+        g.esus_time_spent = g.get('esus_time_spent', 0.0) + elapsed
 
 def get_mysql_connection():
     """Conexão com banco local MySQL"""
@@ -30,53 +425,79 @@ def get_mysql_connection():
         logging.error(f"Erro ao conectar MySQL local: {e}")
         return None
 
+def _load_esus_db_credentials():
+    """Lê as credenciais do e-SUS diretamente da tabela Config (MySQL)."""
+    conn = get_mysql_connection()
+    if not conn:
+        raise ConnectionError("Conexão com banco local indisponível")
+        
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute('SELECT dbname, user, password, host, port, municipio FROM Config WHERE id = 1')
+        result = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return result
+    except mysql.connector.Error:
+        # Fallback se coluna municipio não existir
+        cursor.execute('SELECT dbname, user, password, host, port FROM Config WHERE id = 1')
+        result = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        if result:
+            result['municipio'] = None
+        return result
+
 def get_esus_db_credentials():
-    """Obtém as credenciais do banco de dados e-SUS do MySQL."""
+    """Obtém as credenciais do banco de dados e-SUS do MySQL (com cache em memória)."""
+    ttl = current_app.config.get('ESUS_CREDENTIALS_CACHE_TTL', 300)
+    
+    with _credentials_lock:
+        if _credentials_cache['loaded'] and time.monotonic() - _credentials_cache['loaded_at'] < ttl:
+            cached = _credentials_cache['value']
+            return dict(cached) if cached else None
+    
     try:
-        conn = get_mysql_connection()
-        if not conn:
-            return None
-            
-        cursor = conn.cursor(dictionary=True)
-        try:
-            cursor.execute('SELECT dbname, user, password, host, port, municipio FROM Config WHERE id = 1')
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            return result
-        except mysql.connector.Error:
-            # Fallback se coluna municipio não existir
-            cursor.execute('SELECT dbname, user, password, host, port FROM Config WHERE id = 1')
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            if result:
-                result['municipio'] = None
-            return result
+        result = _load_esus_db_credentials()
     except Exception as e:
         logging.error(f"Erro ao obter credenciais e-SUS: {e}")
         return None
+    
+    with _credentials_lock:
+        _credentials_cache['value'] = dict(result) if result else None
+        _credentials_cache['loaded_at'] = time.monotonic()
+        _credentials_cache['loaded'] = True
+    
+    return dict(result) if result else None
 
-def get_esus_db_connection():
-    """Estabelece a conexão com o banco de dados e-SUS PostgreSQL."""
+def _valid_esus_credentials():
+    """Credenciais e-SUS completas ou None"""
     credentials = get_esus_db_credentials()
     if not credentials:
         logging.warning("Credenciais e-SUS não configuradas")
         return None
     
+    required_fields = ['dbname', 'user', 'password', 'host', 'port']
+    if not all(credentials.get(field) for field in required_fields):
+        logging.warning("Credenciais e-SUS incompletas")
+        return None
+    
+    return credentials
+
+def get_esus_db_connection():
+    """Estabelece uma conexão avulsa (fora do pool) com o banco de dados e-SUS PostgreSQL."""
+    credentials = _valid_esus_credentials()
+    if not credentials:
+        return None
+    
     try:
-        required_fields = ['dbname', 'user', 'password', 'host', 'port']
-        if not all(credentials.get(field) for field in required_fields):
-            logging.warning("Credenciais e-SUS incompletas")
-            return None
-        
         connection = psycopg2.connect(
             dbname=credentials['dbname'],
             user=credentials['user'],
             password=credentials['password'],
             host=credentials['host'],
             port=credentials['port'],
-            connect_timeout=10
+            connect_timeout=current_app.config.get('ESUS_CONNECT_TIMEOUT', 10)
         )
         
         logging.info("Conexão e-SUS estabelecida com sucesso")
@@ -89,18 +510,108 @@ def get_esus_db_connection():
         logging.error(f"Erro inesperado na conexão e-SUS: {e}")
         return None
 
-def test_esus_connection():
-    """Testa a conexão com o banco e-SUS"""
+@contextmanager
+def esus_connection(force=False):
+    """
+    Conexão e-SUS emprestada do pool do processo.
+    
+    Uso:
+        with esus_connection() as conn:
+            if conn: ...
+    
+    Entrega None se o e-SUS não estiver configurado ou acessível, se o
+    circuito estiver aberto ou se o orçamento de tempo e-SUS da requisição
+    (ESUS_REQUEST_BUDGET) tiver acabado. Conexão, socket (tcp_user_timeout)
+    e consultas usam no máximo o tempo restante do orçamento; verificação de
+    saúde que estoura o timeout conta como falha no disjuntor. force=True
+    ignora o circuito aberto (teste manual pelo administrador).
+    """
+    credentials = _valid_esus_credentials()
+    if not credentials:
+        yield None
+        return
+    
+    config = current_app.config
+    
+    remaining = esus_budget_remaining()
+    if remaining is not None and remaining < 1:
+        logging.warning("Orçamento de tempo e-SUS da requisição esgotado - chamada ignorada")
+        yield None
+        return
+    
+    esus_breaker.configure(
+        failure_threshold=config.get('ESUS_BREAKER_FAILURES'),
+        reset_timeout=config.get('ESUS_BREAKER_RESET_TIMEOUT')
+    )
+    if not force and not esus_breaker.allow_request():
+        logging.debug("Circuito e-SUS aberto - chamada rejeitada sem conectar")
+        yield None
+        return
+    
+    esus_pool.configure(
+        max_size=config.get('ESUS_POOL_MAX_SIZE'),
+        idle_timeout=config.get('ESUS_POOL_IDLE_TIMEOUT'),
+        socket_timeout=config.get('ESUS_SOCKET_TIMEOUT')
+    )
+    
+    # libpq aceita connect_timeout inteiro, mínimo 2 segundos
+    connect_timeout = config.get('ESUS_CONNECT_TIMEOUT', 10)
+    statement_timeout = config.get('ESUS_STATEMENT_TIMEOUT', 15)
+    socket_timeout = config.get('ESUS_SOCKET_TIMEOUT', 10)
+    if remaining is not None:
+        connect_timeout = max(2, min(connect_timeout, int(remaining)))
+        statement_timeout = min(statement_timeout, remaining)
+        socket_timeout = min(socket_timeout, remaining)
+    
+    started = time.monotonic()
+    conn = None
     try:
-        conn = get_esus_db_connection()
-        if not conn:
-            return False, "Não foi possível estabelecer conexão"
-        
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT 1")
-            cursor.fetchone()
+        conn = esus_pool.acquire(credentials, connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+        if conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (int(statement_timeout * 1000),))
+    except ESUS_FAILURE_ERRORS as e:
+        logging.error(f"Erro de conexão e-SUS: {e}")
+        esus_breaker.record_failure(e)
+        esus_pool.release(conn, discard=True)
+        conn = None
+    except Exception as e:
+        logging.error(f"Erro inesperado na conexão e-SUS: {e}")
+        esus_breaker.record_failure(e)
+        esus_pool.release(conn, discard=True)
+        conn = None
+    
+    if conn is None:
+        _charge_esus_budget(time.monotonic() - started)
+        yield None
+        return
+    
+    broken = False
+    try:
+        yield conn
+        esus_breaker.record_success()
+    except ESUS_FAILURE_ERRORS as e:
+        broken = True
+        esus_breaker.record_failure(e)
+        raise
+    finally:
+        esus_pool.release(conn, discard=broken)
+        _charge_esus_budget(time.monotonic() - started)
+
+def test_esus_connection(force=False):
+    """Testa a conexão com o banco e-SUS (force=True testa mesmo com o circuito aberto)"""
+    try:
+        with esus_connection(force=force) as conn:
+            if not conn:
+                if esus_breaker.is_open and not force:
+                    retry_in = esus_breaker.stats()['retry_in']
+                    return False, f"e-SUS indisponível (circuito aberto, nova tentativa em {retry_in}s)"
+                return False, "Não foi possível estabelecer conexão"
+            
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
         
-        conn.close()
         return True, "Conexão testada com sucesso"
         
     except Exception as e:
@@ -174,6 +685,9 @@ def save_esus_credentials(dbname, user, password, host, port, municipio=None):
         cursor.close()
         conn.close()
         
+        # Novas credenciais: descartar cache e conexões abertas com as antigas
+        invalidate_esus_credentials_cache()
+        
         logging.info("Credenciais e-SUS salvas com sucesso")
         return True, "Credenciais salvas com sucesso"
         
@@ -181,79 +695,116 @@ def save_esus_credentials(dbname, user, password, host, port, municipio=None):
         logging.error(f"Erro ao salvar credenciais e-SUS: {e}")
         return False, f"Erro ao salvar credenciais: {str(e)}"
 
-def search_patient_in_esus(query, search_type='all'):
-    """Buscar pacientes no banco e-SUS PostgreSQL"""
+# =================== CACHE DE BUSCAS E-SUS ===================
+
+# Acertos e respostas "nenhum resultado" da busca no e-SUS (um nome digitado
+# errado e repetido no balcão não refaz o LIKE '%termo%' no banco remoto)
+esus_search_cache = register_cache('esus_search', maxsize=512, ttl=120)
+
+def esus_search_cache_key(query, search_type='all'):
+    """Chave: tipo de busca + termo normalizado (maiúsculo, espaços simples)"""
+    query = query or ''
+    if search_type in ('cpf', 'cns'):
+        return (search_type, ''.join(filter(str.isdigit, query)))
+    return (search_type, ' '.join(query.upper().split()))
+
+def search_patient_in_esus(query, search_type='all', use_cache=True):
+    """
+    Buscar pacientes no banco e-SUS PostgreSQL
+    
+    Resultados (inclusive lista vazia) ficam em cache por
+    ESUS_SEARCH_CACHE_TTL / ESUS_NEGATIVE_CACHE_TTL segundos. Falhas de
+    conexão não entram no cache. use_cache=False força a consulta.
+    """
+    cache_key = esus_search_cache_key(query, search_type)
+    if use_cache:
+        cached = esus_search_cache.get(cache_key)
+        if cached is not MISSING:
+            return [dict(row) for row in cached]
+    
+    # Cache limpo durante a consulta (credenciais trocadas, limpeza manual): não regravar
+    generation = esus_search_cache.generation()
     try:
-        conn = get_esus_db_connection()
-        if not conn:
-            logging.warning("Conexão com e-SUS não disponível")
-            return []
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            conditions = []
-            params = []
-            
-            if search_type in ['all', 'name']:
-                conditions.append("UPPER(no_cidadao) LIKE UPPER(%s)")
-                params.append(f'%{query}%')
-            
-            if search_type in ['all', 'cpf']:
-                clean_cpf = ''.join(filter(str.isdigit, query))
-                if len(clean_cpf) >= 3:
-                    conditions.append("nu_cpf LIKE %s")
-                    params.append(f'%{clean_cpf}%')
-            
-            if search_type in ['all', 'cns']:
-                clean_cns = ''.join(filter(str.isdigit, query))
-                if len(clean_cns) >= 3:
-                    conditions.append("nu_cns LIKE %s")
-                    params.append(f'%{clean_cns}%')
-            
-            if search_type in ['all', 'birth_date']:
-                try:
-                    if '/' in query:
-                        birth_date = datetime.strptime(query, '%d/%m/%Y').date()
-                    elif '-' in query:
-                        birth_date = datetime.strptime(query, '%Y-%m-%d').date()
-                    else:
-                        raise ValueError("Formato de data inválido")
-                    
-                    conditions.append("dt_nascimento = %s")
-                    params.append(birth_date)
-                except ValueError:
-                    pass
-            
-            if not conditions:
+        with esus_connection() as conn:
+            if not conn:
+                logging.warning("Conexão com e-SUS não disponível")
                 return []
             
-            # Query SQL para buscar na tabela tb_cidadao do e-SUS
-            sql = f"""
-                SELECT 
-                    nu_cpf, nu_cns, no_cidadao, dt_nascimento,
-                    no_mae, no_pai, no_sexo,
-                    ds_logradouro, nu_numero, no_bairro, ds_cep,
-                    nu_telefone_residencial, nu_telefone_celular, nu_telefone_contato
-                FROM tb_cidadao 
-                WHERE ({' OR '.join(conditions)})
-                AND nu_cpf IS NOT NULL 
-                AND no_cidadao IS NOT NULL
-                AND LENGTH(TRIM(no_cidadao)) > 0
-                ORDER BY no_cidadao
-                LIMIT 20
-            """
-            
-            cursor.execute(sql, params)
-            results = cursor.fetchall()
-            
-            logging.info(f"Busca e-SUS retornou {len(results)} resultados para: {query}")
-            return [dict(row) for row in results]
+            results = _search_patient_in_esus(conn, query, search_type)
             
     except Exception as e:
         logging.error(f"Erro na busca e-SUS: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
+    
+    config = current_app.config
+    if results:
+        ttl = config.get('ESUS_SEARCH_CACHE_TTL', 120)
+    else:
+        ttl = config.get('ESUS_NEGATIVE_CACHE_TTL', 60)
+    esus_search_cache.set(cache_key, results, ttl=ttl, generation=generation)
+    
+    return [dict(row) for row in results]
+
+def _search_patient_in_esus(conn, query, search_type):
+    """Executa a busca de pacientes no e-SUS usando a conexão informada"""
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        conditions = []
+        params = []
+        
+        if search_type in ['all', 'name']:
+            conditions.append("UPPER(no_cidadao) LIKE UPPER(%s)")
+            params.append(f'%{query}%')
+        
+        if search_type in ['all', 'cpf']:
+            clean_cpf = ''.join(filter(str.isdigit, query))
+            if len(clean_cpf) >= 3:
+                conditions.append("nu_cpf LIKE %s")
+                params.append(f'%{clean_cpf}%')
+        
+        if search_type in ['all', 'cns']:
+            clean_cns = ''.join(filter(str.isdigit, query))
+            if len(clean_cns) >= 3:
+                conditions.append("nu_cns LIKE %s")
+                params.append(f'%{clean_cns}%')
+        
+        if search_type in ['all', 'birth_date']:
+            try:
+                if '/' in query:
+                    birth_date = datetime.strptime(query, '%d/%m/%Y').date()
+                elif '-' in query:
+                    birth_date = datetime.strptime(query, '%Y-%m-%d').date()
+                else:
+                    raise ValueError("Formato de data inválido")
+                
+                conditions.append("dt_nascimento = %s")
+                params.append(birth_date)
+            except ValueError:
+                pass
+        
+        if not conditions:
+            return []
+        
+        # Query SQL para buscar na tabela tb_cidadao do e-SUS
+        sql = f"""
+            SELECT 
+                nu_cpf, nu_cns, no_cidadao, dt_nascimento,
+                no_mae, no_pai, no_sexo,
+                ds_logradouro, nu_numero, no_bairro, ds_cep,
+                nu_telefone_residencial, nu_telefone_celular, nu_telefone_contato
+            FROM tb_cidadao 
+            WHERE ({' OR '.join(conditions)})
+            AND nu_cpf IS NOT NULL 
+            AND no_cidadao IS NOT NULL
+            AND LENGTH(TRIM(no_cidadao)) > 0
+            ORDER BY no_cidadao
+            LIMIT 20
+        """
+        
+        cursor.execute(sql, params)
+        results = cursor.fetchall()
+        
+        logging.info(f"Busca e-SUS retornou {len(results)} resultados para: {query}")
+        return [dict(row) for row in results]
 
 def get_esus_patient_by_cpf(cpf):
     """Buscar paciente específico por CPF no e-SUS"""
@@ -276,45 +827,46 @@ def get_esus_patient_by_cns(cns):
 def get_esus_statistics():
     """Obter estatísticas do banco e-SUS"""
     try:
-        conn = get_esus_db_connection()
-        if not conn:
-            return None
-        
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            # Total de cidadãos
-            cursor.execute("SELECT COUNT(*) as total FROM tb_cidadao WHERE nu_cpf IS NOT NULL")
-            total = cursor.fetchone()['total']
-            
-            # Por gênero
-            cursor.execute("""
-                SELECT no_sexo, COUNT(*) as count 
-                FROM tb_cidadao 
-                WHERE nu_cpf IS NOT NULL AND no_sexo IS NOT NULL
-                GROUP BY no_sexo
-            """)
-            gender_stats = cursor.fetchall()
+        with esus_connection() as conn:
+            if not conn:
+                return None
             
-            # Com CNS
-            cursor.execute("""
-                SELECT COUNT(*) as with_cns 
-                FROM tb_cidadao 
-                WHERE nu_cpf IS NOT NULL AND nu_cns IS NOT NULL
-            """)
-            with_cns = cursor.fetchone()['with_cns']
-            
-            return {
-                'total_patients': total,
-                'gender_distribution': {row['no_sexo']: row['count'] for row in gender_stats},
-                'patients_with_cns': with_cns,
-                'cns_percentage': round((with_cns / total * 100), 2) if total > 0 else 0
-            }
+            return _get_esus_statistics(conn)
             
     except Exception as e:
         logging.error(f"Erro ao obter estatísticas e-SUS: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
+
+def _get_esus_statistics(conn):
+    """Consulta as estatísticas do e-SUS usando a conexão informada"""
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        # Total de cidadãos
+        cursor.execute("SELECT COUNT(*) as total FROM tb_cidadao WHERE nu_cpf IS NOT NULL")
+        total = cursor.fetchone()['total']
+        
+        # Por gênero
+        cursor.execute("""
+            SELECT no_sexo, COUNT(*) as count 
+            FROM tb_cidadao 
+            WHERE nu_cpf IS NOT NULL AND no_sexo IS NOT NULL
+            GROUP BY no_sexo
+        """)
+        gender_stats = cursor.fetchall()
+        
+        # Com CNS
+        cursor.execute("""
+            SELECT COUNT(*) as with_cns 
+            FROM tb_cidadao 
+            WHERE nu_cpf IS NOT NULL AND nu_cns IS NOT NULL
+        """)
+        with_cns = cursor.fetchone()['with_cns']
+        
+        return {
+            'total_patients': total,
+            'gender_distribution': {row['no_sexo']: row['count'] for row in gender_stats},
+            'patients_with_cns': with_cns,
+            'cns_percentage': round((with_cns / total * 100), 2) if total > 0 else 0
+        }
 
 # Funções utilitárias para limpeza de dados
 def clean_cpf(cpf):
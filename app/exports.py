@@ -0,0 +1,118 @@
+"""
+Exportação em Streaming (CSV e XLSX)
+Linhas lidas do banco em lotes (yield_per) e escritas conforme chegam:
+memória constante mesmo para a população inteira de pacientes ou um ano
+de dispensações.
+
+- CSV: resposta gerada por generator (stream_with_context)
+- XLSX: openpyxl em modo write-only gravando em arquivo temporário,
+  enviado em blocos e apagado ao final
+"""
+
+import csv
+import os
+import tempfile
+from datetime import datetime
+from io import StringIO
+
+from flask import Response, stream_with_context
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+# Linhas por lote lidas do banco
+EXPORT_BATCH_SIZE = 1000
+
+# Bytes por bloco enviados ao cliente
+CHUNK_SIZE = 64 * 1024
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def iter_query(query, batch_size=EXPORT_BATCH_SIZE):
+    """Percorrer a consulta em lotes (cursor no servidor, sem .all())"""
+    return query.yield_per(batch_size)
+
+def export_filename(prefix, extension):
+    return f'{prefix}_{datetime.now().strftime("%Y%m%d")}.{extension}'
+
+def _attachment_headers(filename):
+    return {'Content-Disposition': f'attachment; filename="{filename}"'}
+
+def csv_response(filename, header, rows):
+    """
+    CSV em streaming (';' e BOM UTF-8 para abrir direto no Excel pt-BR)
+    
+    rows: iterável de listas/tuplas, consumido durante o envio
+    """
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        
+        buffer.write('\ufeff')
+        writer.writerow(header)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv; charset=utf-8',
+        headers=_attachment_headers(filename)
+    )
+
+class StreamingWorkbook:
+    """
+    Planilha XLSX em modo write-only (linhas não ficam em memória)
+    
+    As abas são escritas na ordem de criação; uma aba de resumo pode vir
+    depois da aba de dados, com totais acumulados durante o streaming.
+    """
+    
+    def __init__(self):
+        self.workbook = Workbook(write_only=True)
+    
+    def add_sheet(self, title, header, rows, widths=None):
+        sheet = self.workbook.create_sheet(title=title[:31])
+        for index, width in enumerate(widths or [], start=1):
+            sheet.column_dimensions[get_column_letter(index)].width = width
+        
+        header_cells = []
+        for value in header:
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.font = Font(bold=True)
+            header_cells.append(cell)
+        sheet.append(header_cells)
+        
+        for row in rows:
+            sheet.append(list(row))
+        return sheet
+    
+    def response(self, filename):
+        """Salvar em arquivo temporário e enviar em blocos"""
+        handle, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(handle)
+        try:
+            self.workbook.save(path)
+        except Exception:
+            os.remove(path)
+            raise
+        
+        def generate():
+            try:
+                with open(path, 'rb') as file:
+                    while True:
+                        chunk = file.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+            finally:
+                os.remove(path)
+        
+        response = Response(generate(), mimetype=XLSX_MIMETYPE, headers=_attachment_headers(filename))
+        response.headers['Content-Length'] = str(os.path.getsize(path))
+        return response
@@ -0,0 +1,150 @@
+"""
+Chaves de Idempotência
+POSTs repetidos (duplo clique, rede lenta) com o mesmo cabeçalho
+Idempotency-Key devolvem a resposta já gravada em vez de rodar a
+transação de novo.
+
+- antes da view: a chave é reservada (status 'processing') em um commit
+  próprio; a UNIQUE (user_id, endpoint, key) faz a segunda requisição
+  simultânea falhar no INSERT
+- resposta 2xx: corpo e status ficam gravados ('done') e as repetições
+  recebem a mesma resposta, com o cabeçalho Idempotent-Replayed
+- resposta de erro: a chave é apagada (nada foi gravado) e o cliente pode
+  tentar de novo com a mesma chave, inclusive com outro corpo
+
+Sem o cabeçalho a view roda normalmente. As chaves são apagadas depois de
+IDEMPOTENCY_TTL_HOURS.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, current_app, jsonify, make_response, request
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+
+from app.database import db
+from app.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_.:-]{8,64}$')
+
+# Limpeza das chaves vencidas no máximo uma vez por hora
+PURGE_INTERVAL = timedelta(hours=1)
+_purge_lock = threading.Lock()
+_last_purge = None
+
+def _request_hash():
+    return hashlib.sha256(request.get_data(cache=True)).hexdigest()
+
+def purge_expired():
+    """Apagar chaves mais antigas que IDEMPOTENCY_TTL_HOURS"""
+    global _last_purge
+    now = datetime.utcnow()
+    with _purge_lock:
+        if _last_purge and now - _last_purge < PURGE_INTERVAL:
+            return 0
+        _last_purge = now
+    
+    ttl = timedelta(hours=current_app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+    try:
+        deleted = IdempotencyKey.query.filter(
+            IdempotencyKey.created_at < now - ttl
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+    except Exception as e:
+        logging.error(f"Erro ao apagar chaves de idempotência: {e}")
+        db.session.rollback()
+        return 0
+
+def _reserve(key, endpoint, request_hash):
+    """
+    Reservar a chave
+    
+    Returns:
+        (registro reservado, None) ou, com a chave já em uso,
+        (None, resposta guardada / resposta de erro)
+    """
+    record = IdempotencyKey(
+        key=key,
+        user_id=current_user.id,
+        endpoint=endpoint,
+        request_hash=request_hash,
+        status='processing'
+    )
+    db.session.add(record)
+    try:
+        db.session.commit()
+        return record, None
+    except IntegrityError:
+        db.session.rollback()
+    
+    existing = IdempotencyKey.query.filter_by(
+        user_id=current_user.id, endpoint=endpoint, key=key
+    ).first()
+    if existing is None:
+        # Apagada entre o INSERT e a leitura (requisição anterior falhou): tentar de novo
+        return None, (jsonify({'error': 'Requisição em processamento, tente novamente'}), 409)
+    if existing.request_hash != request_hash:
+        return None, (jsonify({'error': 'Chave de idempotência já usada com outros dados'}), 422)
+    if existing.status != 'done':
+        return None, (jsonify({'error': 'Requisição já está em processamento'}), 409)
+    
+    return None, Response(
+        existing.response_body,
+        status=existing.response_status,
+        mimetype=existing.response_mimetype,
+        headers={REPLAYED_HEADER: 'true'}
+    )
+
+def _finish(record, response):
+    """Gravar a resposta 2xx ou liberar a chave"""
+    try:
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            record.status = 'done'
+            record.response_status = response.status_code
+            record.response_body = response.get_data(as_text=True)
+            record.response_mimetype = response.mimetype
+            record.completed_at = datetime.utcnow()
+        else:
+            db.session.delete(record)
+        db.session.commit()
+    except Exception as e:
+        # A resposta já vale; sem o registro a repetição cai em 409 até a chave vencer
+        logging.error(f"Erro ao gravar a chave de idempotência {record.key}: {e}")
+        db.session.rollback()
+
+def idempotent(f):
+    """Decorator para POSTs: repetição com o mesmo Idempotency-Key devolve a resposta gravada"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return f(*args, **kwargs)
+        if not _KEY_PATTERN.match(key):
+            return jsonify({'error': f'{IDEMPOTENCY_HEADER} inválido'}), 400
+        
+        purge_expired()
+        
+        record, replay = _reserve(key, request.endpoint, _request_hash())
+        if replay is not None:
+            return replay
+        
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.delete(record)
+            db.session.commit()
+            raise
+        
+        _finish(record, response)
+        return response
+    return decorated_function
@@ -0,0 +1,144 @@
+"""
+Arquivamento de audit_logs e inventory_movements (tabela quente / arquivo frio)
+As tabelas do banco guardam só os últimos LOG_RETENTION_MONTHS meses; cada
+mês mais antigo vira um arquivo ARCHIVE_FOLDER/<tabela>/<tabela>_AAAA-MM.jsonl.gz
+(uma linha JSON por registro) e sai do banco.
+
+Particionamento nativo do MySQL não serve aqui: tabelas particionadas não
+aceitam chaves estrangeiras (as duas referenciam users/medications). O
+corte por mês dá o mesmo efeito - a tabela quente fica com tamanho
+limitado e os índices (tabela, usuário, data) continuam pequenos.
+
+Ordem segura: o arquivo é gravado por completo (.part -> fsync -> nome
+final) antes de apagar; só os ids exportados são apagados.
+"""
+
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime
+
+from sqlalchemy import func, select
+
+from app.database import db
+from app.models import AuditLog, InventoryMovement
+
+# Tabela -> (modelo, coluna de data)
+ARCHIVE_TABLES = {
+    'audit_logs': (AuditLog, AuditLog.created_at),
+    'inventory_movements': (InventoryMovement, InventoryMovement.movement_date)
+}
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def add_months(value, months):
+    """Primeiro dia do mês, months meses depois (negativo: antes)"""
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+class LogArchiver:
+    """Exporta meses antigos para arquivos compactados e apaga do banco"""
+    
+    def __init__(self, folder, batch_size=5000):
+        self.folder = folder
+        self.batch_size = batch_size
+    
+    def months_to_archive(self, table_name, keep_months):
+        """Meses (primeiro dia) com registros mais antigos que o período mantido"""
+        model, date_column = ARCHIVE_TABLES[table_name]
+        cutoff = add_months(month_start(date.today()), -keep_months)
+        oldest = db.session.query(func.min(date_column)).filter(date_column < cutoff).scalar()
+        if oldest is None:
+            return []
+        
+        months = []
+        month = month_start(oldest)
+        while month < cutoff:
+            months.append(month)
+            month = add_months(month, 1)
+        return months
+    
+    def _path(self, table_name, month):
+        """Nome livre para o mês (execução repetida não sobrescreve arquivos)"""
+        folder = os.path.join(self.folder, table_name)
+        os.makedirs(folder, exist_ok=True)
+        base = f'{table_name}_{month:%Y-%m}'
+        path = os.path.join(folder, f'{base}.jsonl.gz')
+        suffix = 2
+        while os.path.exists(path):
+            path = os.path.join(folder, f'{base}_{suffix}.jsonl.gz')
+            suffix += 1
+        return path
+    
+    def _rows(self, table, date_column, start, end):
+        """Registros do mês em ordem de id, em blocos (keyset)"""
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(table).where(
+                    date_column >= start, date_column < end, table.c.id > last_id
+                ).order_by(table.c.id).limit(self.batch_size)
+            ).mappings().all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1]['id']
+    
+    def archive_month(self, table_name, month, dry_run=False):
+        """
+        Arquivar um mês
+        
+        Returns:
+            (registros arquivados, caminho do arquivo ou None)
+        """
+        model, date_column = ARCHIVE_TABLES[table_name]
+        table = model.__table__
+        start, end = month, add_months(month, 1)
+        
+        if dry_run:
+            count = db.session.query(func.count(model.id)).filter(
+                date_column >= start, date_column < end
+            ).scalar()
+            return count, None
+        
+        path = self._path(table_name, month)
+        partial = f'{path}.part'
+        ids = []
+        with open(partial, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as file:
+                for rows in self._rows(table, date_column, start, end):
+                    for row in rows:
+                        file.write(json.dumps(dict(row), default=_json_default, ensure_ascii=False).encode('utf-8'))
+                        file.write(b'\n')
+                        ids.append(row['id'])
+            raw.flush()
+            os.fsync(raw.fileno())
+        db.session.rollback()  # fim da leitura
+        
+        if not ids:
+            os.remove(partial)
+            return 0, None
+        os.replace(partial, path)
+        
+        for start_index in range(0, len(ids), self.batch_size):
+            chunk = ids[start_index:start_index + self.batch_size]
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+            db.session.commit()
+        
+        logging.info(f"{table_name} {month:%Y-%m}: {len(ids)} registro(s) arquivados em {path}")
+        return len(ids), path
+    
+    def archive(self, table_name, keep_months, dry_run=False):
+        """Arquivar todos os meses fora do período mantido; [(mês, registros, arquivo)]"""
+        results = []
+        for month in self.months_to_archive(table_name, keep_months):
+            count, path = self.archive_month(table_name, month, dry_run=dry_run)
+            results.append((month, count, path))
+        return results
@@ -1,13 +1,18 @@
-from app.database import db
+from app.database import db, register_backfill
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
 from decimal import Decimal, ROUND_HALF_UP
-from sqlalchemy import desc, and_
+from sqlalchemy import desc, and_, bindparam, event, false, inspect as sa_inspect
 import enum
 import logging
 import math
 
+from app.cache import invalidate_on_write, publish_on_write
+from app.search_index import (
+    MIN_DIGIT_SUFFIX, normalize_name, name_tokens, token_rows, only_digits, digit_rows
+)
+
 # ✅ IMPORTAÇÕES PARA INTEGRAÇÃO E-SUS
 try:
     from app.esus_integration import (
@@ -17,7 +22,7 @@ try:
     )
 except ImportError:
     # Fallback caso módulo e-SUS não esteja disponível
-    def search_patient_in_esus(query, search_type='all'):
+    def search_patient_in_esus(query, search_type='all', use_cache=True):
         return []
     def clean_cpf(cpf):
         return ''.join(filter(str.isdigit, str(cpf))) if cpf else None
@@ -497,6 +502,7 @@ class Patient(db.Model):
     cpf = db.Column(db.String(11), unique=True, nullable=False, index=True)
     cns = db.Column(db.String(15), unique=True, nullable=True, index=True)  # Cartão Nacional de Saúde
     full_name = db.Column(db.String(100), nullable=False)
+    search_name = db.Column(db.String(100), nullable=True, index=True)  # Nome normalizado (sem acentos, maiúsculo)
     birth_date = db.Column(db.Date, nullable=False)
     gender = db.Column(db.Enum('M', 'F', 'O', 'N', name='gender_enum'), nullable=True)
     
@@ -524,11 +530,12 @@ class Patient(db.Model):
     # ✅ CONTROLE DE ORIGEM DOS DADOS
     source = db.Column(db.Enum('local', 'esus', 'imported', name='source_enum'), default='local')
     esus_sync_date = db.Column(db.DateTime, nullable=True)  # Data da última sincronização com e-SUS
+    esus_hash = db.Column(db.String(64), nullable=True)  # Hash do conteúdo e-SUS na última sincronização
     
     # Metadados
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relacionamentos
     prescriptions = db.relationship('Prescription', backref='patient', lazy=True)
@@ -639,15 +646,16 @@ class Patient(db.Model):
         }
         return gender_map.get(self.gender, 'Não informado')
     
+    SOURCE_LABELS = {
+        'local': 'Cadastro Local',
+        'esus': 'e-SUS',
+        'imported': 'Importado do e-SUS'
+    }
+    
     @property
     def source_display(self):
         """Exibição da origem dos dados"""
-        source_map = {
-            'local': 'Cadastro Local',
-            'esus': 'e-SUS',
-            'imported': 'Importado do e-SUS'
-        }
-        return source_map.get(self.source, 'Desconhecido')
+        return self.SOURCE_LABELS.get(self.source, 'Desconhecido')
     
     # ✅ MÉTODOS DE CONTROLE DE INTERVALOS
     def get_active_medication_controls(self):
@@ -683,62 +691,15 @@ class Patient(db.Model):
         Returns:
             tuple: (local_results, esus_results)
         """
-        local_results = []
-        esus_results = []
-        
-        if not query or not query.strip():
-            return local_results, esus_results
-        
-        # 1. Buscar no banco local primeiro
-        local_results = cls._search_local(query, search_type)
-        
-        # 2. Se não encontrou no local, buscar no e-SUS
-        if not local_results:
-            try:
-                raw_esus_results = search_patient_in_esus(query, search_type)
-                esus_results = [format_esus_data_for_display(data) for data in raw_esus_results]
-                logging.info(f"Busca e-SUS encontrou {len(esus_results)} resultados")
-            except Exception as e:
-                logging.error(f"Erro na busca e-SUS: {e}")
-                esus_results = []
-        
-        return local_results, esus_results
+        from app.patient_search import PatientSearchService
+        return PatientSearchService.search_integrated(query, search_type)
     
     @classmethod
     def _search_local(cls, query, search_type='all'):
         """Buscar pacientes no banco local"""
+        from app.patient_search import PatientSearchService
         try:
-            # Limpar query
-            clean_query = ''.join(filter(str.isalnum, query.lower()))
-            
-            conditions = []
-            
-            if search_type in ['all', 'name']:
-                conditions.append(cls.full_name.like(f'%{query}%'))
-            
-            if search_type in ['all', 'cpf']:
-                conditions.append(cls.cpf.like(f'%{clean_query}%'))
-            
-            if search_type in ['all', 'cns'] and clean_query:
-                conditions.append(cls.cns.like(f'%{clean_query}%'))
-            
-            if search_type in ['all', 'birth_date']:
-                # Tentar parsear data em diferentes formatos
-                try:
-                    # Formato DD/MM/YYYY
-                    if '/' in query:
-                        birth_date = datetime.strptime(query, '%d/%m/%Y').date()
-                        conditions.append(cls.birth_date == birth_date)
-                    # Formato YYYY-MM-DD
-                    elif '-' in query and len(query) == 10:
-                        birth_date = datetime.strptime(query, '%Y-%m-%d').date()
-                        conditions.append(cls.birth_date == birth_date)
-                except ValueError:
-                    pass
-            
-            if conditions:
-                return cls.query.filter(db.or_(*conditions)).all()
-            
+            return PatientSearchService.find_patients(query, search_type)
         except Exception as e:
             logging.error(f"Erro na busca local: {e}")
         
@@ -885,7 +846,7 @@ class Patient(db.Model):
         """Sincronizar dados com e-SUS se disponível"""
         try:
             if self.cpf:
-                esus_data = search_patient_in_esus(self.cpf, 'cpf')
+                esus_data = search_patient_in_esus(self.cpf, 'cpf', use_cache=False)
                 if esus_data:
                     # Atualizar com dados mais recentes do e-SUS
                     updated_data = esus_data[0]  # Pegar primeiro resultado
@@ -910,9 +871,221 @@ class Patient(db.Model):
         
         return False
     
+    # ✅ BUSCA POR NOME (ÍNDICE DE TOKENS NORMALIZADOS)
+    @classmethod
+    def name_filter(cls, term, fields=('name',)):
+        """
+        Filtro de busca por nome usando patient_name_tokens
+        
+        Cada palavra digitada precisa ser prefixo de alguma palavra do nome
+        (sem acentos e sem diferenciar maiúsculas): "joao sil" encontra
+        "JOÃO DA SILVA". Cada palavra vira uma busca por faixa no índice
+        (field, token), em vez de um LIKE '%termo%' na tabela inteira.
+        
+        Args:
+            term: texto digitado
+            fields: campos pesquisados ('name' e/ou 'mother')
+        
+        Returns:
+            cláusula SQLAlchemy (sempre falsa se o termo não tiver palavras)
+        """
+        tokens = name_tokens(term)
+        if not tokens:
+            return false()
+        
+        clauses = []
+        for field in fields:
+            conditions = [
+                cls.id.in_(
+                    db.session.query(PatientNameToken.patient_id).filter(
+                        PatientNameToken.field == field,
+                        PatientNameToken.token.like(f'{token}%')
+                    )
+                )
+                for token in tokens
+            ]
+            clauses.append(and_(*conditions))
+        
+        return db.or_(*clauses) if len(clauses) > 1 else clauses[0]
+    
+    # ✅ BUSCA POR DOCUMENTOS E TELEFONES (ÍNDICE DE SUFIXOS)
+    @classmethod
+    def digits_filter(cls, term, fields=('cpf', 'cns', 'phone')):
+        """
+        Filtro "contém estes dígitos" em CPF, CNS e telefones
+        
+        Usa patient_digit_suffixes: o trecho digitado é prefixo de algum
+        sufixo indexado, então cada busca é uma faixa no índice
+        (field, suffix) em vez de LIKE '%dígitos%' em cinco colunas.
+        Termos com menos de MIN_DIGIT_SUFFIX dígitos usam prefixo nas colunas.
+        
+        Args:
+            term: texto digitado (pontuação é ignorada)
+            fields: campos pesquisados ('cpf', 'cns' e/ou 'phone')
+        
+        Returns:
+            cláusula SQLAlchemy (sempre falsa se o termo não tiver dígitos)
+        """
+        digits = only_digits(term)
+        if not digits:
+            return false()
+        
+        if len(digits) < MIN_DIGIT_SUFFIX:
+            columns = {
+                'cpf': [cls.cpf],
+                'cns': [cls.cns],
+                'phone': [cls.cell_phone, cls.home_phone, cls.contact_phone, cls.phone]
+            }
+            return db.or_(*[
+                column.like(f'{digits}%') for field in fields for column in columns[field]
+            ])
+        
+        return cls.id.in_(
+            db.session.query(PatientDigitSuffix.patient_id).filter(
+                PatientDigitSuffix.field.in_(fields),
+                PatientDigitSuffix.suffix.like(f'{digits}%')
+            )
+        )
+    
+    @classmethod
+    def rebuild_search_index(cls, batch_size=1000):
+        """Recalcular search_name, patient_name_tokens e patient_digit_suffixes de todos os pacientes"""
+        tokens_table = PatientNameToken.__table__
+        suffixes_table = PatientDigitSuffix.__table__
+        total = 0
+        last_id = 0
+        
+        while True:
+            rows = db.session.query(
+                cls.id, cls.full_name, cls.mother_name, cls.cpf, cls.cns,
+                cls.cell_phone, cls.home_phone, cls.contact_phone, cls.phone
+            ).filter(cls.id > last_id).order_by(cls.id).limit(batch_size).all()
+            
+            if not rows:
+                break
+            
+            ids = [row.id for row in rows]
+            db.session.execute(tokens_table.delete().where(tokens_table.c.patient_id.in_(ids)))
+            db.session.execute(suffixes_table.delete().where(suffixes_table.c.patient_id.in_(ids)))
+            
+            db.session.execute(
+                cls.__table__.update().where(cls.__table__.c.id == bindparam('patient_id')).values(
+                    search_name=bindparam('normalized_name')
+                ),
+                [
+                    {'patient_id': row.id, 'normalized_name': normalize_name(row.full_name)[:100] or None}
+                    for row in rows
+                ]
+            )
+            
+            token_values = [
+                {'patient_id': patient_id, 'field': field, 'token': token}
+                for row in rows
+                for patient_id, field, token in token_rows(row.id, row.full_name, row.mother_name)
+            ]
+            if token_values:
+                db.session.execute(tokens_table.insert(), token_values)
+            
+            suffix_values = [
+                {'patient_id': patient_id, 'field': field, 'suffix': suffix}
+                for row in rows
+                for patient_id, field, suffix in digit_rows(
+                    row.id, row.cpf, row.cns,
+                    [row.cell_phone, row.home_phone, row.contact_phone, row.phone]
+                )
+            ]
+            if suffix_values:
+                db.session.execute(suffixes_table.insert(), suffix_values)
+            
+            db.session.commit()
+            total += len(rows)
+            last_id = ids[-1]
+        
+        return total
+    
     def __repr__(self):
         return f'<Patient {self.full_name} - CPF: {self.formatted_cpf}>'
 
+class PatientNameToken(db.Model):
+    """Índice de palavras normalizadas do nome do paciente e da mãe"""
+    __tablename__ = 'patient_name_tokens'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.Enum('name', 'mother', name='name_token_field_enum'), nullable=False)
+    token = db.Column(db.String(50), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_patient_name_tokens_lookup', 'field', 'token', 'patient_id'),
+    )
+    
+    def __repr__(self):
+        return f'<PatientNameToken {self.field}: {self.token}>'
+
+class PatientDigitSuffix(db.Model):
+    """Índice de sufixos de CPF, CNS e telefones do paciente"""
+    __tablename__ = 'patient_digit_suffixes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False, index=True)
+    field = db.Column(db.Enum('cpf', 'cns', 'phone', name='digit_suffix_field_enum'), nullable=False)
+    suffix = db.Column(db.String(15), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_patient_digit_suffixes_lookup', 'suffix', 'field', 'patient_id'),
+    )
+    
+    def __repr__(self):
+        return f'<PatientDigitSuffix {self.field}: {self.suffix}>'
+
+# ✅ MANUTENÇÃO AUTOMÁTICA DOS ÍNDICES DE BUSCA
+PATIENT_DIGIT_ATTRIBUTES = ('cpf', 'cns', 'cell_phone', 'home_phone', 'contact_phone', 'phone')
+
+@event.listens_for(Patient, 'before_insert')
+@event.listens_for(Patient, 'before_update')
+def _patient_set_search_name(mapper, connection, target):
+    """Manter search_name sincronizado com full_name"""
+    target.search_name = normalize_name(target.full_name)[:100] or None
+
+def _write_patient_tokens(connection, target):
+    tokens_table = PatientNameToken.__table__
+    connection.execute(tokens_table.delete().where(tokens_table.c.patient_id == target.id))
+    values = [
+        {'patient_id': patient_id, 'field': field, 'token': token}
+        for patient_id, field, token in token_rows(target.id, target.full_name, target.mother_name)
+    ]
+    if values:
+        connection.execute(tokens_table.insert(), values)
+
+def _write_patient_suffixes(connection, target):
+    suffixes_table = PatientDigitSuffix.__table__
+    connection.execute(suffixes_table.delete().where(suffixes_table.c.patient_id == target.id))
+    values = [
+        {'patient_id': patient_id, 'field': field, 'suffix': suffix}
+        for patient_id, field, suffix in digit_rows(
+            target.id, target.cpf, target.cns,
+            [target.cell_phone, target.home_phone, target.contact_phone, target.phone]
+        )
+    ]
+    if values:
+        connection.execute(suffixes_table.insert(), values)
+
+@event.listens_for(Patient, 'after_insert')
+def _patient_tokens_after_insert(mapper, connection, target):
+    _write_patient_tokens(connection, target)
+    _write_patient_suffixes(connection, target)
+
+@event.listens_for(Patient, 'after_update')
+def _patient_tokens_after_update(mapper, connection, target):
+    state = sa_inspect(target)
+    if state.attrs.full_name.history.has_changes() or state.attrs.mother_name.history.has_changes():
+        _write_patient_tokens(connection, target)
+    if any(getattr(state.attrs, name).history.has_changes() for name in PATIENT_DIGIT_ATTRIBUTES):
+        _write_patient_suffixes(connection, target)
+
+# Banco existente: índice criado pelo upgrade_schema nasce vazio e as buscas não achariam ninguém
+register_backfill(['patients.search_name', 'patient_name_tokens', 'patient_digit_suffixes'], Patient.rebuild_search_index)
+
 # ✅ MODELO DE MEDICAMENTOS COM CONTROLE DE INTERVALOS E CÁLCULOS
 class Medication(db.Model):
     __tablename__ = 'medications'
@@ -940,7 +1113,7 @@ class Medication(db.Model):
     # Metadados
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relacionamentos - CORRIGIDOS
     prescription_items = db.relationship('PrescriptionItem', backref='medication', lazy=True)
@@ -1165,7 +1338,7 @@ class Dispensation(db.Model):
     prescription_id = db.Column(db.Integer, db.ForeignKey('prescriptions.id'), nullable=True)
     dispenser_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
-    dispensation_date = db.Column(db.DateTime, default=datetime.utcnow)
+    dispensation_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     status = db.Column(db.Enum(DispensationStatus), default=DispensationStatus.PENDING)
     observations = db.Column(db.Text, nullable=True)
     total_cost = db.Column(db.DECIMAL(10, 2), nullable=True)
@@ -1173,6 +1346,11 @@ class Dispensation(db.Model):
     # Relacionamentos
     items = db.relationship('DispensationItem', back_populates='dispensation', cascade='all, delete-orphan')
     
+    __table_args__ = (
+        # Histórico do paciente (mais recentes primeiro)
+        db.Index('ix_dispensations_patient_date', 'patient_id', 'dispensation_date'),
+    )
+    
     def __repr__(self):
         return f'<Dispensation {self.id} - {self.patient.full_name}>'
 
@@ -1259,6 +1437,68 @@ class DispensationItem(db.Model):
     def __repr__(self):
         return f'<DispensationItem {self.medication.commercial_name if self.medication else "Unknown"}: {self.quantity_dispensed}>'
 
+# =================== AGREGADOS DIÁRIOS DE DISPENSAÇÃO ===================
+# Mantidos a cada flush pelo app/rollups.py; recalculáveis com scripts/rebuild_rollups.py
+
+class DispensationDailyMedication(db.Model):
+    """Itens dispensados por dia, medicamento e dispensador"""
+    __tablename__ = 'dispensation_daily_medications'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    medication_id = db.Column(db.Integer, db.ForeignKey('medications.id'), nullable=False)
+    dispenser_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    total_cost = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+    items_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'medication_id', 'dispenser_id', name='uq_dispensation_daily_medications'),
+        db.Index('ix_dispensation_daily_medications_medication', 'medication_id', 'day'),
+    )
+    
+    def __repr__(self):
+        return f'<DispensationDailyMedication {self.day} med={self.medication_id}: {self.quantity}>'
+
+class DispensationDailyDispenser(db.Model):
+    """Dispensações por dia e dispensador (concluídas e custo separados)"""
+    __tablename__ = 'dispensation_daily_dispensers'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    dispenser_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    
+    dispensations_count = db.Column(db.Integer, nullable=False, default=0)
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    completed_cost = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'dispenser_id', name='uq_dispensation_daily_dispensers'),
+    )
+    
+    def __repr__(self):
+        return f'<DispensationDailyDispenser {self.day} user={self.dispenser_id}: {self.dispensations_count}>'
+
+class DispensationDailyPatientBucket(db.Model):
+    """Dispensações por dia, faixa etária (na data da dispensação) e gênero"""
+    __tablename__ = 'dispensation_daily_patient_buckets'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    age_bucket = db.Column(db.String(10), nullable=False)
+    gender = db.Column(db.String(1), nullable=False)
+    
+    dispensations_count = db.Column(db.Integer, nullable=False, default=0)
+    total_cost = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'age_bucket', 'gender', name='uq_dispensation_daily_patient_buckets'),
+    )
+    
+    def __repr__(self):
+        return f'<DispensationDailyPatientBucket {self.day} {self.age_bucket}/{self.gender}: {self.dispensations_count}>'
+
 # Processo Alto Custo
 class HighCostProcess(db.Model):
     __tablename__ = 'high_cost_processes'
@@ -1293,6 +1533,11 @@ class HighCostProcess(db.Model):
     approvals = db.relationship('ProcessApproval', backref='process', lazy=True)
     dispensations = db.relationship('HighCostDispensation', backref='process', lazy=True)
     
+    __table_args__ = (
+        # Histórico do paciente (mais recentes primeiro)
+        db.Index('ix_high_cost_processes_patient_date', 'patient_id', 'request_date'),
+    )
+    
     def generate_protocol(self):
         """Gera número de protocolo único"""
         year = datetime.now().year
@@ -1431,6 +1676,11 @@ class InventoryMovement(db.Model):
     
     movement_date = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_inventory_movements_date', 'movement_date'),
+        db.Index('ix_inventory_movements_medication_date', 'medication_id', 'movement_date'),
+    )
+    
     def __repr__(self):
         return f'<InventoryMovement {self.movement_type} - {self.quantity}>'
 
@@ -1453,5 +1703,109 @@ class AuditLog(db.Model):
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Filtros da tela de auditoria, sempre ordenada pela data (arquivamento: por mês)
+    __table_args__ = (
+        db.Index('ix_audit_logs_created', 'created_at'),
+        db.Index('ix_audit_logs_user_created', 'user_id', 'created_at'),
+        db.Index('ix_audit_logs_table_created', 'table_name', 'created_at'),
+        db.Index('ix_audit_logs_table_user_created', 'table_name', 'user_id', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<AuditLog {self.action} - {self.table_name}>'
+
+class ReportJob(db.Model):
+    """Relatório gerado em segundo plano (arquivo em UPLOAD_FOLDER/reports até expirar)"""
+    __tablename__ = 'report_jobs'
+    
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex (também usado na URL de download)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    
+    report_type = db.Column(db.String(50), nullable=False)
+    format_type = db.Column(db.String(10), nullable=False)
+    params = db.Column(db.Text, nullable=True)  # JSON
+    
+    # queued -> running -> done | failed; done/failed -> expired
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)  # 0-100
+    message = db.Column(db.String(200), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    
+    file_path = db.Column(db.String(500), nullable=True)
+    file_name = db.Column(db.String(255), nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    
+    # Relacionamentos
+    user = db.relationship('User')
+    
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed', 'expired')
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'report_type': self.report_type,
+            'format_type': self.format_type,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'error': self.error,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+        }
+    
     def __repr__(self):
-        return f'<AuditLog {self.action} - {self.table_name}>'
\ No newline at end of file
+        return f'<ReportJob {self.id} {self.report_type}/{self.format_type}: {self.status}>'
+
+class IdempotencyKey(db.Model):
+    """Chave Idempotency-Key de um POST e a resposta guardada para as repetições"""
+    __tablename__ = 'idempotency_keys'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)  # sha256 do corpo
+    
+    # processing -> done (respostas de erro apagam a chave)
+    status = db.Column(db.String(20), nullable=False, default='processing')
+    response_status = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(db.Text, nullable=True)
+    response_mimetype = db.Column(db.String(100), nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'endpoint', 'key', name='uq_idempotency_keys'),
+    )
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.endpoint} {self.key}: {self.status}>'
+
+# ✅ INVALIDAÇÃO DOS CACHES DE AUTOCOMPLETE (APÓS O COMMIT)
+invalidate_on_write(Patient, 'patient_search')
+invalidate_on_write(Medication, 'medication_search')
+invalidate_on_write(MedicationDispensing, 'medication_search')
+
+# ✅ EVENTOS DE GRAVAÇÃO (contadores e alertas dos dashboards)
+publish_on_write(Patient, 'patients', columns=('is_active', 'source', 'esus_sync_date', 'created_at'))
+publish_on_write(User, 'users', columns=('is_active',))
+publish_on_write(Medication, 'medications', columns=(
+    'current_stock', 'minimum_stock', 'expiry_date', 'is_active'
+))
+publish_on_write(Medication, 'medication_alerts', columns=(
+    'current_stock', 'minimum_stock', 'expiry_date', 'commercial_name', 'dosage', 'batch_number'
+))
+publish_on_write(Dispensation, 'dispensations', columns=('dispensation_date', 'dispenser_id'))
+publish_on_write(HighCostProcess, 'high_cost', columns=('status',))
@@ -0,0 +1,281 @@
+"""
+Histórico (Timeline) do Paciente
+Itens de dispensação, dispensações sem itens e processos de alto custo em
+uma única consulta UNION ALL. Os filtros (período, tipo, medicamento) e o
+cursor da página entram em cada parte da união, que usa os índices
+(patient_id, data); a ordenação é por (data, origem, id), do mais recente
+para o mais antigo, com paginação por cursor (keyset) em vez de OFFSET.
+
+Nenhum objeto ORM é carregado: sem lazy loads de itens, medicamento e
+dispensador por linha.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import String, and_, cast, func, literal, null, or_, select, union, union_all
+from sqlalchemy.sql import exists
+
+from app.database import db
+from app.models import (
+    Dispensation, DispensationItem, DispensationStatus, HighCostProcess,
+    Medication, ProcessDocument, ProcessStatus, User
+)
+
+HISTORY_PAGE_SIZE = 10
+
+# Origem da linha -> tipo exibido ('dispensation' / 'high_cost')
+SOURCE_TYPES = {
+    'dispensation': 'dispensation',
+    'dispensation_item': 'dispensation',
+    'high_cost': 'high_cost'
+}
+
+NO_ITEMS_LABEL = 'Dispensação registrada'
+MISSING_MEDICATION = 'Medicamento não encontrado'
+
+def encode_cursor(row):
+    """Posição da última linha da página: 'data ISO|origem|id'"""
+    return f'{row.event_date.isoformat()}|{row.source}|{row.row_id}'
+
+def decode_cursor(value):
+    """(data, origem, id) ou None para cursor ausente/inválido"""
+    try:
+        event_date, source, row_id = value.split('|')
+        if source not in SOURCE_TYPES:
+            return None
+        return datetime.fromisoformat(event_date), source, int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _status_value(enum_class, name):
+    """Enum gravado pelo nome (ex.: 'COMPLETED') -> valor ('completed')"""
+    if name in enum_class.__members__:
+        return enum_class[name].value
+    return name.lower() if name else name
+
+class HistoryPage:
+    """Página do histórico (iterável, como a paginação do Flask-SQLAlchemy)"""
+    
+    def __init__(self, items, cursor, next_cursor, per_page, total):
+        self.items = items
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.per_page = per_page
+        self.total = total
+        self.has_prev = cursor is not None
+        self.has_next = next_cursor is not None
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+
+class PatientHistoryService:
+    """Timeline e estatísticas do histórico de um paciente"""
+    
+    @staticmethod
+    def _before(date_column, id_column, source, position):
+        """
+        Condição do cursor para uma parte da união (origem fixa)
+        
+        (data, origem, id) < (d, o, i) com a origem já conhecida.
+        """
+        event_date, cursor_source, row_id = position
+        if source < cursor_source:
+            return date_column <= event_date
+        if source > cursor_source:
+            return date_column < event_date
+        return or_(date_column < event_date, and_(date_column == event_date, id_column < row_id))
+    
+    @classmethod
+    def _parts(cls, patient_id, since=None, type_filter=None, medication_filter=None, position=None):
+        """SELECTs da união, já filtrados"""
+        parts = []
+        pattern = f'%{medication_filter}%' if medication_filter else None
+        
+        if type_filter in (None, '', 'dispensation'):
+            # Um registro por item dispensado
+            items = select(
+                literal('dispensation_item', String(20)).label('source'),
+                Dispensation.dispensation_date.label('event_date'),
+                DispensationItem.id.label('row_id'),
+                func.coalesce(Medication.commercial_name, MISSING_MEDICATION).label('medication_name'),
+                DispensationItem.quantity_dispensed.label('quantity'),
+                func.coalesce(User.full_name, 'N/A').label('dispenser_name'),
+                func.coalesce(DispensationItem.observations, Dispensation.observations).label('notes'),
+                cast(Dispensation.status, String(20)).label('status'),
+                null().label('protocol_number'),
+                null().label('doctor_name'),
+                null().label('cid_code'),
+                literal(0).label('attachments_count')
+            ).select_from(DispensationItem).join(
+                Dispensation, Dispensation.id == DispensationItem.dispensation_id
+            ).outerjoin(
+                Medication, Medication.id == DispensationItem.medication_id
+            ).outerjoin(
+                User, User.id == Dispensation.dispenser_id
+            ).where(Dispensation.patient_id == patient_id)
+            
+            if since:
+                items = items.where(Dispensation.dispensation_date >= since)
+            if pattern:
+                items = items.where(Medication.commercial_name.ilike(pattern))
+            if position:
+                items = items.where(cls._before(
+                    Dispensation.dispensation_date, DispensationItem.id, 'dispensation_item', position
+                ))
+            parts.append(items)
+            
+            # Dispensações sem itens: uma entrada genérica
+            if not medication_filter or medication_filter.lower() in NO_ITEMS_LABEL.lower():
+                no_items = select(
+                    literal('dispensation', String(20)).label('source'),
+                    Dispensation.dispensation_date.label('event_date'),
+                    Dispensation.id.label('row_id'),
+                    literal(NO_ITEMS_LABEL, String(100)).label('medication_name'),
+                    literal(1).label('quantity'),
+                    func.coalesce(User.full_name, 'N/A').label('dispenser_name'),
+                    Dispensation.observations.label('notes'),
+                    cast(Dispensation.status, String(20)).label('status'),
+                    null().label('protocol_number'),
+                    null().label('doctor_name'),
+                    null().label('cid_code'),
+                    literal(0).label('attachments_count')
+                ).select_from(Dispensation).outerjoin(
+                    User, User.id == Dispensation.dispenser_id
+                ).where(
+                    Dispensation.patient_id == patient_id,
+                    ~exists().where(DispensationItem.dispensation_id == Dispensation.id)
+                )
+                
+                if since:
+                    no_items = no_items.where(Dispensation.dispensation_date >= since)
+                if position:
+                    no_items = no_items.where(cls._before(
+                        Dispensation.dispensation_date, Dispensation.id, 'dispensation', position
+                    ))
+                parts.append(no_items)
+        
+        if type_filter in (None, '', 'high_cost'):
+            documents = select(func.count(ProcessDocument.id)).where(
+                ProcessDocument.process_id == HighCostProcess.id
+            ).correlate(HighCostProcess).scalar_subquery()
+            
+            processes = select(
+                literal('high_cost', String(20)).label('source'),
+                HighCostProcess.request_date.label('event_date'),
+                HighCostProcess.id.label('row_id'),
+                func.coalesce(Medication.commercial_name, MISSING_MEDICATION).label('medication_name'),
+                null().label('quantity'),
+                null().label('dispenser_name'),
+                null().label('notes'),
+                cast(HighCostProcess.status, String(20)).label('status'),
+                HighCostProcess.protocol_number.label('protocol_number'),
+                HighCostProcess.doctor_name.label('doctor_name'),
+                HighCostProcess.cid10.label('cid_code'),
+                documents.label('attachments_count')
+            ).select_from(HighCostProcess).outerjoin(
+                Medication, Medication.id == HighCostProcess.medication_id
+            ).where(HighCostProcess.patient_id == patient_id)
+            
+            if since:
+                processes = processes.where(HighCostProcess.request_date >= since)
+            if pattern:
+                processes = processes.where(Medication.commercial_name.ilike(pattern))
+            if position:
+                processes = processes.where(cls._before(
+                    HighCostProcess.request_date, HighCostProcess.id, 'high_cost', position
+                ))
+            parts.append(processes)
+        
+        return parts
+    
+    @staticmethod
+    def _to_item(row):
+        """Linha da união -> dicionário usado pelo template"""
+        item_type = SOURCE_TYPES[row.source]
+        if item_type == 'high_cost':
+            return {
+                'type': 'high_cost',
+                'date': row.event_date,
+                'medication_name': row.medication_name,
+                'protocol_number': row.protocol_number,
+                'status': _status_value(ProcessStatus, row.status),
+                'prescribing_doctor': row.doctor_name,
+                'cid_code': row.cid_code,
+                'quantity_approved': None,
+                'attachments_count': row.attachments_count or 0
+            }
+        return {
+            'type': 'dispensation',
+            'date': row.event_date,
+            'medication_name': row.medication_name,
+            'quantity': row.quantity,
+            'pharmacist_name': row.dispenser_name,
+            'prescription_number': None,
+            'notes': row.notes,
+            'status': _status_value(DispensationStatus, row.status),
+            'attachments_count': 0
+        }
+    
+    @classmethod
+    def count(cls, patient_id, since=None, type_filter=None, medication_filter=None):
+        """Registros da timeline com os filtros (sem filtros: o total)"""
+        parts = cls._parts(patient_id, since, type_filter, medication_filter)
+        if not parts:
+            return 0
+        timeline = union_all(*parts).subquery('timeline')
+        return db.session.scalar(select(func.count()).select_from(timeline)) or 0
+    
+    @classmethod
+    def page(cls, patient_id, cursor=None, per_page=HISTORY_PAGE_SIZE,
+             since=None, type_filter=None, medication_filter=None):
+        """Página que começa depois do cursor (None: a mais recente)"""
+        position = decode_cursor(cursor) if cursor else None
+        parts = cls._parts(patient_id, since, type_filter, medication_filter, position)
+        total = cls.count(patient_id, since, type_filter, medication_filter)
+        if not parts:
+            return HistoryPage([], None, None, per_page, total)
+        
+        timeline = union_all(*parts).subquery('timeline')
+        rows = db.session.execute(
+            select(timeline).order_by(
+                timeline.c.event_date.desc(), timeline.c.source.desc(), timeline.c.row_id.desc()
+            ).limit(per_page + 1)
+        ).all()
+        
+        next_cursor = encode_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+        items = [cls._to_item(row) for row in rows[:per_page]]
+        return HistoryPage(items, cursor if position else None, next_cursor, per_page, total)
+    
+    @classmethod
+    def stats(cls, patient_id):
+        """Dispensações, processos, medicamentos diferentes e última dispensação em uma consulta"""
+        medications = union(
+            select(DispensationItem.medication_id).join(
+                Dispensation, Dispensation.id == DispensationItem.dispensation_id
+            ).where(Dispensation.patient_id == patient_id),
+            select(HighCostProcess.medication_id).where(HighCostProcess.patient_id == patient_id)
+        ).subquery('medications')
+        
+        row = db.session.execute(select(
+            select(func.count(Dispensation.id)).where(
+                Dispensation.patient_id == patient_id
+            ).scalar_subquery().label('total_dispensations'),
+            select(func.count(HighCostProcess.id)).where(
+                HighCostProcess.patient_id == patient_id
+            ).scalar_subquery().label('total_high_cost'),
+            select(func.count()).select_from(medications).scalar_subquery().label('unique_medications'),
+            select(func.max(Dispensation.dispensation_date)).where(
+                Dispensation.patient_id == patient_id
+            ).scalar_subquery().label('last_dispensation_date')
+        )).one()
+        return dict(row._mapping)
+
+def period_start(period):
+    """'30', '90', ... (dias) -> datetime inicial; vazio/inválido -> None"""
+    try:
+        return datetime.now() - timedelta(days=int(period)) if period else None
+    except (ValueError, TypeError):
+        return None
@@ -0,0 +1,273 @@
+"""
+Serviço Unificado de Busca de Pacientes
+Classifica o termo digitado, escolhe o plano indexado mais barato e
+ordena os resultados (correspondências exatas primeiro)
+
+Usado por todas as rotas de busca de pacientes (listas, DataTables,
+autocomplete, dispensação) e por Patient.search_integrated.
+"""
+
+import re
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import case, false
+
+from app.database import db
+from app.models import Patient
+from app.search_index import normalize_name, only_digits
+from app.utils import calculate_age
+from app.esus_integration import search_patient_in_esus, format_esus_data_for_display
+
+# Termo classificado: kind em 'cpf', 'cns', 'birth_date', 'digits', 'email', 'name'
+SearchPlan = namedtuple('SearchPlan', ['kind', 'value'])
+
+# Colunas devolvidas pelas buscas leves (autocomplete e dispensação)
+ROW_COLUMNS = (
+    Patient.id, Patient.full_name, Patient.cpf, Patient.cns, Patient.birth_date,
+    Patient.mother_name, Patient.cell_phone, Patient.home_phone, Patient.contact_phone,
+    Patient.phone, Patient.email, Patient.source, Patient.is_active
+)
+
+# Tipo de busca da tela -> tipo de busca do e-SUS
+ESUS_SEARCH_TYPES = {
+    'cpf': 'cpf',
+    'cns': 'cns',
+    'birth_date': 'birth_date',
+    'name': 'name',
+    'digits': 'all'
+}
+
+_DOCUMENT_CHARS = re.compile(r'^[0-9.\-/() ]+$')
+_DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+
+class PatientSearchService:
+    """
+    Busca de pacientes em um único lugar
+    
+    search_type aceita 'auto' (ou 'all') - classificação automática - ou um
+    campo explícito da tela: 'name', 'mother', 'cpf', 'cns', 'phone',
+    'email' e 'birth_date'.
+    """
+    
+    # =================== CLASSIFICAÇÃO ===================
+    
+    @staticmethod
+    def classify(term):
+        """
+        Classificar o termo digitado
+        
+        '123.456.789-09' -> cpf, 15 dígitos -> cns, '01/02/1980' -> birth_date,
+        outros números -> digits (trecho de documento/telefone), '@' -> email,
+        resto -> name
+        """
+        term = (term or '').strip()
+        
+        for date_format in _DATE_FORMATS:
+            try:
+                return SearchPlan('birth_date', datetime.strptime(term, date_format).date())
+            except ValueError:
+                pass
+        
+        if _DOCUMENT_CHARS.match(term):
+            digits = only_digits(term)
+            if len(digits) == 11:
+                return SearchPlan('cpf', digits)
+            if len(digits) == 15:
+                return SearchPlan('cns', digits)
+            if digits:
+                return SearchPlan('digits', digits)
+        
+        if '@' in term:
+            return SearchPlan('email', term)
+        
+        return SearchPlan('name', term)
+    
+    @classmethod
+    def cache_key(cls, term, search_type='auto', limit=10):
+        """
+        Chave de cache: termos que produzem a mesma busca têm a mesma chave
+        ('João', 'joao ' e 'JOAO' -> ('name', 'JOAO'))
+        """
+        plan = cls.classify(term) if search_type in ('auto', 'all') else SearchPlan(search_type, term)
+        if plan.kind in ('name', 'mother'):
+            value = normalize_name(plan.value)
+        elif plan.kind in ('cpf', 'cns', 'phone', 'digits'):
+            value = only_digits(plan.value)
+        elif plan.kind == 'birth_date':
+            value = plan.value
+        else:
+            value = (plan.value or '').strip().lower()
+        return (plan.kind, value, search_type, limit)
+    
+    # =================== FILTROS ===================
+    
+    @classmethod
+    def filter_clause(cls, term, search_type='auto'):
+        """
+        Cláusula WHERE para o termo (para listas paginadas)
+        
+        Documentos exatos usam digits_filter: o documento completo também é
+        um sufixo indexado, e um celular de 11 dígitos continua sendo achado.
+        """
+        if search_type == 'name':
+            return Patient.name_filter(term)
+        if search_type == 'mother':
+            return Patient.name_filter(term, fields=('mother',))
+        if search_type in ('cpf', 'cns', 'phone'):
+            return Patient.digits_filter(term, fields=(search_type,))
+        if search_type == 'email':
+            return Patient.email.ilike(f'%{term.strip()}%')
+        if search_type == 'birth_date':
+            plan = cls.classify(term)
+            return Patient.birth_date == plan.value if plan.kind == 'birth_date' else false()
+        
+        return cls._plan_clause(cls.classify(term))
+    
+    @staticmethod
+    def _plan_clause(plan):
+        if plan.kind in ('cpf', 'cns', 'digits'):
+            return Patient.digits_filter(plan.value)
+        if plan.kind == 'birth_date':
+            return Patient.birth_date == plan.value
+        if plan.kind == 'email':
+            return Patient.email.ilike(f'%{plan.value}%')
+        return Patient.name_filter(plan.value, fields=('name', 'mother'))
+    
+    @classmethod
+    def rank_order(cls, term, search_type='auto'):
+        """
+        Ordenação por relevância: exato, depois prefixo, depois o resto
+        (desempate por nome)
+        """
+        if search_type in ('auto', 'all', 'name', 'mother'):
+            plan = cls.classify(term) if search_type in ('auto', 'all') else SearchPlan('name', term)
+        elif search_type in ('cpf', 'cns', 'phone'):
+            plan = SearchPlan('digits', only_digits(term))
+        else:
+            plan = SearchPlan(search_type, term)
+        
+        if plan.kind == 'name' and search_type != 'mother':
+            normalized = normalize_name(plan.value)
+            rank = case(
+                (Patient.search_name == normalized, 0),
+                (Patient.search_name.like(f'{normalized}%'), 1),
+                else_=2
+            )
+            return [rank, Patient.full_name]
+        
+        if plan.kind in ('cpf', 'cns', 'digits') and plan.value:
+            rank = case(
+                (Patient.cpf == plan.value, 0),
+                (Patient.cns == plan.value, 0),
+                (Patient.cpf.like(f'{plan.value}%'), 1),
+                (Patient.cns.like(f'{plan.value}%'), 1),
+                else_=2
+            )
+            return [rank, Patient.full_name]
+        
+        return [Patient.full_name]
+    
+    # =================== BUSCAS ===================
+    
+    @classmethod
+    def search(cls, term, search_type='auto', limit=10, active_only=True):
+        """
+        Busca leve para autocomplete/dispensação
+        
+        Returns:
+            list de Row (id, full_name, cpf, cns, birth_date, mother_name,
+            telefones, email, source, is_active) - sem carregar objetos ORM
+        """
+        term = (term or '').strip()
+        if not term:
+            return []
+        
+        query = db.session.query(*ROW_COLUMNS)
+        if active_only:
+            query = query.filter(Patient.is_active == True)
+        
+        # CPF/CNS completo: busca exata pelo índice único primeiro
+        if search_type in ('auto', 'all'):
+            plan = cls.classify(term)
+            if plan.kind in ('cpf', 'cns'):
+                column = Patient.cpf if plan.kind == 'cpf' else Patient.cns
+                rows = query.filter(column == plan.value).limit(limit).all()
+                if rows:
+                    return rows
+        
+        return query.filter(cls.filter_clause(term, search_type)).order_by(
+            *cls.rank_order(term, search_type)
+        ).limit(limit).all()
+    
+    @classmethod
+    def find_patients(cls, term, search_type='auto', limit=None, active_only=False):
+        """Mesma busca de search(), devolvendo objetos Patient (para templates)"""
+        term = (term or '').strip()
+        if not term:
+            return []
+        
+        query = Patient.query.filter(cls.filter_clause(term, search_type))
+        if active_only:
+            query = query.filter(Patient.is_active == True)
+        query = query.order_by(*cls.rank_order(term, search_type))
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+    
+    @classmethod
+    def search_esus(cls, term, search_type='auto'):
+        """Busca no e-SUS já formatada para exibição"""
+        if search_type in ('auto', 'all'):
+            esus_type = ESUS_SEARCH_TYPES.get(cls.classify(term).kind, 'all')
+        else:
+            esus_type = search_type
+        
+        raw_results = search_patient_in_esus(term.strip(), esus_type)
+        results = [format_esus_data_for_display(data) for data in raw_results]
+        return [result for result in results if result]
+    
+    @classmethod
+    def search_integrated(cls, term, search_type='auto', limit=None):
+        """
+        Busca integrada: primeiro local, depois e-SUS (só se nada for achado)
+        
+        Returns:
+            tuple: (objetos Patient locais, resultados e-SUS formatados)
+        """
+        local_results = []
+        esus_results = []
+        
+        if not term or not term.strip():
+            return local_results, esus_results
+        
+        try:
+            local_results = cls.find_patients(term, search_type, limit=limit)
+        except Exception as e:
+            logging.error(f"Erro na busca local: {e}")
+        
+        if not local_results:
+            try:
+                esus_results = cls.search_esus(term, search_type)
+                logging.info(f"Busca e-SUS encontrou {len(esus_results)} resultados")
+            except Exception as e:
+                logging.error(f"Erro na busca e-SUS: {e}")
+                esus_results = []
+        
+        return local_results, esus_results
+    
+    # =================== FORMATAÇÃO ===================
+    
+    @staticmethod
+    def primary_phone(row):
+        """Telefone principal (celular > residencial > contato > phone)"""
+        return row.cell_phone or row.home_phone or row.contact_phone or row.phone
+    
+    @staticmethod
+    def age(row):
+        return calculate_age(row.birth_date)
+    
+    @staticmethod
+    def source_display(row):
+        return Patient.SOURCE_LABELS.get(row.source, 'Desconhecido')
@@ -0,0 +1,150 @@
+"""
+Estatísticas Agregadas de Pacientes
+Gênero, faixas etárias, cadastros por mês, cidades/estados e completude
+calculados no banco (GROUP BY e SUM(CASE ...)) em vez de carregar todos
+os pacientes ativos como objetos ORM.
+
+Memória proporcional ao número de grupos, não ao de pacientes.
+"""
+
+from datetime import date, datetime
+
+from sqlalchemy import case, func, extract
+
+from app.database import db
+from app.models import Patient
+from app.dashboard_stats import count_if
+
+# Faixas etárias dos gráficos: (rótulo, idade máxima ou None)
+AGE_BUCKETS = (
+    ('0-18', 18),
+    ('19-30', 30),
+    ('31-50', 50),
+    ('51-65', 65),
+    ('65+', None)
+)
+
+GENDER_LABELS = (
+    ('M', 'Masculino'),
+    ('F', 'Feminino'),
+    ('O', 'Outro'),
+    ('N', 'Não informar')
+)
+
+def years_before(day, years):
+    """Mesma data 'years' anos antes (29/02 vira 28/02 em ano não bissexto)"""
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        return day.replace(year=day.year - years, day=28)
+
+def _filled(column):
+    """Campo texto preenchido (não nulo e não só espaços)"""
+    return column.isnot(None) & (func.trim(column) != '')
+
+class PatientStatsService:
+    """Agregações dos pacientes ativos usadas pelas APIs de gráficos"""
+    
+    @staticmethod
+    def age_bucket_expression(today=None):
+        """
+        CASE sobre birth_date com os limites já calculados em Python
+        
+        idade <= N  <=>  birth_date > (hoje - (N + 1) anos)
+        """
+        today = today or date.today()
+        whens = [
+            (Patient.birth_date > years_before(today, max_age + 1), label)
+            for label, max_age in AGE_BUCKETS if max_age is not None
+        ]
+        return case(*whens, else_=AGE_BUCKETS[-1][0])
+    
+    @classmethod
+    def gender_counts(cls):
+        """{'M': n, 'F': n, 'O': n, 'N': n} - gênero nulo conta como 'N'"""
+        gender = func.coalesce(Patient.gender, 'N')
+        rows = db.session.query(gender, func.count(Patient.id)).filter(
+            Patient.is_active == True
+        ).group_by(gender).all()
+        
+        counts = {code: 0 for code, _ in GENDER_LABELS}
+        for code, count in rows:
+            counts[code] = counts.get(code, 0) + count
+        return counts
+    
+    @classmethod
+    def age_counts(cls, today=None):
+        """{'0-18': n, '19-30': n, ...} em uma consulta"""
+        bucket = cls.age_bucket_expression(today).label('bucket')
+        rows = db.session.query(bucket, func.count(Patient.id)).filter(
+            Patient.is_active == True
+        ).group_by(bucket).all()
+        
+        counts = {label: 0 for label, _ in AGE_BUCKETS}
+        counts.update({label: count for label, count in rows})
+        return counts
+    
+    @classmethod
+    def monthly_registrations(cls, months=6, now=None):
+        """
+        Cadastros de pacientes ativos nos últimos meses (mês atual incluído)
+        
+        Returns:
+            list de (datetime do início do mês, quantidade), do mais antigo ao atual
+        """
+        now = now or datetime.now()
+        month_starts = []
+        year, month = now.year, now.month
+        for _ in range(months):
+            month_starts.insert(0, datetime(year, month, 1))
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+        
+        year_col = extract('year', Patient.created_at)
+        month_col = extract('month', Patient.created_at)
+        rows = db.session.query(year_col, month_col, func.count(Patient.id)).filter(
+            Patient.is_active == True,
+            Patient.created_at >= month_starts[0],
+            Patient.created_at <= now
+        ).group_by(year_col, month_col).all()
+        
+        by_month = {(int(row_year), int(row_month)): count for row_year, row_month, count in rows}
+        return [(start, by_month.get((start.year, start.month), 0)) for start in month_starts]
+    
+    @classmethod
+    def top_values(cls, column, limit=10):
+        """[(valor, quantidade)] mais frequentes da coluna (nulos/vazios fora)"""
+        count = func.count(Patient.id)
+        return db.session.query(column, count).filter(
+            Patient.is_active == True,
+            _filled(column)
+        ).group_by(column).order_by(count.desc()).limit(limit).all()
+    
+    @classmethod
+    def completeness(cls, thirty_days_ago):
+        """
+        Contadores de preenchimento em uma consulta
+        
+        completeness_points soma, por paciente, os 6 campos principais
+        preenchidos (nome, CPF, nascimento, gênero, telefone, endereço).
+        """
+        has_phone = (
+            _filled(Patient.cell_phone) | _filled(Patient.home_phone) |
+            _filled(Patient.contact_phone) | _filled(Patient.phone)
+        )
+        points = (
+            count_if(_filled(Patient.full_name)) +
+            count_if(_filled(Patient.cpf)) +
+            count_if(Patient.birth_date.isnot(None)) +
+            count_if(Patient.gender.isnot(None)) +
+            count_if(has_phone) +
+            count_if(_filled(Patient.address))
+        )
+        row = db.session.query(
+            func.count(Patient.id).label('total'),
+            count_if(Patient.created_at >= thirty_days_ago).label('new_30'),
+            count_if(_filled(Patient.cns)).label('with_cns'),
+            count_if(has_phone | _filled(Patient.email)).label('with_contact'),
+            count_if(_filled(Patient.address)).label('with_address'),
+            points.label('completeness_points')
+        ).filter(Patient.is_active == True).one()
+        return {key: int(value or 0) for key, value in row._mapping.items()}
@@ -0,0 +1,239 @@
+"""
+Renderização de PDF (ReportLab) em Processos
+Os relatórios descrevem o PDF com PdfDocument (só textos, números e nomes
+de cores - serializável) e o doc.build roda em um ProcessPoolExecutor
+(PDF_RENDER_WORKERS), fora do GIL das threads do Waitress.
+
+Tabelas grandes são quebradas em blocos de TABLE_CHUNK_ROWS linhas: o
+ReportLab mede e posiciona cada bloco por página em vez de medir e dividir
+de novo a tabela inteira a cada quebra de página.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from flask import send_file
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
+# Linhas por bloco de tabela (~ uma página A4 com fonte 8)
+TABLE_CHUNK_ROWS = 40
+
+# Padrões do TableStyle do ReportLab (fonte 10, padding 6 de cada lado)
+DEFAULT_FONT_SIZE = 10
+CELL_PADDING = 12
+
+class PdfDocument:
+    """Descrição do PDF em blocos simples (enviada ao processo de renderização)"""
+    
+    def __init__(self):
+        self.blocks = []
+    
+    def title(self, text):
+        self.blocks.append(('paragraph', text, 'Title'))
+    
+    def centered_title(self, text):
+        """Título centralizado (Heading1, 18pt) dos relatórios de alto custo/financeiro"""
+        self.blocks.append(('paragraph', text, 'CustomTitle'))
+    
+    def paragraph(self, text, style='Normal'):
+        self.blocks.append(('paragraph', text, style))
+    
+    def spacer(self, height=12):
+        self.blocks.append(('spacer', height))
+    
+    def table(self, rows, header='grey', header_text='whitesmoke', align='CENTER',
+              header_size=None, header_padding=None, body=None, body_size=None):
+        """
+        Tabela com a primeira linha como cabeçalho
+        
+        Cores pelo nome em reportlab.lib.colors (ex.: 'grey', 'lightblue')
+        """
+        style = {
+            'header': header, 'header_text': header_text, 'align': align,
+            'header_size': header_size, 'header_padding': header_padding,
+            'body': body, 'body_size': body_size
+        }
+        self.blocks.append(('table', [[str(value) for value in row] for row in rows], style))
+
+# =================== RENDERIZAÇÃO (processo filho) ===================
+
+def _paragraph_styles():
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=18,
+        spaceAfter=30,
+        alignment=1  # Center
+    ))
+    return styles
+
+def _table_style(style, with_header=True):
+    """Comandos do TableStyle; sem cabeçalho, o estilo do corpo vale desde a linha 0"""
+    body_start = 1 if with_header else 0
+    commands = []
+    if with_header:
+        commands += [
+            ('BACKGROUND', (0, 0), (-1, 0), getattr(colors, style['header'])),
+            ('TEXTCOLOR', (0, 0), (-1, 0), getattr(colors, style['header_text'])),
+            ('ALIGN', (0, 0), (-1, -1), style['align']),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold')
+        ]
+        if style['header_size']:
+            commands.append(('FONTSIZE', (0, 0), (-1, 0), style['header_size']))
+        if style['header_padding']:
+            commands.append(('BOTTOMPADDING', (0, 0), (-1, 0), style['header_padding']))
+    else:
+        commands.append(('ALIGN', (0, 0), (-1, -1), style['align']))
+    if style['body']:
+        commands.append(('BACKGROUND', (0, body_start), (-1, -1), getattr(colors, style['body'])))
+    commands.append(('GRID', (0, 0), (-1, -1), 1, colors.black))
+    if style['body_size']:
+        commands.append(('FONTSIZE', (0, body_start), (-1, -1), style['body_size']))
+    return TableStyle(commands)
+
+def _column_widths(rows, style):
+    """Larguras medidas uma vez para todos os blocos ficarem alinhados"""
+    header_size = style['header_size'] or DEFAULT_FONT_SIZE
+    body_size = style['body_size'] or DEFAULT_FONT_SIZE
+    widths = [stringWidth(value, 'Helvetica-Bold', header_size) for value in rows[0]]
+    for row in rows[1:]:
+        for index, value in enumerate(row):
+            widths[index] = max(widths[index], stringWidth(value, 'Helvetica', body_size))
+    return [width + CELL_PADDING for width in widths]
+
+def _tables(rows, style):
+    """
+    Tabela em blocos de TABLE_CHUNK_ROWS linhas (só o primeiro com cabeçalho)
+    
+    Os blocos ficam colados e com a mesma grade: visualmente uma tabela só.
+    """
+    header, body = rows[0], rows[1:]
+    chunks = [body[start:start + TABLE_CHUNK_ROWS] for start in range(0, len(body), TABLE_CHUNK_ROWS)]
+    if len(chunks) <= 1:
+        table = Table(rows)
+        table.setStyle(_table_style(style))
+        return [table]
+    
+    widths = _column_widths(rows, style)
+    first = Table([header] + chunks[0], colWidths=widths)
+    first.setStyle(_table_style(style))
+    tables = [first]
+    
+    body_style = _table_style(style, with_header=False)
+    for chunk in chunks[1:]:
+        table = Table(chunk, colWidths=widths)
+        table.setStyle(body_style)
+        tables.append(table)
+    return tables
+
+def render_blocks(blocks):
+    """Blocos de PdfDocument -> bytes do PDF (roda no processo de renderização)"""
+    styles = _paragraph_styles()
+    story = []
+    for block in blocks:
+        kind = block[0]
+        if kind == 'paragraph':
+            story.append(Paragraph(block[1], styles[block[2]]))
+        elif kind == 'spacer':
+            story.append(Spacer(1, block[1]))
+        elif kind == 'table':
+            story.extend(_tables(block[1], block[2]))
+    
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc.build(story)
+    return buffer.getvalue()
+
+# =================== POOL DE PROCESSOS ===================
+
+class PdfRenderTimeout(RuntimeError):
+    """PDF não ficou pronto em PDF_RENDER_TIMEOUT segundos"""
+
+class PdfRenderer:
+    """Envia os documentos ao pool; PDF_RENDER_WORKERS=0 renderiza na própria thread"""
+    
+    def __init__(self, workers=2, timeout=120):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def init_app(self, app):
+        self.workers = app.config.get('PDF_RENDER_WORKERS', self.workers)
+        self.timeout = app.config.get('PDF_RENDER_TIMEOUT', self.timeout)
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: não herdar locks/conexões do processo multi-thread do servidor
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+    
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+    
+    def _recycle(self, executor):
+        """
+        Pool novo para os próximos PDFs; o antigo termina o que já recebeu
+        (inclusive a renderização presa) e encerra os processos
+        """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+    
+    def render(self, document):
+        """Bytes do PDF (PdfRenderTimeout se passar de PDF_RENDER_TIMEOUT)"""
+        if self.workers <= 0:
+            return render_blocks(document.blocks)
+        
+        executor = self._get_executor()
+        try:
+            future = executor.submit(render_blocks, document.blocks)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # Já em execução: não dá para interromper, só tirar o processo do caminho
+                logging.warning(f"Renderização de PDF passou de {self.timeout}s - pool recriado")
+                self._recycle(executor)
+            raise PdfRenderTimeout(
+                f"Relatório grande demais para gerar em PDF agora (mais de {self.timeout}s). "
+                "Reduza o período ou tente novamente em alguns minutos."
+            )
+        except BrokenProcessPool as e:
+            # Processo de renderização morreu: recriar o pool na próxima vez e renderizar aqui
+            logging.error(f"Pool de renderização de PDF quebrado: {e}")
+            self.shutdown()
+            return render_blocks(document.blocks)
+
+# Instância global do renderizador
+pdf_renderer = PdfRenderer()
+atexit.register(pdf_renderer.shutdown)
+
+def init_pdf_renderer(app):
+    """Configurar o pool (os processos só sobem no primeiro PDF)"""
+    pdf_renderer.init_app(app)
+
+def pdf_response(document, filename):
+    """Renderizar no pool e devolver como download"""
+    return send_file(
+        BytesIO(pdf_renderer.render(document)),
+        as_attachment=True,
+        download_name=filename,
+        mimetype='application/pdf'
+    )
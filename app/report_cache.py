@@ -0,0 +1,139 @@
+"""
+Cache de Relatórios Prontos (PDF/Excel)
+Chave: (tipo, parâmetros normalizados, formato, versão dos dados). A versão
+junta, para cada tabela de origem do relatório:
+
+- MAX(id) e MAX(updated_at) lidos no banco (pega gravações de outros
+  processos; o script de sincronização e-SUS grava updated_at no upsert)
+- um contador de gravações locais, incrementado após o commit (pega
+  UPDATEs em tabelas sem updated_at, como a mudança de status)
+
+Pedido igual com os dados inalterados devolve os bytes já gerados; qualquer
+gravação muda a versão e a entrada antiga simplesmente deixa de ser usada
+(sai pelo LRU/TTL).
+"""
+
+import logging
+import threading
+from datetime import date
+
+from flask import Response
+from sqlalchemy import func
+
+from app.cache import register_cache, publish_on_write, subscribe, MISSING
+from app.database import db
+from app.models import Medication, Dispensation, DispensationItem, HighCostProcess, Patient, User
+
+# Tabelas lidas por cada relatório
+REPORT_SOURCES = {
+    'stock': (Medication,),
+    'expiry': (Medication,),
+    'consumption': (Medication, Dispensation, DispensationItem),
+    'financial': (Medication, Dispensation, DispensationItem),
+    'high_cost': (HighCostProcess, Patient, Medication),
+    'dispensations': (Dispensation, DispensationItem, Patient, User),
+    'patients': (Patient,),
+    'esus_integration': (Patient,)
+}
+
+# Relatórios prontos (chave: (tipo, parâmetros, formato, versão))
+report_result_cache = register_cache('report_results', maxsize=32, ttl=12 * 3600)
+
+# Arquivos maiores que isso não ficam em memória
+_max_bytes = 5 * 1024 * 1024
+
+# =================== GRAVAÇÕES LOCAIS ===================
+
+_write_lock = threading.Lock()
+_write_generations = {}
+
+def report_source_topic(model):
+    """Tópico das gravações na tabela (publicar com publish() em SQL direto)"""
+    return f'report_source:{model.__tablename__}'
+
+def _bump(topic):
+    with _write_lock:
+        _write_generations[topic] = _write_generations.get(topic, 0) + 1
+
+for _model in {model for models in REPORT_SOURCES.values() for model in models}:
+    publish_on_write(_model, report_source_topic(_model))
+    subscribe(report_source_topic(_model), _bump)
+
+# =================== VERSÃO DOS DADOS ===================
+
+def table_version(model):
+    """(MAX(id), MAX(updated_at), gravações locais) da tabela"""
+    columns = [func.max(model.id)]
+    if hasattr(model, 'updated_at'):
+        columns.append(func.max(model.updated_at))
+    row = db.session.query(*columns).one()
+    with _write_lock:
+        local = _write_generations.get(report_source_topic(model), 0)
+    return tuple(row) + (local,)
+
+def data_version(report_type):
+    """Versão dos dados do relatório (a data entra: vencimentos e nomes de arquivo dependem do dia)"""
+    return (date.today(),) + tuple(table_version(model) for model in REPORT_SOURCES[report_type])
+
+def normalize_params(params):
+    """Parâmetros preenchidos, em ordem fixa (datas em ISO)"""
+    return tuple(sorted(
+        (key, value.isoformat() if isinstance(value, date) else str(value))
+        for key, value in params.items() if value not in (None, '')
+    ))
+
+# =================== LEITURA / GRAVAÇÃO ===================
+
+def _response(entry):
+    return Response(entry['body'], mimetype=entry['mimetype'], headers={
+        'Content-Disposition': entry['disposition'],
+        'X-Report-Cache': 'HIT'
+    })
+
+def cached_report(report_type, format_type, params, render):
+    """
+    Resposta do relatório, do cache quando os dados não mudaram
+    
+    render() gera a resposta (send_file); respostas em streaming sem
+    Content-Length (CSV) ou maiores que _max_bytes passam direto.
+    """
+    if report_type not in REPORT_SOURCES:
+        return render()
+    
+    try:
+        key = (report_type, normalize_params(params), format_type, data_version(report_type))
+    except Exception as e:
+        logging.error(f"Erro ao calcular a versão do relatório {report_type}: {e}")
+        db.session.rollback()
+        return render()
+    
+    entry = report_result_cache.get(key)
+    if entry is not MISSING:
+        return _response(entry)
+    
+    response = render()
+    size = response.content_length
+    if response.status_code != 200 or size is None or size > _max_bytes:
+        return response
+    
+    try:
+        body = b''.join(response.iter_encoded())
+    finally:
+        response.close()
+    
+    entry = {
+        'body': body,
+        'mimetype': response.mimetype,
+        'disposition': response.headers.get('Content-Disposition', '')
+    }
+    report_result_cache.set(key, entry)
+    return Response(body, mimetype=entry['mimetype'], headers={'Content-Disposition': entry['disposition']})
+
+def init_report_cache(app):
+    """Aplicar limites configurados (config.py)"""
+    global _max_bytes
+    report_result_cache.configure(
+        maxsize=app.config.get('REPORT_CACHE_SIZE'),
+        ttl=app.config.get('REPORT_CACHE_TTL')
+    )
+    _max_bytes = app.config.get('REPORT_CACHE_MAX_BYTES', _max_bytes)
@@ -0,0 +1,209 @@
+"""
+Fila de Relatórios em Segundo Plano
+PDF/Excel/CSV são gerados por um pool local de threads (REPORT_JOB_WORKERS)
+em vez de dentro da requisição: reports_generate grava o pedido em
+report_jobs e responde na hora; a página do job consulta o progresso e
+baixa o arquivo, guardado em UPLOAD_FOLDER/reports até expirar
+(REPORT_JOB_TTL_HOURS).
+
+As funções generate_*_report existentes são reaproveitadas: rodam em um
+contexto de requisição de teste e a resposta (send_file ou streaming) é
+gravada em disco.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from app.database import db
+from app.models import ReportJob
+
+REPORTS_SUBFOLDER = 'reports'
+
+_FILENAME_PATTERN = re.compile(r'filename="?([^";]+)"?')
+
+def serialize_params(params):
+    """Parâmetros do relatório em JSON (datas em ISO)"""
+    return json.dumps({
+        key: value.isoformat() if isinstance(value, date) else value
+        for key, value in params.items()
+    })
+
+def deserialize_params(raw):
+    """Inverso de serialize_params (chaves *_date voltam a ser date)"""
+    params = json.loads(raw) if raw else {}
+    for key, value in params.items():
+        if key.endswith('_date') and value:
+            params[key] = date.fromisoformat(value[:10])
+    return params
+
+class ReportJobQueue:
+    """Pool de threads que executa os relatórios enfileirados"""
+    
+    def __init__(self, workers=2, ttl_hours=24):
+        self.workers = workers
+        self.ttl = timedelta(hours=ttl_hours)
+        self._app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._started_at = datetime.utcnow()
+    
+    def init_app(self, app):
+        self._app = app
+        self.workers = app.config.get('REPORT_JOB_WORKERS', self.workers)
+        self.ttl = timedelta(hours=app.config.get('REPORT_JOB_TTL_HOURS', 24))
+        self._started_at = datetime.utcnow()
+    
+    @property
+    def folder(self):
+        folder = os.path.join(self._app.config.get('UPLOAD_FOLDER', 'uploads'), REPORTS_SUBFOLDER)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._recover_interrupted()
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='report-job'
+                )
+            return self._executor
+    
+    # =================== ENFILEIRAR ===================
+    
+    def submit(self, report_type, format_type, params, user_id):
+        """Gravar o job e enviá-lo ao pool (retorna o ReportJob)"""
+        job = ReportJob(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            report_type=report_type,
+            format_type=format_type,
+            params=serialize_params(params),
+            status='queued',
+            progress=0,
+            message='Aguardando na fila'
+        )
+        db.session.add(job)
+        db.session.commit()
+        
+        self._get_executor().submit(self._run, job.id)
+        return job
+    
+    # =================== EXECUÇÃO ===================
+    
+    def _run(self, job_id):
+        app = self._app
+        with app.app_context():
+            try:
+                self.purge_expired()
+                
+                job = db.session.get(ReportJob, job_id)
+                if job is None or job.status != 'queued':
+                    return
+                self._update(job, status='running', progress=10, started_at=datetime.utcnow(),
+                             message='Consultando dados')
+                
+                from app.routes import run_report
+                with app.test_request_context():
+                    response = run_report(job.report_type, job.format_type, **deserialize_params(job.params))
+                    self._update(job, progress=70, message='Gravando arquivo')
+                    self._store(job, response)
+                
+                self._update(job, status='done', progress=100, message='Relatório pronto',
+                             finished_at=datetime.utcnow(), expires_at=datetime.utcnow() + self.ttl)
+            except Exception as e:
+                logging.error(f"Erro no relatório em segundo plano {job_id}: {e}")
+                db.session.rollback()
+                job = db.session.get(ReportJob, job_id)
+                if job is not None:
+                    self._update(job, status='failed', message='Erro ao gerar relatório', error=str(e)[:1000],
+                                 finished_at=datetime.utcnow(), expires_at=datetime.utcnow() + self.ttl)
+            finally:
+                db.session.remove()
+    
+    def _store(self, job, response):
+        """Gravar o corpo da resposta em UPLOAD_FOLDER/reports/<job>.<ext>"""
+        try:
+            if response.status_code != 200 or response.mimetype == 'text/html':
+                raise ValueError('O relatório não gerou um arquivo para download')
+            
+            disposition = response.headers.get('Content-Disposition', '')
+            match = _FILENAME_PATTERN.search(disposition)
+            file_name = match.group(1) if match else f'relatorio_{job.report_type}'
+            extension = os.path.splitext(file_name)[1] or f'.{job.format_type}'
+            
+            path = os.path.join(self.folder, f'{job.id}{extension}')
+            partial = f'{path}.part'
+            with open(partial, 'wb') as file:
+                for chunk in response.iter_encoded():
+                    file.write(chunk)
+            os.replace(partial, path)
+        finally:
+            response.close()
+        
+        job.file_path = path
+        job.file_name = file_name
+        job.mimetype = response.mimetype
+        job.file_size = os.path.getsize(path)
+    
+    @staticmethod
+    def _update(job, **values):
+        """Gravar progresso/estado na hora (a página consulta de outra requisição)"""
+        for key, value in values.items():
+            setattr(job, key, value)
+        db.session.commit()
+    
+    # =================== MANUTENÇÃO ===================
+    
+    def purge_expired(self):
+        """Apagar arquivos vencidos e marcar os jobs como 'expired'"""
+        expired = ReportJob.query.filter(
+            ReportJob.status.in_(('done', 'failed')),
+            ReportJob.expires_at < datetime.utcnow()
+        ).all()
+        for job in expired:
+            if job.file_path and os.path.exists(job.file_path):
+                try:
+                    os.remove(job.file_path)
+                except OSError as e:
+                    logging.warning(f"Não foi possível apagar {job.file_path}: {e}")
+            job.status = 'expired'
+            job.file_path = None
+        if expired:
+            db.session.commit()
+        return len(expired)
+    
+    def _recover_interrupted(self):
+        """Jobs na fila ou em execução antes deste processo subir não vão terminar"""
+        try:
+            ReportJob.query.filter(
+                ReportJob.status.in_(('queued', 'running')),
+                ReportJob.created_at < self._started_at
+            ).update({
+                'status': 'failed',
+                'message': 'Interrompido (servidor reiniciado)',
+                'finished_at': datetime.utcnow(),
+                'expires_at': datetime.utcnow() + self.ttl
+            }, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Erro ao recuperar jobs de relatório: {e}")
+            db.session.rollback()
+    
+    def file_available(self, job):
+        return (
+            job.status == 'done' and job.file_path and os.path.exists(job.file_path)
+            and (job.expires_at is None or job.expires_at > datetime.utcnow())
+        )
+
+# Instância global da fila
+report_job_queue = ReportJobQueue()
+
+def init_report_jobs(app):
+    """Configurar a fila (o pool de threads só é criado no primeiro job)"""
+    report_job_queue.init_app(app)
@@ -0,0 +1,393 @@
+"""
+Agregados Diários de Dispensação
+Tabelas por dia x medicamento x dispensador, dia x dispensador e
+dia x faixa etária x gênero, mantidas a cada flush das dispensações
+(deltas somados com col = col + delta em um upsert) e lidas pelos relatórios
+de consumo, financeiro e de dispensações.
+
+Um relatório anual lê ~365 x N linhas agregadas em vez de milhões de itens.
+Quando upgrade_schema cria as tabelas em um banco existente, elas são
+preenchidas na hora (register_backfill). Recalcular tudo (ou um
+período): scripts/rebuild_rollups.py
+"""
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import and_, case, event, func, desc, inspect, true
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.database import db, register_backfill
+from app.models import (
+    Dispensation, DispensationItem, DispensationStatus, Medication, Patient,
+    DispensationDailyMedication, DispensationDailyDispenser, DispensationDailyPatientBucket
+)
+from app.patient_stats import AGE_BUCKETS
+
+ROLLUP_MODELS = (DispensationDailyMedication, DispensationDailyDispenser, DispensationDailyPatientBucket)
+
+# Atributos que alteram a contribuição de cada modelo nos agregados
+DISPENSATION_ATTRIBUTES = ('dispensation_date', 'dispenser_id', 'patient_id', 'status', 'total_cost')
+ITEM_ATTRIBUTES = ('medication_id', 'quantity_dispensed', 'total_cost')
+
+def age_bucket(birth_date, day):
+    """Faixa etária (rótulos de AGE_BUCKETS) na data da dispensação"""
+    if not birth_date:
+        return AGE_BUCKETS[-1][0]
+    age = day.year - birth_date.year - ((day.month, day.day) < (birth_date.month, birth_date.day))
+    for label, max_age in AGE_BUCKETS:
+        if max_age is None or age <= max_age:
+            return label
+
+def _day(value):
+    return value.date() if hasattr(value, 'date') else value
+
+# =================== DELTAS POR FLUSH ===================
+
+class RollupDelta:
+    """Somatório dos deltas de um flush, agrupado por linha dos agregados"""
+    
+    def __init__(self):
+        self.rows = defaultdict(lambda: defaultdict(int))
+    
+    def add(self, model, key, sign, **values):
+        row = self.rows[(model, tuple(sorted(key.items())))]
+        for column, value in values.items():
+            row[column] += sign * (value or 0)
+    
+    def add_dispensation(self, values, patient, sign):
+        day = _day(values['dispensation_date'])
+        if day is None:
+            return
+        completed = values['status'] == DispensationStatus.COMPLETED
+        self.add(DispensationDailyDispenser, {'day': day, 'dispenser_id': values['dispenser_id']}, sign,
+                 dispensations_count=1,
+                 completed_count=1 if completed else 0,
+                 completed_cost=values['total_cost'] if completed else 0)
+        if patient is not None:
+            self.add(DispensationDailyPatientBucket, {
+                'day': day,
+                'age_bucket': age_bucket(patient.birth_date, day),
+                'gender': patient.gender or 'N'
+            }, sign, dispensations_count=1, total_cost=values['total_cost'])
+    
+    def add_item(self, values, day, dispenser_id, sign):
+        day = _day(day)
+        if day is None:
+            return
+        self.add(DispensationDailyMedication, {
+            'day': day, 'medication_id': values['medication_id'], 'dispenser_id': dispenser_id
+        }, sign, quantity=values['quantity_dispensed'], total_cost=values['total_cost'], items_count=1)
+    
+    def apply(self, connection):
+        for (model, key), values in self.rows.items():
+            values = {column: delta for column, delta in values.items() if delta}
+            if values:
+                _upsert_add(connection, model.__table__, dict(key), values)
+
+def _upsert_add(connection, table, key, values):
+    """
+    Somar os deltas na linha da chave, criando a linha se preciso
+    
+    MySQL: um único INSERT ... ON DUPLICATE KEY UPDATE col = col + VALUES(col).
+    UPDATE sem linha seguido de INSERT deixa um gap lock em REPEATABLE READ e
+    duas primeiras dispensações do dia para a mesma chave terminam em
+    deadlock (1213). Outros bancos (sqlite dos testes): UPDATE e, sem linha,
+    INSERT em savepoint.
+    """
+    if connection.dialect.name == 'mysql':
+        insert = mysql_insert(table).values(**key, **values)
+        connection.execute(insert.on_duplicate_key_update(
+            {column: table.c[column] + insert.inserted[column] for column in values}
+        ))
+        return
+    
+    where = and_(*(table.c[column] == value for column, value in key.items()))
+    increment = table.update().where(where).values(
+        {column: table.c[column] + delta for column, delta in values.items()}
+    )
+    if connection.execute(increment).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(table.insert().values(**key, **values))
+    except IntegrityError:
+        # Outra transação criou a linha entre o UPDATE e o INSERT
+        connection.execute(increment)
+
+def _current(instance, attributes):
+    return {name: getattr(instance, name) for name in attributes}
+
+def _previous(instance, attributes):
+    """Valores antes das alterações pendentes (histórico do atributo)"""
+    state = inspect(instance)
+    values = {}
+    for name in attributes:
+        history = state.attrs[name].history
+        if history.deleted:
+            values[name] = history.deleted[0]
+        elif history.unchanged:
+            values[name] = history.unchanged[0]
+        else:
+            values[name] = None
+    return values
+
+def _changed(instance, attributes):
+    state = inspect(instance)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+def _parent(session, model, parent_id):
+    """
+    Pai pela chave estrangeira
+    
+    Objetos criados só com o id (Dispensation(patient_id=...),
+    DispensationItem(dispensation_id=...)) ainda estão pendentes no
+    after_flush e o relacionamento lazy devolve None.
+    """
+    if parent_id is None:
+        return None
+    with session.no_autoflush:
+        return session.get(model, parent_id)
+
+def collect_deltas(session):
+    """Deltas dos objetos novos, alterados e removidos neste flush"""
+    delta = RollupDelta()
+    
+    for instance in session.new:
+        if isinstance(instance, Dispensation):
+            delta.add_dispensation(_current(instance, DISPENSATION_ATTRIBUTES),
+                                   _parent(session, Patient, instance.patient_id), +1)
+        elif isinstance(instance, DispensationItem):
+            parent = _parent(session, Dispensation, instance.dispensation_id)
+            if parent is not None:
+                delta.add_item(_current(instance, ITEM_ATTRIBUTES), parent.dispensation_date, parent.dispenser_id, +1)
+    
+    for instance in session.deleted:
+        if isinstance(instance, Dispensation):
+            old = _previous(instance, DISPENSATION_ATTRIBUTES)
+            delta.add_dispensation(old, _parent(session, Patient, old['patient_id']), -1)
+        elif isinstance(instance, DispensationItem):
+            values = _previous(instance, ITEM_ATTRIBUTES + ('dispensation_id',))
+            parent = _parent(session, Dispensation, values['dispensation_id'])
+            if parent is not None:
+                parent_values = _previous(parent, ('dispensation_date', 'dispenser_id'))
+                delta.add_item(values, parent_values['dispensation_date'], parent_values['dispenser_id'], -1)
+    
+    for instance in session.dirty:
+        if isinstance(instance, Dispensation) and _changed(instance, DISPENSATION_ATTRIBUTES):
+            old = _previous(instance, DISPENSATION_ATTRIBUTES)
+            delta.add_dispensation(old, _parent(session, Patient, old['patient_id']), -1)
+            delta.add_dispensation(_current(instance, DISPENSATION_ATTRIBUTES),
+                                   _parent(session, Patient, instance.patient_id), +1)
+            
+            # Data ou dispensador mudou: itens mudam de linha
+            if _changed(instance, ('dispensation_date', 'dispenser_id')):
+                for item in instance.items:
+                    if item in session.new or item in session.deleted:
+                        continue
+                    values = _previous(item, ITEM_ATTRIBUTES)
+                    delta.add_item(values, old['dispensation_date'], old['dispenser_id'], -1)
+                    delta.add_item(values, instance.dispensation_date, instance.dispenser_id, +1)
+        
+        elif isinstance(instance, DispensationItem) and _changed(instance, ITEM_ATTRIBUTES):
+            parent = _parent(session, Dispensation, instance.dispensation_id)
+            if parent is not None:
+                delta.add_item(_previous(instance, ITEM_ATTRIBUTES), parent.dispensation_date, parent.dispenser_id, -1)
+                delta.add_item(_current(instance, ITEM_ATTRIBUTES), parent.dispensation_date, parent.dispenser_id, +1)
+    
+    return delta
+
+def _apply_rollup_deltas(session, flush_context):
+    # Mesma transação da dispensação: commit/rollback juntos
+    delta = collect_deltas(session)
+    if delta.rows:
+        delta.apply(session.connection())
+
+def init_rollups(app):
+    """Registrar a manutenção dos agregados (uma vez por processo)"""
+    if not event.contains(Session, 'after_flush', _apply_rollup_deltas):
+        event.listen(Session, 'after_flush', _apply_rollup_deltas)
+
+# =================== RECÁLCULO (CLI) ===================
+
+def rebuild_rollups(start_date=None, end_date=None, chunk_days=31):
+    """
+    Recalcular os agregados a partir das dispensações, em blocos de dias
+    
+    Returns:
+        int: dias recalculados
+    """
+    day_column = func.date(Dispensation.dispensation_date, type_=db.Date)
+    
+    if start_date is None or end_date is None:
+        first, last = db.session.query(
+            func.min(Dispensation.dispensation_date), func.max(Dispensation.dispensation_date)
+        ).one()
+        if first is None:
+            return 0
+        start_date = start_date or first.date()
+        end_date = end_date or last.date()
+    
+    days = 0
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        in_chunk = and_(
+            Dispensation.dispensation_date >= chunk_start,
+            Dispensation.dispensation_date < chunk_end + timedelta(days=1)
+        )
+        
+        for model in ROLLUP_MODELS:
+            db.session.query(model).filter(
+                model.day >= chunk_start, model.day <= chunk_end
+            ).delete(synchronize_session=False)
+        
+        medication_rows = db.session.query(
+            day_column, DispensationItem.medication_id, Dispensation.dispenser_id,
+            func.sum(DispensationItem.quantity_dispensed),
+            func.sum(DispensationItem.total_cost),
+            func.count(DispensationItem.id)
+        ).join(Dispensation).filter(in_chunk).group_by(
+            day_column, DispensationItem.medication_id, Dispensation.dispenser_id
+        ).all()
+        if medication_rows:
+            db.session.execute(DispensationDailyMedication.__table__.insert(), [
+                {'day': day, 'medication_id': medication_id, 'dispenser_id': dispenser_id,
+                 'quantity': quantity or 0, 'total_cost': cost or 0, 'items_count': count}
+                for day, medication_id, dispenser_id, quantity, cost, count in medication_rows
+            ])
+        
+        completed = Dispensation.status == DispensationStatus.COMPLETED
+        dispenser_rows = db.session.query(
+            day_column, Dispensation.dispenser_id,
+            func.count(Dispensation.id),
+            func.sum(case((completed, 1), else_=0)),
+            func.sum(case((completed, Dispensation.total_cost), else_=0))
+        ).filter(in_chunk).group_by(day_column, Dispensation.dispenser_id).all()
+        if dispenser_rows:
+            db.session.execute(DispensationDailyDispenser.__table__.insert(), [
+                {'day': day, 'dispenser_id': dispenser_id, 'dispensations_count': count,
+                 'completed_count': completed_count or 0, 'completed_cost': completed_cost or 0}
+                for day, dispenser_id, count, completed_count, completed_cost in dispenser_rows
+            ])
+        
+        # Faixa etária depende do dia: agrupar por nascimento e classificar aqui
+        buckets = defaultdict(lambda: [0, 0])
+        patient_rows = db.session.query(
+            day_column, Patient.birth_date, Patient.gender,
+            func.count(Dispensation.id), func.sum(Dispensation.total_cost)
+        ).join(Patient, Patient.id == Dispensation.patient_id).filter(in_chunk).group_by(
+            day_column, Patient.birth_date, Patient.gender
+        ).all()
+        for day, birth_date, gender, count, cost in patient_rows:
+            bucket = buckets[(day, age_bucket(birth_date, day), gender or 'N')]
+            bucket[0] += count
+            bucket[1] += cost or 0
+        if buckets:
+            db.session.execute(DispensationDailyPatientBucket.__table__.insert(), [
+                {'day': day, 'age_bucket': label, 'gender': gender,
+                 'dispensations_count': count, 'total_cost': cost}
+                for (day, label, gender), (count, cost) in buckets.items()
+            ])
+        
+        db.session.commit()
+        days += (chunk_end - chunk_start).days + 1
+        logging.info(f"Agregados recalculados: {chunk_start} a {chunk_end}")
+        chunk_start = chunk_end + timedelta(days=1)
+    
+    return days
+
+# Tabelas recém-criadas em banco com dispensações: preencher no upgrade_schema
+register_backfill([model.__tablename__ for model in ROLLUP_MODELS], rebuild_rollups)
+
+# =================== CONSULTAS DOS RELATÓRIOS ===================
+
+def _in_period(model, start_date, end_date):
+    conditions = []
+    if start_date:
+        conditions.append(model.day >= _day(start_date))
+    if end_date:
+        conditions.append(model.day <= _day(end_date))
+    return and_(*conditions) if conditions else true()
+
+class DispensationRollups:
+    """Consultas dos relatórios sobre os agregados diários"""
+    
+    @staticmethod
+    def consumption(start_date=None, end_date=None):
+        """Mesmas colunas do relatório de consumo (por medicamento)"""
+        rollup = DispensationDailyMedication
+        return db.session.query(
+            Medication.commercial_name,
+            Medication.generic_name,
+            Medication.dosage,
+            func.sum(rollup.quantity).label('total_dispensed'),
+            func.sum(rollup.items_count).label('dispensations_count'),
+            func.sum(rollup.total_cost).label('total_cost')
+        ).join(rollup, rollup.medication_id == Medication.id).filter(
+            _in_period(rollup, start_date, end_date)
+        ).group_by(
+            Medication.id, Medication.commercial_name,
+            Medication.generic_name, Medication.dosage
+        ).order_by(desc('total_dispensed')).all()
+    
+    @staticmethod
+    def completed_totals(start_date=None, end_date=None):
+        """Custo e quantidade das dispensações concluídas (relatório financeiro)"""
+        rollup = DispensationDailyDispenser
+        return db.session.query(
+            func.sum(rollup.completed_cost).label('total_basic_cost'),
+            func.coalesce(func.sum(rollup.completed_count), 0).label('total_dispensations')
+        ).filter(_in_period(rollup, start_date, end_date)).one()
+    
+    @staticmethod
+    def medication_costs(start_date=None, end_date=None, limit=20):
+        rollup = DispensationDailyMedication
+        return db.session.query(
+            Medication.commercial_name,
+            func.sum(rollup.total_cost).label('total_cost'),
+            func.sum(rollup.quantity).label('total_quantity')
+        ).join(rollup, rollup.medication_id == Medication.id).filter(
+            _in_period(rollup, start_date, end_date)
+        ).group_by(
+            Medication.id, Medication.commercial_name
+        ).order_by(desc('total_cost')).limit(limit).all()
+    
+    @staticmethod
+    def daily_counts(start_date=None, end_date=None, dispenser_id=None):
+        """[(dia, dispensações)] em ordem cronológica"""
+        rollup = DispensationDailyDispenser
+        query = db.session.query(rollup.day, func.sum(rollup.dispensations_count)).filter(
+            _in_period(rollup, start_date, end_date)
+        )
+        if dispenser_id:
+            query = query.filter(rollup.dispenser_id == dispenser_id)
+        return query.group_by(rollup.day).order_by(rollup.day).all()
+    
+    @staticmethod
+    def top_medications(start_date=None, end_date=None, dispenser_id=None, limit=10):
+        """[(nome, quantidade)] dos medicamentos mais dispensados"""
+        rollup = DispensationDailyMedication
+        quantity = func.sum(rollup.quantity)
+        query = db.session.query(Medication.commercial_name, quantity).join(
+            rollup, rollup.medication_id == Medication.id
+        ).filter(_in_period(rollup, start_date, end_date))
+        if dispenser_id:
+            query = query.filter(rollup.dispenser_id == dispenser_id)
+        return query.group_by(Medication.id, Medication.commercial_name).order_by(
+            quantity.desc()
+        ).limit(limit).all()
+    
+    @staticmethod
+    def patient_buckets(start_date=None, end_date=None):
+        """[(faixa etária, gênero, dispensações, custo)] do período"""
+        rollup = DispensationDailyPatientBucket
+        return db.session.query(
+            rollup.age_bucket, rollup.gender,
+            func.sum(rollup.dispensations_count), func.sum(rollup.total_cost)
+        ).filter(_in_period(rollup, start_date, end_date)).group_by(
+            rollup.age_bucket, rollup.gender
+        ).order_by(rollup.age_bucket, rollup.gender).all()
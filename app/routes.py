@@ -12,11 +12,6 @@ import re
 # Imports para geração de relatórios
 from io import BytesIO, StringIO
 import pandas as pd
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
-from reportlab.lib import colors
 import csv
 
 # ✅ ADICIONAR NO TOPO DO routes.py:
@@ -32,6 +27,20 @@ from app.calculations import (
 
 from app.database import db, login_manager
 from app.models import *
+from app.patient_search import PatientSearchService
+from app.dashboard_stats import DashboardStatsService
+from app.patient_stats import PatientStatsService, GENDER_LABELS, AGE_BUCKETS
+from app.patient_history import PatientHistoryService, period_start
+from app.rollups import DispensationRollups, age_bucket
+from app.exports import iter_query, csv_response, export_filename, StreamingWorkbook
+from app.pdf_render import PdfDocument, pdf_response
+from app.cache import patient_search_cache, medication_search_cache, all_cache_stats
+from app.status_sampler import status_sampler
+from app.report_jobs import report_job_queue
+from app.report_cache import cached_report
+from app.stock import StockService, InsufficientStockError
+from app.idempotency import idempotent
+from app.audit_log import audit_log_page
 from app.forms import *
 from app.auth import *
 from app.utils import *
@@ -39,9 +48,9 @@ from app.utils import *
 # ✅ IMPORTAR FUNÇÕES E-SUS
 from app.esus_integration import (
     get_esus_db_credentials, save_esus_credentials, 
-    test_esus_connection, search_patient_in_esus,
-    get_esus_statistics, format_esus_data_for_display,
-    get_esus_patient_by_cpf, get_esus_patient_by_cns
+    test_esus_connection, get_esus_statistics,
+    get_esus_patient_by_cpf, get_esus_patient_by_cns,
+    esus_search_cache, esus_breaker
 )
 
 # Blueprint principal
@@ -196,25 +205,8 @@ def dashboard():
 @admin_required
 def admin_dashboard():
     """Dashboard do administrador"""
-    # Estatísticas gerais
-    stats = {
-        'total_patients': Patient.query.filter_by(is_active=True).count(),
-        'total_users': User.query.filter_by(is_active=True).count(),
-        'total_medications': Medication.query.filter_by(is_active=True).count(),
-        'pending_high_cost': HighCostProcess.query.filter_by(status=ProcessStatus.PENDING).count(),
-        'low_stock_medications': Medication.query.filter(
-            Medication.current_stock <= Medication.minimum_stock
-        ).count(),
-        'near_expiry_medications': Medication.query.filter(
-            and_(
-                Medication.expiry_date.isnot(None),
-                Medication.expiry_date <= date.today() + timedelta(days=30)
-            )
-        ).count(),
-        # ✅ ESTATÍSTICAS E-SUS
-        'patients_from_esus': Patient.query.filter_by(source='imported').count(),
-        'patients_synced_esus': Patient.query.filter(Patient.esus_sync_date.isnot(None)).count()
-    }
+    # Estatísticas gerais (✅ uma consulta por tabela, em cache)
+    stats = DashboardStatsService.admin_stats()
     
     # Dispensações dos últimos 7 dias
     week_ago = datetime.now() - timedelta(days=7)
@@ -236,37 +228,16 @@ def admin_dashboard():
 @pharmacist_required
 def pharmacist_dashboard():
     """Dashboard do farmacêutico"""
-    # Estatísticas do farmacêutico
-    stats = {
-        'pending_evaluations': HighCostProcess.query.filter_by(
-            status=ProcessStatus.UNDER_EVALUATION
-        ).count(),
-        'pending_approvals': HighCostProcess.query.filter_by(
-            status=ProcessStatus.PENDING
-        ).count(),
-        'low_stock_count': Medication.query.filter(
-            Medication.current_stock <= Medication.minimum_stock
-        ).count(),
-        'today_dispensations': Dispensation.query.filter(
-            Dispensation.dispensation_date >= date.today()
-        ).count()
-    }
+    # Estatísticas do farmacêutico (✅ uma consulta por tabela, em cache)
+    stats = DashboardStatsService.pharmacist_stats()
     
     # Alertas importantes
     alerts = []
     
-    # Medicamentos com estoque baixo
-    low_stock = Medication.query.filter(
-        Medication.current_stock <= Medication.minimum_stock
-    ).limit(5).all()
-    
-    # Medicamentos próximos ao vencimento
-    near_expiry = Medication.query.filter(
-        and_(
-            Medication.expiry_date.isnot(None),
-            Medication.expiry_date <= date.today() + timedelta(days=30)
-        )
-    ).limit(5).all()
+    # Medicamentos com estoque baixo / próximos ao vencimento (✅ em cache)
+    medication_alerts = DashboardStatsService.section('medication_alerts')
+    low_stock = medication_alerts['low_stock']
+    near_expiry = medication_alerts['near_expiry']
     
     # Processos alto custo pendentes de avaliação
     pending_processes = HighCostProcess.query.filter_by(
@@ -283,22 +254,8 @@ def pharmacist_dashboard():
 @staff_required
 def attendant_dashboard():
     """Dashboard do atendente"""
-    # Estatísticas do atendente
-    stats = {
-        'today_dispensations': Dispensation.query.filter(
-            and_(
-                Dispensation.dispensation_date >= date.today(),
-                Dispensation.dispenser_id == current_user.id
-            )
-        ).count(),
-        'total_patients': Patient.query.filter_by(is_active=True).count(),
-        'available_medications': Medication.query.filter(
-            and_(
-                Medication.is_active == True,
-                Medication.current_stock > 0
-            )
-        ).count()
-    }
+    # Estatísticas do atendente (✅ uma consulta por tabela, em cache)
+    stats = DashboardStatsService.attendant_stats(current_user.id)
     
     # Dispensações recentes do usuário
     my_dispensations = Dispensation.query.filter_by(
@@ -365,12 +322,27 @@ def esus_config_save():
     
     return redirect(url_for('main.esus_config'))
 
+@main.route('/admin/esus-cache/flush', methods=['POST'])
+@admin_required
+def esus_cache_flush():
+    """Limpar cache de buscas e-SUS (acertos e "nenhum resultado")"""
+    stats = esus_search_cache.stats()
+    esus_search_cache.clear()
+    log_action('FLUSH', 'esus_search_cache', new_values={'entries': stats['size']})
+    
+    return jsonify({
+        'success': True,
+        'message': f"Cache de buscas e-SUS limpo ({stats['size']} entradas removidas)",
+        'stats': stats
+    })
+
 @main.route('/admin/esus-test', methods=['POST'])
 @admin_required
 def esus_test_connection():
     """Testar conexão com e-SUS"""
     try:
-        success, message = test_esus_connection()
+        # Teste manual: tenta conectar mesmo com o circuito aberto
+        success, message = test_esus_connection(force=True)
         return jsonify({
             'success': success,
             'message': message
@@ -398,31 +370,9 @@ def patients_list():
     
     query = Patient.query
     
-    # ✅ APLICAR FILTROS DE BUSCA EXPANDIDOS
+    # ✅ APLICAR FILTROS DE BUSCA EXPANDIDOS (name, cpf, cns, phone, email, mother)
     if search_term:
-        if search_type == 'name':
-            query = query.filter(Patient.full_name.ilike(f'%{search_term}%'))
-        elif search_type == 'cpf':
-            clean_cpf = re.sub(r'[^0-9]', '', search_term)
-            query = query.filter(Patient.cpf.like(f'%{clean_cpf}%'))
-        elif search_type == 'cns':
-            clean_cns = re.sub(r'[^0-9]', '', search_term)
-            query = query.filter(Patient.cns.like(f'%{clean_cns}%'))
-        elif search_type == 'phone':
-            # ✅ BUSCAR EM TODOS OS TELEFONES
-            clean_phone = re.sub(r'[^0-9]', '', search_term)
-            query = query.filter(
-                or_(
-                    Patient.cell_phone.like(f'%{clean_phone}%'),
-                    Patient.home_phone.like(f'%{clean_phone}%'),
-                    Patient.contact_phone.like(f'%{clean_phone}%')
-                )
-            )
-        elif search_type == 'email':
-            query = query.filter(Patient.email.ilike(f'%{search_term}%'))
-        elif search_type == 'mother':
-            # ✅ NOVO: BUSCA POR NOME DA MÃE
-            query = query.filter(Patient.mother_name.ilike(f'%{search_term}%'))
+        query = query.filter(PatientSearchService.filter_clause(search_term, search_type))
     
     # ✅ FILTROS DE STATUS E GÊNERO
     if status_filter == 'active':
@@ -436,7 +386,8 @@ def patients_list():
     if gender_filter:
         query = query.filter(Patient.gender == gender_filter)
     
-    patients = query.order_by(Patient.full_name).paginate(
+    order = PatientSearchService.rank_order(search_term, search_type) if search_term else [Patient.full_name]
+    patients = query.order_by(*order).paginate(
         page=page, per_page=per_page, error_out=False
     )
     
@@ -494,7 +445,7 @@ def patients_search_integrated():
     
     try:
         # Usar busca integrada do modelo Patient
-        local_results, esus_results = Patient.search_integrated(search_term, search_type)
+        local_results, esus_results = PatientSearchService.search_integrated(search_term, search_type)
         
         return render_template('patients/search_results.html',
                              local_results=local_results,
@@ -521,13 +472,7 @@ def search_esus_patients():
         return jsonify({'success': False, 'message': 'Termo de busca é obrigatório'})
     
     try:
-        raw_results = search_patient_in_esus(query, search_type)
-        formatted_results = []
-        
-        for patient in raw_results:
-            formatted_data = format_esus_data_for_display(patient)
-            if formatted_data:
-                formatted_results.append(formatted_data)
+        formatted_results = PatientSearchService.search_esus(query, search_type)
         
         return jsonify({
             'success': True,
@@ -800,172 +745,35 @@ def patient_edit(id):
 @main.route('/patients/<int:id>/history')
 @staff_required
 def patient_history(id):
-    """✅ HISTÓRICO COMPLETO DO PACIENTE - VERSÃO CORRIGIDA"""
+    """✅ HISTÓRICO COMPLETO DO PACIENTE - TIMELINE NO BANCO (UNION ALL + CURSOR)"""
     patient = Patient.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('before') or None
     
     # ✅ FILTROS DA URL
     period = request.args.get('period', '')
     type_filter = request.args.get('type', '')
-    medication_filter = request.args.get('medication', '')
-    
-    # ✅ CALCULAR ESTATÍSTICAS GERAIS
-    all_dispensations = Dispensation.query.filter_by(patient_id=id).all()
-    all_high_cost = HighCostProcess.query.filter_by(patient_id=id).all()
-    
-    total_dispensations = len(all_dispensations)
-    total_high_cost = len(all_high_cost)
-    
-    # ✅ MEDICAMENTOS ÚNICOS
-    unique_meds = set()
-    for disp in all_dispensations:
-        if hasattr(disp, 'items') and disp.items:
-            for item in disp.items:
-                unique_meds.add(item.medication_id)
-    for process in all_high_cost:
-        unique_meds.add(process.medication_id)
-    unique_medications = len(unique_meds)
-    
-    # ✅ ÚLTIMA DISPENSAÇÃO
-    last_dispensation = Dispensation.query.filter_by(patient_id=id).order_by(
-        desc(Dispensation.dispensation_date)
-    ).first()
-    
-    # ✅ CRIAR TIMELINE UNIFICADA
-    history_items_list = []
-    
-    # Adicionar dispensações
-    for dispensation in all_dispensations:
-        if hasattr(dispensation, 'items') and dispensation.items:
-            for item in dispensation.items:
-                history_items_list.append({
-                    'type': 'dispensation',
-                    'date': dispensation.dispensation_date,
-                    'medication_name': item.medication.commercial_name if item.medication else 'Medicamento não encontrado',
-                    'quantity': item.quantity_dispensed,
-                    'pharmacist_name': dispensation.dispenser.full_name if dispensation.dispenser else 'N/A',
-                    'prescription_number': getattr(dispensation, 'prescription_number', None),
-                    'notes': item.observations or dispensation.observations,
-                    'status': dispensation.status.value if hasattr(dispensation.status, 'value') else str(dispensation.status),
-                    'attachments': []
-                })
-        else:
-            # Se não há itens, criar entrada genérica
-            history_items_list.append({
-                'type': 'dispensation',
-                'date': dispensation.dispensation_date,
-                'medication_name': 'Dispensação registrada',
-                'quantity': 1,
-                'pharmacist_name': dispensation.dispenser.full_name if dispensation.dispenser else 'N/A',
-                'prescription_number': getattr(dispensation, 'prescription_number', None),
-                'notes': dispensation.observations,
-                'status': dispensation.status.value if hasattr(dispensation.status, 'value') else str(dispensation.status),
-                'attachments': []
-            })
+    medication_filter = request.args.get('medication', '').strip()
     
-    # Adicionar processos alto custo
-    for process in all_high_cost:
-        history_items_list.append({
-            'type': 'high_cost',
-            'date': process.request_date,
-            'medication_name': process.medication.commercial_name if process.medication else 'Medicamento não encontrado',
-            'protocol_number': process.protocol_number,
-            'status': process.status.value if hasattr(process.status, 'value') else str(process.status),
-            'prescribing_doctor': process.doctor_name,
-            'cid_code': process.cid10,
-            'quantity_approved': getattr(process, 'approved_quantity', None),
-            'attachments': getattr(process, 'documents', [])
-        })
+    # ✅ ESTATÍSTICAS GERAIS (uma consulta agregada)
+    stats = PatientHistoryService.stats(id)
     
-    # ✅ APLICAR FILTROS
-    filtered_items = []
+    # ✅ PÁGINA DA TIMELINE (filtros aplicados no banco)
+    history_items = PatientHistoryService.page(
+        id, cursor=cursor, since=period_start(period),
+        type_filter=type_filter, medication_filter=medication_filter
+    )
     
-    for item in history_items_list:
-        # Filtro por período
-        if period:
-            try:
-                days = int(period)
-                cutoff_date = datetime.now() - timedelta(days=days)
-                item_date = item['date']
-                
-                # Converter para datetime se for date
-                if hasattr(item_date, 'date'):
-                    item_datetime = item_date
-                else:
-                    item_datetime = datetime.combine(item_date, datetime.min.time())
-                
-                if item_datetime < cutoff_date:
-                    continue
-            except (ValueError, TypeError):
-                pass
-        
-        # Filtro por tipo
-        if type_filter and item['type'] != type_filter:
-            continue
-        
-        # Filtro por medicamento
-        if medication_filter and medication_filter.lower() not in item['medication_name'].lower():
-            continue
-        
-        filtered_items.append(item)
-    
-    # ✅ ORDENAR POR DATA (MAIS RECENTE PRIMEIRO)
-    filtered_items.sort(key=lambda x: x['date'], reverse=True)
-    
-    # ✅ PAGINAÇÃO MANUAL
-    per_page = 10
-    total_count = len(history_items_list)
-    filtered_count = len(filtered_items)
-    
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_items = filtered_items[start:end]
-    
-    # ✅ CRIAR CLASSE DE PAGINAÇÃO ITERÁVEL
-    class PaginationWrapper:
-        def __init__(self, items, page, per_page, total):
-            self._items = items
-            self.page = page
-            self.per_page = per_page
-            self.total = total
-            self.pages = (total + per_page - 1) // per_page if total > 0 else 1
-            self.has_prev = page > 1
-            self.has_next = page < self.pages
-            self.prev_num = page - 1 if self.has_prev else None
-            self.next_num = page + 1 if self.has_next else None
-        
-        def __iter__(self):
-            """Permite iteração direta sobre o objeto"""
-            return iter(self._items)
-        
-        def __len__(self):
-            """Retorna comprimento dos itens"""
-            return len(self._items)
-        
-        @property
-        def items(self):
-            """Compatibilidade com Flask-SQLAlchemy pagination"""
-            return self._items
-        
-        def iter_pages(self, left_edge=2, left_current=2, right_current=3, right_edge=2):
-            """Gerador de páginas para navegação"""
-            last = self.pages
-            for num in range(1, last + 1):
-                if (num <= left_edge or 
-                    (self.page - left_current - 1 < num < self.page + right_current) or 
-                    num > last - right_edge):
-                    yield num
-    
-    # ✅ CRIAR OBJETO DE PAGINAÇÃO
-    history_items = PaginationWrapper(paginated_items, page, per_page, filtered_count)
+    filtered_count = history_items.total
+    has_filters = period_start(period) or type_filter or medication_filter
+    total_count = PatientHistoryService.count(id) if has_filters else filtered_count
     
     return render_template('patients/history.html', 
                          patient=patient,
                          history_items=history_items,
-                         total_dispensations=total_dispensations,
-                         unique_medications=unique_medications,
-                         total_high_cost=total_high_cost,
-                         last_dispensation=last_dispensation,
+                         total_dispensations=stats['total_dispensations'],
+                         unique_medications=stats['unique_medications'],
+                         total_high_cost=stats['total_high_cost'],
+                         last_dispensation_date=stats['last_dispensation_date'],
                          total_count=total_count,
                          filtered_count=filtered_count,
                          period=period,
@@ -991,42 +799,14 @@ def dispensation_search_patient():
         return jsonify({'error': 'Digite pelo menos 3 caracteres'}), 400
     
     try:
-        query = Patient.query.filter(Patient.is_active == True)
-        
-        if search_term.isdigit():
-            if len(search_term) == 11:
-                # CPF
-                query = query.filter(Patient.cpf == search_term)
-            elif len(search_term) == 15:
-                # CNS
-                query = query.filter(Patient.cns == search_term)
-            else:
-                # ✅ BUSCA EM TELEFONES E DOCUMENTOS
-                query = query.filter(
-                    or_(
-                        Patient.cpf.like(f'%{search_term}%'),
-                        Patient.cns.like(f'%{search_term}%'),
-                        Patient.cell_phone.like(f'%{search_term}%'),
-                        Patient.home_phone.like(f'%{search_term}%'),
-                        Patient.contact_phone.like(f'%{search_term}%')
-                    )
-                )
-        else:
-            # ✅ BUSCA POR NOME OU NOME DA MÃE
-            query = query.filter(
-                or_(
-                    Patient.full_name.ilike(f'%{search_term}%'),
-                    Patient.mother_name.ilike(f'%{search_term}%')
-                )
-            )
-        
-        patients = query.order_by(Patient.full_name).limit(50).all()
+        # ✅ CPF/CNS EXATO, DATA, TRECHO DE DOCUMENTO/TELEFONE OU NOME/NOME DA MÃE
+        patients = PatientSearchService.search(search_term, limit=50)
         
         # ✅ FORMATAR DADOS COM NOVOS CAMPOS
         patients_data = []
         for patient in patients:
             # Telefone principal (prioridade: celular > residencial > contato)
-            primary_phone = patient.cell_phone or patient.home_phone or patient.contact_phone or getattr(patient, 'phone', None)
+            primary_phone = PatientSearchService.primary_phone(patient)
             
             patients_data.append({
                 'id': patient.id,
@@ -1034,10 +814,10 @@ def dispensation_search_patient():
                 'cpf': format_cpf(patient.cpf),
                 'cns': format_cns(patient.cns) if patient.cns else None,
                 'birth_date': patient.birth_date.isoformat() if patient.birth_date else None,
-                'age': patient.age,
+                'age': PatientSearchService.age(patient),
                 'phone': format_phone(primary_phone) if primary_phone else None,
-                'mother_name': getattr(patient, 'mother_name', None),
-                'source': getattr(patient, 'source', 'local') or 'local'
+                'mother_name': patient.mother_name,
+                'source': patient.source or 'local'
             })
         
         return jsonify({
@@ -1090,6 +870,7 @@ def dispensation_confirm_page():
 
 @main.route('/dispensation/create', methods=['POST'])
 @staff_required
+@idempotent
 def dispensation_create():
     """Processar dispensação com controle de intervalos UNIVERSAL"""
     data = request.get_json()
@@ -1108,19 +889,29 @@ def dispensation_create():
         return jsonify({'error': 'Paciente não encontrado'}), 404
     
     try:
+        # ✅ CARREGAR MEDICAMENTOS E CONTROLES ATIVOS DE UMA VEZ (UMA CONSULTA IN CADA)
+        medication_ids = {med_data['medication_id'] for med_data in medications}
+        medications_by_id = {
+            medication.id: medication
+            for medication in Medication.query.filter(Medication.id.in_(medication_ids))
+        }
+        controls_by_medication = {}
+        for control in DispensationControl.query.filter(
+            DispensationControl.patient_id == patient_id,
+            DispensationControl.medication_id.in_(medication_ids),
+            DispensationControl.is_active == True
+        ).order_by(DispensationControl.id):
+            controls_by_medication.setdefault(control.medication_id, control)
+        
         # ✅ VERIFICAR INTERVALOS PARA TODOS OS MEDICAMENTOS - LÓGICA UNIVERSAL
         blocked_medications = []
         
         for med_data in medications:
-            medication = Medication.query.get(med_data['medication_id'])
+            medication = medications_by_id.get(med_data['medication_id'])
             
             if medication:
-                # ✅ BUSCAR CONTROLE EXISTENTE PARA QUALQUER MEDICAMENTO
-                existing_control = DispensationControl.query.filter_by(
-                    patient_id=patient_id,
-                    medication_id=medication.id,
-                    is_active=True
-                ).first()
+                # ✅ CONTROLE EXISTENTE PARA QUALQUER MEDICAMENTO
+                existing_control = controls_by_medication.get(medication.id)
                 
                 if existing_control:
                     # ✅ MEDICAMENTO JÁ TEM CONTROLE - VERIFICAR SE PODE DISPENSAR
@@ -1185,13 +976,16 @@ def dispensation_create():
         db.session.add(dispensation)
         db.session.flush()  # Para obter o ID
         
+        # ✅ BLOQUEAR O ESTOQUE (FOR UPDATE, ORDEM DE ID) ATÉ O COMMIT
+        stock_by_id = StockService.lock(medications_by_id)
+        
         total_cost = Decimal('0.00')
         interval_controls_created = 0
         early_releases_count = 0
         
         # ✅ PROCESSAR CADA MEDICAMENTO
         for med_data in medications:
-            medication = Medication.query.get(med_data['medication_id'])
+            medication = medications_by_id.get(med_data['medication_id'])
             quantity = int(med_data['quantity'])
             med_observations = med_data.get('observations', '')
             interval_control_data = med_data.get('interval_control')
@@ -1199,8 +993,11 @@ def dispensation_create():
             if not medication:
                 raise ValueError(f"Medicamento {med_data['medication_id']} não encontrado")
             
-            if medication.current_stock < quantity:
-                raise ValueError(f"Estoque insuficiente para {medication.commercial_name}")
+            if quantity <= 0:
+                raise ValueError(f"Quantidade inválida para {medication.commercial_name}")
+            
+            if stock_by_id[medication.id] < quantity:
+                raise InsufficientStockError(f"Estoque insuficiente para {medication.commercial_name}")
             
             # ✅ CALCULAR CUSTO
             unit_cost = medication.unit_cost or Decimal('0.00')
@@ -1220,11 +1017,7 @@ def dispensation_create():
             db.session.flush()  # ✅ IMPORTANTE: Obter ID do item para o controle
             
             # ✅ PROCESSAR CONTROLE DE INTERVALO (OBRIGATÓRIO PARA TODOS)
-            existing_control = DispensationControl.query.filter_by(
-                patient_id=patient_id,
-                medication_id=medication.id,
-                is_active=True
-            ).first()
+            existing_control = controls_by_medication.get(medication.id)
             
             if existing_control:
                 # ✅ ATUALIZAR CONTROLE EXISTENTE
@@ -1290,11 +1083,13 @@ def dispensation_create():
                 )
                 
                 db.session.add(new_control)
+                controls_by_medication[medication.id] = new_control
                 interval_controls_created += 1
             
-            # ✅ ATUALIZAR ESTOQUE
-            old_stock = medication.current_stock
-            medication.current_stock -= quantity
+            # ✅ ATUALIZAR ESTOQUE (UPDATE ATÔMICO COM current_stock >= quantidade)
+            StockService.decrement(medication, quantity)
+            old_stock = stock_by_id[medication.id]
+            stock_by_id[medication.id] = old_stock - quantity
             
             # ✅ REGISTRAR MOVIMENTO DE ESTOQUE
             movement = InventoryMovement(
@@ -1303,7 +1098,7 @@ def dispensation_create():
                 movement_type='exit',
                 quantity=quantity,
                 previous_stock=old_stock,
-                new_stock=medication.current_stock,
+                new_stock=stock_by_id[medication.id],
                 reason=f'Dispensação #{dispensation.id}',
                 reference_id=dispensation.id,
                 reference_type='dispensation'
@@ -1343,6 +1138,9 @@ def dispensation_create():
             'redirect_url': url_for('main.dispensation_index')  # ✅ URL CORRETA PARA REDIRECIONAMENTO
         })
         
+    except InsufficientStockError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Erro na dispensação universal: {e}")
@@ -1511,7 +1309,7 @@ def generate_patient_report(patient, start_date, end_date, format_type):
         and_(
             Dispensation.patient_id == patient.id,
             Dispensation.dispensation_date >= start_date,
-            Dispensation.dispensation_date <= end_date
+            Dispensation.dispensation_date < end_date + timedelta(days=1)
         )
     ).options(
         joinedload(Dispensation.items).joinedload(DispensationItem.medication),
@@ -1611,83 +1409,41 @@ def generate_patient_report(patient, start_date, end_date, format_type):
 
 def generate_patient_report_pdf(patient, dispensations, high_cost_processes, timeline_events, stats, start_date, end_date):
     """Gerar PDF do relatório do paciente"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
     # Título
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=1
-    )
-    
-    title = Paragraph(f"Relatório do Paciente: {patient.full_name}", title_style)
-    story.append(title)
+    document.centered_title(f"Relatório do Paciente: {patient.full_name}")
     
     # Período
-    period = Paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}", styles['Normal'])
-    story.append(period)
-    story.append(Spacer(1, 12))
+    document.paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}")
+    document.spacer(12)
     
     # Dados do paciente
-    patient_data = [
+    document.table([
         ['Dados do Paciente', ''],
         ['Nome', patient.full_name],
         ['CPF', format_cpf(patient.cpf)],
         ['CNS', format_cns(patient.cns) if patient.cns else 'N/A'],
         ['Idade', f"{patient.age} anos"],
         ['Telefone', patient.primary_phone or 'N/A']
-    ]
-    
-    patient_table = Table(patient_data)
-    patient_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(patient_table)
-    story.append(Spacer(1, 12))
+    ], header='lightblue', header_text='black', align='LEFT', header_size=12, header_padding=12, body='beige')
+    document.spacer(12)
     
     # Estatísticas do período
-    stats_data = [
+    document.table([
         ['Estatísticas do Período', ''],
         ['Total de Dispensações', str(stats['total_dispensations'])],
         ['Processos Alto Custo', str(stats['total_high_cost'])],
         ['Medicamentos Únicos', str(stats['unique_medications'])],
         ['Quantidade Total', str(stats['total_quantity'])],
         ['Custo Total', f"R$ {stats['total_cost']:.2f}"]
-    ]
-    
-    stats_table = Table(stats_data)
-    stats_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgreen),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(stats_table)
-    story.append(Spacer(1, 12))
+    ], header='lightgreen', header_text='black', align='LEFT', header_size=12, header_padding=12, body='beige')
+    document.spacer(12)
     
     # Timeline de eventos (últimos 20)
     if timeline_events:
-        timeline_title = Paragraph("Timeline de Eventos (Últimos 20)", styles['Heading2'])
-        story.append(timeline_title)
-        story.append(Spacer(1, 6))
+        document.paragraph("Timeline de Eventos (Últimos 20)", 'Heading2')
+        document.spacer(6)
         
         timeline_data = [['Data', 'Tipo', 'Descrição', 'Detalhes']]
         
@@ -1699,29 +1455,10 @@ def generate_patient_report_pdf(patient, dispensations, high_cost_processes, tim
                 event['details'][:30]
             ])
         
-        timeline_table = Table(timeline_data)
-        timeline_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(timeline_table)
+        document.table(timeline_data, header_size=10, header_padding=12, body='beige', body_size=8)
     
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_paciente_{patient.full_name.replace(" ", "_")}_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
+    return pdf_response(
+        document, f'relatorio_paciente_{patient.full_name.replace(" ", "_")}_{datetime.now().strftime("%Y%m%d")}.pdf'
     )
 
 def generate_patient_report_excel(patient, dispensations, high_cost_processes, timeline_events, stats, start_date, end_date):
@@ -2206,28 +1943,24 @@ def api_medications_search_with_intervals():
     if len(term) < 3:
         return jsonify([])
     
-    # Query base
-    query = Medication.query.filter(
-        and_(
-            Medication.is_active == True,
-            Medication.current_stock > 0,
-            or_(
-                Medication.commercial_name.ilike(f'%{term}%'),
-                Medication.generic_name.ilike(f'%{term}%')
+    def load_medications():
+        # Query base
+        query = Medication.query.filter(
+            and_(
+                Medication.is_active == True,
+                Medication.current_stock > 0,
+                or_(
+                    Medication.commercial_name.ilike(f'%{term}%'),
+                    Medication.generic_name.ilike(f'%{term}%')
+                )
             )
         )
-    )
-    
-    # Filtro por tipo se especificado
-    if medication_type:
-        query = query.filter(Medication.medication_type == medication_type)
-    
-    medications = query.limit(20).all()
-    
-    results = []
-    for med in medications:
-        # Dados básicos do medicamento
-        med_data = {
+        
+        # Filtro por tipo se especificado
+        if medication_type:
+            query = query.filter(Medication.medication_type == medication_type)
+        
+        return [{
             'id': med.id,
             'commercial_name': med.commercial_name,
             'generic_name': med.generic_name,
@@ -2240,12 +1973,36 @@ def api_medications_search_with_intervals():
             'controlled_substance': med.controlled_substance,
             'has_interval_control': med.has_interval_control,
             'interval_days': med.interval_days
-        }
+        } for med in query.limit(20).all()]
+    
+    # ✅ DADOS DOS MEDICAMENTOS EM CACHE (ESTOQUE INVALIDA NO COMMIT)
+    medications = medication_search_cache.get_or_set(
+        ('intervals', term.lower(), medication_type), load_medications
+    )
+    
+    # ✅ PRÓXIMA DATA PERMITIDA: UMA CONSULTA PARA TODOS OS MEDICAMENTOS COM INTERVALO
+    next_dates = {}
+    if patient_id:
+        interval_ids = [med['id'] for med in medications if med['has_interval_control']]
+        if interval_ids:
+            controls = DispensationControl.query.filter(
+                DispensationControl.patient_id == patient_id,
+                DispensationControl.medication_id.in_(interval_ids),
+                DispensationControl.is_active == True
+            ).order_by(desc(DispensationControl.last_dispensation_date)).all()
+            for control in controls:
+                next_dates.setdefault(control.medication_id, control.next_allowed_date)
+    
+    results = []
+    for med in medications:
+        # Dados básicos do medicamento
+        med_data = dict(med)
         
         # Verificar controle de intervalo se paciente especificado
-        if patient_id and med.has_interval_control:
-            can_dispense = med.can_dispense_to_patient(patient_id)
-            next_date = med.get_next_allowed_date_for_patient(patient_id)
+        if patient_id and med['has_interval_control']:
+            # Sem controle ativo = primeira dispensação, pode dispensar hoje
+            next_date = next_dates.get(med['id']) or date.today()
+            can_dispense = date.today() >= next_date
             
             med_data.update({
                 'can_dispense': can_dispense,
@@ -3447,7 +3204,7 @@ def high_cost_new():
     
     if search_term:
         # Usar busca integrada
-        local_results, esus_results = Patient.search_integrated(search_term)
+        local_results, esus_results = PatientSearchService.search_integrated(search_term, limit=10)
         local_patients = local_results[:10]  # Limitar a 10
         
         # Se não encontrou no local, mostrar do e-SUS
@@ -3555,31 +3312,120 @@ def reports_generate():
         gender = None
         registration_period = None
     
+    if report_type not in RUNNABLE_REPORT_TYPES:
+        flash('Tipo de relatório inválido.', 'error')
+        return redirect(url_for('main.reports_index'))
+    
+    params = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'age_range': age_range,
+        'gender': gender,
+        'registration_period': registration_period
+    }
+    
     try:
-        if report_type == 'consumption':
-            return generate_consumption_report(start_date, end_date, format_type)
-        elif report_type == 'stock':
-            return generate_stock_report(format_type)
-        elif report_type == 'expiry':
-            return generate_expiry_report(format_type)
-        elif report_type == 'high_cost':
-            return generate_high_cost_report(start_date, end_date, format_type)
-        elif report_type == 'dispensations':
-            return generate_dispensations_report(start_date, end_date, format_type)
-        elif report_type == 'patients':
-            return generate_patients_report(format_type, age_range, gender, registration_period)
-        elif report_type == 'financial':
-            return generate_financial_report(start_date, end_date, format_type)
-        elif report_type == 'esus_integration':  # ✅ NOVO RELATÓRIO E-SUS
-            return generate_esus_integration_report(format_type)
-        else:
-            flash('Tipo de relatório inválido.', 'error')
-            return redirect(url_for('main.reports_index'))
+        # ✅ ARQUIVOS (PDF/EXCEL/CSV) NA FILA: a requisição responde na hora
+        if format_type != 'html' and current_app.config.get('REPORT_JOBS_ENABLED', True):
+            job = report_job_queue.submit(report_type, format_type, params, current_user.id)
+            return redirect(url_for('main.report_job_view', job_id=job.id))
+        
+        return run_report(report_type, format_type, **params)
     
     except Exception as e:
         flash(f'Erro ao gerar relatório: {str(e)}', 'error')
         return redirect(url_for('main.reports_index'))
 
+RUNNABLE_REPORT_TYPES = (
+    'consumption', 'stock', 'expiry', 'high_cost', 'dispensations',
+    'patients', 'financial', 'esus_integration'
+)
+
+def run_report(report_type, format_type, **params):
+    """
+    Gerar o relatório (requisição ou fila em segundo plano)
+    
+    Arquivos (PDF/Excel) vêm do cache quando os dados de origem não mudaram.
+    """
+    if format_type == 'html':
+        return dispatch_report(report_type, format_type, **params)
+    return cached_report(report_type, format_type, params,
+                         lambda: dispatch_report(report_type, format_type, **params))
+
+def dispatch_report(report_type, format_type, start_date=None, end_date=None,
+                    age_range=None, gender=None, registration_period=None):
+    """Despachar para o generate_*_report"""
+    if report_type == 'consumption':
+        return generate_consumption_report(start_date, end_date, format_type)
+    elif report_type == 'stock':
+        return generate_stock_report(format_type)
+    elif report_type == 'expiry':
+        return generate_expiry_report(format_type)
+    elif report_type == 'high_cost':
+        return generate_high_cost_report(start_date, end_date, format_type)
+    elif report_type == 'dispensations':
+        return generate_dispensations_report(start_date, end_date, format_type)
+    elif report_type == 'patients':
+        return generate_patients_report(format_type, age_range, gender, registration_period)
+    elif report_type == 'financial':
+        return generate_financial_report(start_date, end_date, format_type)
+    elif report_type == 'esus_integration':  # ✅ NOVO RELATÓRIO E-SUS
+        return generate_esus_integration_report(format_type)
+    raise ValueError(f'Tipo de relatório inválido: {report_type}')
+
+# ✅ RELATÓRIOS EM SEGUNDO PLANO (progresso e download)
+def get_report_job_or_none(job_id):
+    """Job do usuário atual (administradores veem todos)"""
+    job = db.session.get(ReportJob, job_id)
+    if job is None:
+        return None
+    if job.user_id != current_user.id and current_user.role.value != 'admin':
+        return None
+    return job
+
+@main.route('/reports/jobs/<job_id>')
+@staff_required
+def report_job_view(job_id):
+    """Página de acompanhamento do relatório"""
+    job = get_report_job_or_none(job_id)
+    if job is None:
+        flash('Relatório não encontrado.', 'error')
+        return redirect(url_for('main.reports_index'))
+    
+    report_names = dict(REPORT_TYPES)
+    return render_template('reports/job.html', job=job,
+                         report_name=report_names.get(job.report_type, job.report_type))
+
+@main.route('/reports/jobs/<job_id>/status')
+@staff_required
+def report_job_status(job_id):
+    """Progresso do relatório (consultado pela página a cada poucos segundos)"""
+    job = get_report_job_or_none(job_id)
+    if job is None:
+        return jsonify({'error': 'Relatório não encontrado'}), 404
+    
+    data = job.to_dict()
+    data['download_url'] = (
+        url_for('main.report_job_download', job_id=job.id)
+        if report_job_queue.file_available(job) else None
+    )
+    return jsonify(data)
+
+@main.route('/reports/jobs/<job_id>/download')
+@staff_required
+def report_job_download(job_id):
+    """Baixar o arquivo gerado (até expirar)"""
+    job = get_report_job_or_none(job_id)
+    if job is None or not report_job_queue.file_available(job):
+        flash('Arquivo do relatório não encontrado ou expirado.', 'error')
+        return redirect(url_for('main.reports_index'))
+    
+    log_action('DOWNLOAD', 'report_jobs', None, new_values={
+        'job_id': job.id, 'report_type': job.report_type, 'format_type': job.format_type
+    })
+    return send_file(job.file_path, as_attachment=True,
+                     download_name=job.file_name, mimetype=job.mimetype)
+
 # ✅ NOVO RELATÓRIO DE INTEGRAÇÃO E-SUS
 def generate_esus_integration_report(format_type):
     """Relatório de integração e-SUS"""
@@ -3648,24 +3494,8 @@ def generate_esus_integration_report(format_type):
 
 def generate_consumption_report(start_date, end_date, format_type):
     """Relatório de consumo - APENAS DADOS REAIS"""
-    query = db.session.query(
-        Medication.commercial_name,
-        Medication.generic_name,
-        Medication.dosage,
-        func.sum(DispensationItem.quantity_dispensed).label('total_dispensed'),
-        func.count(DispensationItem.id).label('dispensations_count'),
-        func.sum(DispensationItem.total_cost).label('total_cost')
-    ).join(DispensationItem).join(Dispensation)
-    
-    if start_date:
-        query = query.filter(Dispensation.dispensation_date >= start_date)
-    if end_date:
-        query = query.filter(Dispensation.dispensation_date <= end_date)
-    
-    data = query.group_by(
-        Medication.id, Medication.commercial_name, 
-        Medication.generic_name, Medication.dosage
-    ).order_by(desc('total_dispensed')).all()
+    # ✅ Agregados diários (dia x medicamento) em vez dos itens brutos
+    data = DispensationRollups.consumption(start_date, end_date)
     
     if format_type == 'html':
         return render_template('reports/consumption.html', data=data, 
@@ -3787,6 +3617,10 @@ def generate_high_cost_report(start_date, end_date, format_type):
 
 def generate_dispensations_report(start_date, end_date, format_type):
     """Relatório de dispensações - APENAS DADOS REAIS"""
+    # ✅ EXCEL/CSV EM STREAMING (sem carregar o período inteiro em memória)
+    if format_type in ('excel', 'csv'):
+        return stream_dispensations_export(start_date, end_date, format_type)
+    
     query = Dispensation.query.options(
         joinedload(Dispensation.patient),
         joinedload(Dispensation.dispenser),
@@ -3796,7 +3630,7 @@ def generate_dispensations_report(start_date, end_date, format_type):
     if start_date:
         query = query.filter(Dispensation.dispensation_date >= start_date)
     if end_date:
-        query = query.filter(Dispensation.dispensation_date <= end_date)
+        query = query.filter(Dispensation.dispensation_date < end_date + timedelta(days=1))
     
     dispensations = query.order_by(desc(Dispensation.dispensation_date)).all()
     
@@ -3813,8 +3647,6 @@ def generate_dispensations_report(start_date, end_date, format_type):
                              end_date=end_date)
     elif format_type == 'pdf':
         return generate_dispensations_pdf(dispensations, total_cost, total_items, start_date, end_date)
-    elif format_type == 'excel':
-        return generate_dispensations_excel(dispensations, total_cost, total_items, start_date, end_date)
 
 # =================== APIS CORRIGIDAS PARA RELATÓRIO ===================
 
@@ -3890,8 +3722,8 @@ def api_patients_datatable():
         # ✅ BUSCA GLOBAL
         if search_value:
             search_filter = or_(
-                Patient.full_name.ilike(f'%{search_value}%'),
-                Patient.cpf.like(f'%{search_value}%'),
+                PatientSearchService.filter_clause(search_value, 'name'),
+                PatientSearchService.filter_clause(search_value, 'cpf'),
                 Patient.city.ilike(f'%{search_value}%')
             )
             query = query.filter(search_filter)
@@ -3961,74 +3793,29 @@ def api_patients_datatable():
 @main.route('/api/patients/charts')
 @staff_required
 def api_patients_charts():
-    """✅ API para dados dos gráficos CORRIGIDA"""
+    """✅ API para dados dos gráficos (agregação no banco)"""
     try:
-        # ✅ DADOS DE GÊNERO
-        gender_counts = {'M': 0, 'F': 0, 'O': 0, 'N': 0}
-        
-        # Buscar todos os gêneros dos pacientes ativos
-        patients = Patient.query.filter_by(is_active=True).all()
-        
-        for patient in patients:
-            if patient.gender:
-                gender_counts[patient.gender] = gender_counts.get(patient.gender, 0) + 1
-            else:
-                gender_counts['N'] += 1  # Não informado
-        
+        # ✅ DADOS DE GÊNERO (GROUP BY gender)
+        gender_counts = PatientStatsService.gender_counts()
         gender_data = {
-            'labels': ['Masculino', 'Feminino', 'Outro', 'Não informar'],
-            'values': [gender_counts['M'], gender_counts['F'], gender_counts['O'], gender_counts['N']]
+            'labels': [label for _, label in GENDER_LABELS],
+            'values': [gender_counts[code] for code, _ in GENDER_LABELS]
         }
         
-        # ✅ DADOS DE IDADE
-        age_groups = {'0-18': 0, '19-30': 0, '31-50': 0, '51-65': 0, '65+': 0}
-        
-        for patient in patients:
-            age = patient.age
-            if age <= 18:
-                age_groups['0-18'] += 1
-            elif age <= 30:
-                age_groups['19-30'] += 1
-            elif age <= 50:
-                age_groups['31-50'] += 1
-            elif age <= 65:
-                age_groups['51-65'] += 1
-            else:
-                age_groups['65+'] += 1
-        
+        # ✅ DADOS DE IDADE (CASE sobre birth_date)
+        age_groups = PatientStatsService.age_counts()
         age_data = {
             'labels': list(age_groups.keys()),
             'values': list(age_groups.values())
         }
         
-        # ✅ DADOS DE CADASTROS POR MÊS (últimos 6 meses)
+        # ✅ DADOS DE CADASTROS POR MÊS (últimos 6 meses, uma consulta)
+        registrations = PatientStatsService.monthly_registrations(months=6)
         registration_data = {
-            'labels': [],
-            'values': []
+            'labels': [month_start.strftime('%b') for month_start, _ in registrations],
+            'values': [count for _, count in registrations]
         }
         
-        for i in range(5, -1, -1):
-            # Calcular início e fim do mês
-            target_date = datetime.now() - timedelta(days=i*30)
-            month_start = target_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            
-            if i == 0:
-                month_end = datetime.now()
-            else:
-                next_month = month_start.replace(month=month_start.month + 1) if month_start.month < 12 else month_start.replace(year=month_start.year + 1, month=1)
-                month_end = next_month
-            
-            count = Patient.query.filter(
-                and_(
-                    Patient.created_at >= month_start,
-                    Patient.created_at < month_end,
-                    Patient.is_active == True
-                )
-            ).count()
-            
-            registration_data['labels'].append(month_start.strftime('%b'))
-            registration_data['values'].append(count)
-        
         return jsonify({
             'success': True,
             'gender_data': gender_data,
@@ -4049,37 +3836,17 @@ def api_patients_charts():
 @main.route('/api/patients/geographic')
 @staff_required
 def api_patients_geographic():
-    """✅ API para dados geográficos CORRIGIDA"""
+    """✅ API para dados geográficos (GROUP BY city/state no banco)"""
     try:
-        # ✅ DADOS POR CIDADE (usando Python para contar)
-        cities_count = {}
-        states_count = {}
-        
-        patients = Patient.query.filter_by(is_active=True).all()
-        
-        for patient in patients:
-            # Contar cidades
-            if patient.city:
-                cities_count[patient.city] = cities_count.get(patient.city, 0) + 1
-            
-            # Contar estados  
-            if patient.state:
-                states_count[patient.state] = states_count.get(patient.state, 0) + 1
-        
-        # Ordenar e pegar top 10
-        cities_data = []
-        for city, count in sorted(cities_count.items(), key=lambda x: x[1], reverse=True)[:10]:
-            cities_data.append({
-                'name': city,
-                'count': count
-            })
-        
-        states_data = []
-        for state, count in sorted(states_count.items(), key=lambda x: x[1], reverse=True)[:10]:
-            states_data.append({
-                'name': state,
-                'count': count
-            })
+        # ✅ TOP 10 CIDADES E ESTADOS
+        cities_data = [
+            {'name': city, 'count': count}
+            for city, count in PatientStatsService.top_values(Patient.city, limit=10)
+        ]
+        states_data = [
+            {'name': state, 'count': count}
+            for state, count in PatientStatsService.top_values(Patient.state, limit=10)
+        ]
         
         return jsonify({
             'success': True,
@@ -4099,12 +3866,12 @@ def api_patients_geographic():
 @main.route('/api/patients/stats')
 @staff_required
 def api_patients_stats():
-    """✅ API para estatísticas pré-calculadas CORRIGIDA"""
+    """✅ API para estatísticas pré-calculadas (uma consulta com SUM(CASE ...))"""
     try:
-        # ✅ BUSCAR TODOS OS PACIENTES ATIVOS DE UMA VEZ
-        patients = Patient.query.filter_by(is_active=True).all()
+        thirty_days_ago = datetime.now() - timedelta(days=30)
+        counts = PatientStatsService.completeness(thirty_days_ago)
         
-        total_patients = len(patients)
+        total_patients = counts['total']
         active_patients = total_patients
         
         if total_patients == 0:
@@ -4120,62 +3887,19 @@ def api_patients_stats():
                 'address_rate': 0
             })
         
-        # ✅ CALCULAR ESTATÍSTICAS COM PYTHON
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        new_patients_30 = 0
-        patients_with_cns = 0
-        contact_count = 0
-        address_count = 0
-        completeness_score = 0
-        
-        for patient in patients:
-            # Novos pacientes (30 dias)
-            if patient.created_at >= thirty_days_ago:
-                new_patients_30 += 1
-            
-            # Pacientes com CNS
-            if patient.cns and patient.cns.strip():
-                patients_with_cns += 1
-            
-            # Pacientes com dados de contato
-            if (patient.cell_phone or patient.home_phone or patient.contact_phone or 
-                patient.phone or patient.email):
-                contact_count += 1
-            
-            # Pacientes com endereço
-            if patient.address and patient.address.strip():
-                address_count += 1
-            
-            # Completude dos dados (6 campos principais)
-            score = 0
-            if patient.full_name and patient.full_name.strip():
-                score += 1
-            if patient.cpf and patient.cpf.strip():
-                score += 1
-            if patient.birth_date:
-                score += 1
-            if patient.gender:
-                score += 1
-            if (patient.cell_phone or patient.home_phone or patient.contact_phone or patient.phone):
-                score += 1
-            if patient.address and patient.address.strip():
-                score += 1
-            
-            completeness_score += score
-        
         # ✅ CALCULAR PERCENTUAIS
         max_score = total_patients * 6
-        completeness_rate = (completeness_score / max_score * 100) if max_score > 0 else 0
-        cns_rate = (patients_with_cns / total_patients * 100) if total_patients > 0 else 0
-        contact_rate = (contact_count / total_patients * 100) if total_patients > 0 else 0
-        address_rate = (address_count / total_patients * 100) if total_patients > 0 else 0
+        completeness_rate = counts['completeness_points'] / max_score * 100
+        cns_rate = counts['with_cns'] / total_patients * 100
+        contact_rate = counts['with_contact'] / total_patients * 100
+        address_rate = counts['with_address'] / total_patients * 100
         
         return jsonify({
             'success': True,
             'total_patients': total_patients,
             'active_patients': active_patients,
-            'new_patients_30': new_patients_30,
-            'patients_with_cns': patients_with_cns,
+            'new_patients_30': counts['new_30'],
+            'patients_with_cns': counts['with_cns'],
             'completeness_rate': round(completeness_rate, 1),
             'cns_rate': round(cns_rate, 1),
             'contact_rate': round(contact_rate, 1),
@@ -4197,6 +3921,60 @@ def api_patients_stats():
             'address_rate': 0
         }), 200
 
+def patients_report_query(age_range=None, gender=None, registration_period=None):
+    """Pacientes ativos com os filtros do relatório de pacientes"""
+    query = Patient.query.filter_by(is_active=True)
+    
+    # Aplicar filtros se especificados
+    if gender:
+        query = query.filter(Patient.gender == gender)
+    
+    if age_range:
+        current_year = datetime.now().year
+        if age_range == '0-18':
+            min_birth_year = current_year - 18
+            query = query.filter(extract('year', Patient.birth_date) >= min_birth_year)
+        elif age_range == '19-30':
+            min_birth_year = current_year - 30
+            max_birth_year = current_year - 19
+            query = query.filter(
+                and_(
+                    extract('year', Patient.birth_date) >= min_birth_year,
+                    extract('year', Patient.birth_date) <= max_birth_year
+                )
+            )
+        elif age_range == '31-50':
+            min_birth_year = current_year - 50
+            max_birth_year = current_year - 31
+            query = query.filter(
+                and_(
+                    extract('year', Patient.birth_date) >= min_birth_year,
+                    extract('year', Patient.birth_date) <= max_birth_year
+                )
+            )
+        elif age_range == '51-65':
+            min_birth_year = current_year - 65
+            max_birth_year = current_year - 51
+            query = query.filter(
+                and_(
+                    extract('year', Patient.birth_date) >= min_birth_year,
+                    extract('year', Patient.birth_date) <= max_birth_year
+                )
+            )
+        elif age_range == '65+':
+            max_birth_year = current_year - 65
+            query = query.filter(extract('year', Patient.birth_date) <= max_birth_year)
+    
+    if registration_period:
+        try:
+            days = int(registration_period)
+            cutoff_date = datetime.now() - timedelta(days=days)
+            query = query.filter(Patient.created_at >= cutoff_date)
+        except ValueError:
+            pass
+    
+    return query
+
 def generate_patients_report(format_type, age_range=None, gender=None, registration_period=None):
     """✅ RELATÓRIO DE PACIENTES OTIMIZADO - CORRIGIDO"""
     
@@ -4277,58 +4055,13 @@ def generate_patients_report(format_type, age_range=None, gender=None, registrat
                                  stats=stats)
     
     else:
-        # ✅ PARA PDF/EXCEL, CARREGA OS DADOS COMPLETOS (COM LIMITE)
-        query = Patient.query.filter_by(is_active=True)
+        query = patients_report_query(age_range, gender, registration_period)
         
-        # Aplicar filtros se especificados
-        if gender:
-            query = query.filter(Patient.gender == gender)
+        # ✅ EXCEL/CSV EM STREAMING: população inteira, memória constante
+        if format_type in ('excel', 'csv'):
+            return stream_patients_export(query.order_by(Patient.full_name), format_type)
         
-        if age_range:
-            current_year = datetime.now().year
-            if age_range == '0-18':
-                min_birth_year = current_year - 18
-                query = query.filter(extract('year', Patient.birth_date) >= min_birth_year)
-            elif age_range == '19-30':
-                min_birth_year = current_year - 30
-                max_birth_year = current_year - 19
-                query = query.filter(
-                    and_(
-                        extract('year', Patient.birth_date) >= min_birth_year,
-                        extract('year', Patient.birth_date) <= max_birth_year
-                    )
-                )
-            elif age_range == '31-50':
-                min_birth_year = current_year - 50
-                max_birth_year = current_year - 31
-                query = query.filter(
-                    and_(
-                        extract('year', Patient.birth_date) >= min_birth_year,
-                        extract('year', Patient.birth_date) <= max_birth_year
-                    )
-                )
-            elif age_range == '51-65':
-                min_birth_year = current_year - 65
-                max_birth_year = current_year - 51
-                query = query.filter(
-                    and_(
-                        extract('year', Patient.birth_date) >= min_birth_year,
-                        extract('year', Patient.birth_date) <= max_birth_year
-                    )
-                )
-            elif age_range == '65+':
-                max_birth_year = current_year - 65
-                query = query.filter(extract('year', Patient.birth_date) <= max_birth_year)
-        
-        if registration_period:
-            try:
-                days = int(registration_period)
-                cutoff_date = datetime.now() - timedelta(days=days)
-                query = query.filter(Patient.created_at >= cutoff_date)
-            except ValueError:
-                pass
-        
-        # ✅ LIMITAR A 5000 REGISTROS PARA PDF/EXCEL
+        # ✅ PDF LIMITADO A 5000 REGISTROS
         patients = query.order_by(Patient.full_name).limit(5000).all()
         
         # Calcular estatísticas simples dos dados carregados
@@ -4358,24 +4091,12 @@ def generate_patients_report(format_type, age_range=None, gender=None, registrat
         
         if format_type == 'pdf':
             return generate_patients_pdf(patients, age_groups, esus_stats)
-        elif format_type == 'excel':
-            return generate_patients_excel(patients, age_groups, esus_stats)
 
 def generate_financial_report(start_date, end_date, format_type):
     """Relatório financeiro - APENAS DADOS REAIS"""
     
-    # Custos de dispensações básicas
-    dispensation_query = db.session.query(
-        func.sum(Dispensation.total_cost).label('total_basic_cost'),
-        func.count(Dispensation.id).label('total_dispensations')
-    ).filter(Dispensation.status == DispensationStatus.COMPLETED)
-    
-    if start_date:
-        dispensation_query = dispensation_query.filter(Dispensation.dispensation_date >= start_date)
-    if end_date:
-        dispensation_query = dispensation_query.filter(Dispensation.dispensation_date <= end_date)
-    
-    dispensation_stats = dispensation_query.first()
+    # Custos de dispensações básicas (✅ agregados diários)
+    dispensation_stats = DispensationRollups.completed_totals(start_date, end_date)
     
     # Valor do estoque atual
     stock_value = db.session.query(
@@ -4384,21 +4105,8 @@ def generate_financial_report(start_date, end_date, format_type):
         and_(Medication.is_active == True, Medication.unit_cost.isnot(None))
     ).scalar() or 0
     
-    # Custos por medicamento
-    medication_costs = db.session.query(
-        Medication.commercial_name,
-        func.sum(DispensationItem.total_cost).label('total_cost'),
-        func.sum(DispensationItem.quantity_dispensed).label('total_quantity')
-    ).join(DispensationItem).join(Dispensation)
-    
-    if start_date:
-        medication_costs = medication_costs.filter(Dispensation.dispensation_date >= start_date)
-    if end_date:
-        medication_costs = medication_costs.filter(Dispensation.dispensation_date <= end_date)
-    
-    medication_costs = medication_costs.group_by(
-        Medication.id, Medication.commercial_name
-    ).order_by(desc('total_cost')).limit(20).all()
+    # Custos por medicamento (✅ agregados diários)
+    medication_costs = DispensationRollups.medication_costs(start_date, end_date, limit=20)
     
     if format_type == 'html':
         return render_template('reports/financial.html',
@@ -4449,7 +4157,7 @@ def dispensations_report():
     if start_date:
         query = query.filter(Dispensation.dispensation_date >= start_date)
     if end_date:
-        query = query.filter(Dispensation.dispensation_date <= end_date)
+        query = query.filter(Dispensation.dispensation_date < end_date + timedelta(days=1))
     if pharmacist_id:
         query = query.filter(Dispensation.dispenser_id == pharmacist_id)
     
@@ -4472,8 +4180,6 @@ def dispensations_report():
     
     # ✅ PROCESSAR DISPENSAÇÕES SE EXISTIREM
     if dispensations:
-        from collections import defaultdict
-        
         # ✅ PROCESSAR CADA DISPENSAÇÃO
         for dispensation in dispensations:
             # Processar itens da dispensação
@@ -4494,42 +4200,16 @@ def dispensations_report():
                 
                 dispensation_items.append(dispensation_obj)
         
-        # ✅ CALCULAR DADOS DO GRÁFICO POR DIA
-        daily_counts = defaultdict(int)
-        for dispensation in dispensations:
-            # Usar apenas DD/MM para o gráfico
-            date_key = dispensation.dispensation_date.strftime('%d/%m')
-            daily_counts[date_key] += 1
-        
-        # ✅ ORDENAR DATAS CORRETAMENTE
-        if daily_counts:
-            # Tentar ordenar cronologicamente
-            try:
-                current_year = datetime.now().year
-                sorted_dates = sorted(daily_counts.keys(), 
-                    key=lambda x: datetime.strptime(f"{x}/{current_year}", '%d/%m/%Y'))
-            except:
-                # Fallback: ordenar alfabeticamente
-                sorted_dates = sorted(daily_counts.keys())
-            
-            chart_dates = sorted_dates
-            chart_dispensations = [daily_counts[date] for date in sorted_dates]
+        # ✅ GRÁFICO POR DIA (agregados diários, já em ordem cronológica)
+        daily_counts = DispensationRollups.daily_counts(start_date, end_date, pharmacist_id)
+        chart_dates = [day.strftime('%d/%m') for day, _ in daily_counts]
+        chart_dispensations = [int(count) for _, count in daily_counts]
         
-        # ✅ CALCULAR TOP MEDICAMENTOS
-        medication_counts = defaultdict(int)
-        for dispensation in dispensations:
-            for item in dispensation.items:
-                if item.medication and item.medication.commercial_name:
-                    # Limitar o nome do medicamento para evitar labels muito grandes
-                    med_name = item.medication.commercial_name[:25]
-                    medication_counts[med_name] += item.quantity_dispensed
-        
-        # ✅ PEGAR TOP 10 MEDICAMENTOS
-        if medication_counts:
-            top_medications = sorted(medication_counts.items(), 
-                                   key=lambda x: x[1], reverse=True)[:10]
-            top_medications_labels = [med[0] for med in top_medications]
-            top_medications_data = [med[1] for med in top_medications]
+        # ✅ TOP 10 MEDICAMENTOS (agregados diários)
+        top_medications = DispensationRollups.top_medications(start_date, end_date, pharmacist_id, limit=10)
+        # Limitar o nome do medicamento para evitar labels muito grandes
+        top_medications_labels = [name[:25] for name, _ in top_medications]
+        top_medications_data = [int(quantity) for _, quantity in top_medications]
     
     unique_medications_count = len(unique_medications)
     
@@ -4729,7 +4409,7 @@ def admin_user_toggle_status(id):
 @admin_required
 def admin_audit_logs():
     """Logs de auditoria"""
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('before') or None
     action_filter = request.args.get('action', '')
     table_filter = request.args.get('table', '')
     user_filter = request.args.get('user', '', type=int)
@@ -4743,9 +4423,8 @@ def admin_audit_logs():
     if user_filter:
         query = query.filter(AuditLog.user_id == user_filter)
     
-    logs = query.order_by(desc(AuditLog.created_at)).paginate(
-        page=page, per_page=50, error_out=False
-    )
+    # ✅ PAGINAÇÃO POR CURSOR (SEM OFFSET) - registros antigos ficam nos arquivos de scripts/archive_logs.py
+    logs = audit_log_page(query, cursor)
     
     # Usuários para filtro
     users = User.query.filter_by(is_active=True).order_by(User.full_name).all()
@@ -4755,66 +4434,56 @@ def admin_audit_logs():
                          users=users,
                          action_filter=action_filter,
                          table_filter=table_filter,
-                         user_filter=user_filter)
+                         user_filter=user_filter,
+                         retention_months=current_app.config.get('LOG_RETENTION_MONTHS'))
 
 @main.route('/admin/system-info')
 @admin_required
 def admin_system_info():
     """Informações do sistema"""
-    import psutil
-    import platform
+    # ✅ Retrato coletado em segundo plano (sem cpu_percent(interval=1) nem contagens por requisição)
+    snapshot = status_sampler.snapshot()
+    sampled = snapshot['system']
     
     # Informações do sistema
     system_info = {
-        'platform': platform.platform(),
-        'python_version': platform.python_version(),
-        'cpu_percent': psutil.cpu_percent(interval=1),
-        'memory': psutil.virtual_memory(),
-        'disk': psutil.disk_usage('/'),
-        'uptime': datetime.now() - datetime.fromtimestamp(psutil.boot_time())
+        'platform': sampled['platform'],
+        'python_version': sampled['python_version'],
+        'cpu_percent': sampled['cpu_percent'],
+        'memory': sampled['memory'],
+        'disk': sampled['disk'],
+        'uptime': datetime.now() - sampled['boot_time'] if sampled['boot_time'] else None
     }
     
     # Estatísticas do banco
-    db_stats = {
-        'total_patients': Patient.query.count(),
-        'active_patients': Patient.query.filter_by(is_active=True).count(),
-        'total_medications': Medication.query.count(),
-        'active_medications': Medication.query.filter_by(is_active=True).count(),
-        'total_dispensations': Dispensation.query.count(),
-        'total_high_cost_processes': HighCostProcess.query.count(),
-        'total_users': User.query.count(),
-        'active_users': User.query.filter_by(is_active=True).count(),
-        # ✅ ESTATÍSTICAS E-SUS
-        'esus_imported_patients': Patient.query.filter_by(source='imported').count(),
-        'esus_synced_patients': Patient.query.filter(Patient.esus_sync_date.isnot(None)).count()
-    }
+    db_stats = dict(snapshot['db'] or {})
+    last_sync = db_stats.pop('esus_last_sync', None)
     
     # ✅ STATUS E-SUS
     esus_status = {
-        'configured': get_esus_db_credentials() is not None,
-        'connected': False,
-        'last_sync': None
+        'configured': snapshot['esus']['configured'],
+        'connected': snapshot['esus']['connected'],
+        'last_sync': last_sync,
+        'circuit': esus_breaker.stats()
     }
     
-    if esus_status['configured']:
-        success, _ = test_esus_connection()
-        esus_status['connected'] = success
-        
-        # Última sincronização
-        last_sync_patient = Patient.query.filter(
-            Patient.esus_sync_date.isnot(None)
-        ).order_by(desc(Patient.esus_sync_date)).first()
-        
-        if last_sync_patient:
-            esus_status['last_sync'] = last_sync_patient.esus_sync_date
-    
     return render_template('admin/system_info.html', 
                          system_info=system_info,
                          db_stats=db_stats,
                          esus_status=esus_status,
+                         snapshot_age=snapshot['age_seconds'],
                          current_time=datetime.now(),
                          current_date=date.today())
 
+@main.route('/admin/cache-stats')
+@admin_required
+def admin_cache_stats():
+    """Acertos/falhas dos caches em memória deste processo"""
+    return jsonify({
+        'success': True,
+        'caches': all_cache_stats()
+    })
+
 @main.route('/dispensation/search-patient-birthdate', methods=['POST'])
 @login_required
 def dispensation_search_patient_birthdate():
@@ -4944,32 +4613,35 @@ def api_medications_search():
     if len(term) < 2:
         return jsonify([])
     
-    medications = Medication.query.filter(
-        and_(
-            Medication.is_active == True,
-            or_(
-                Medication.commercial_name.ilike(f'%{term}%'),
-                Medication.generic_name.ilike(f'%{term}%')
+    def load_medications():
+        medications = Medication.query.filter(
+            and_(
+                Medication.is_active == True,
+                or_(
+                    Medication.commercial_name.ilike(f'%{term}%'),
+                    Medication.generic_name.ilike(f'%{term}%')
+                )
             )
-        )
-    ).limit(20).all()
-    
-    results = []
-    for med in medications:
-        results.append({
-            'id': med.id,
-            'commercial_name': med.commercial_name,
-            'generic_name': med.generic_name,
-            'dosage': med.dosage,
-            'current_stock': med.current_stock,
-            'unit_cost': float(med.unit_cost) if med.unit_cost else None,
-            'requires_prescription': med.requires_prescription,
-            'controlled_substance': med.controlled_substance,
-            'has_calculation_config': med.has_dispensing_config,        # ✅ NOVO
-            'calculation_config_display': med.dispensing_config_display  # ✅ NOVO
-        })
+        ).limit(20).all()
+        
+        results = []
+        for med in medications:
+            results.append({
+                'id': med.id,
+                'commercial_name': med.commercial_name,
+                'generic_name': med.generic_name,
+                'dosage': med.dosage,
+                'current_stock': med.current_stock,
+                'unit_cost': float(med.unit_cost) if med.unit_cost else None,
+                'requires_prescription': med.requires_prescription,
+                'controlled_substance': med.controlled_substance,
+                'has_calculation_config': med.has_dispensing_config,        # ✅ NOVO
+                'calculation_config_display': med.dispensing_config_display  # ✅ NOVO
+            })
+        return results
     
-    return jsonify(results)
+    # ✅ CACHE DE AUTOCOMPLETE (INVALIDADO POR GRAVAÇÕES EM MEDICAMENTOS)
+    return jsonify(medication_search_cache.get_or_set(('search', term.lower()), load_medications))
 
 @main.route('/api/patients/search')
 @staff_required
@@ -4984,67 +4656,48 @@ def api_patients_search():
     results = []
     
     try:
-        # ✅ BUSCA LOCAL EXPANDIDA
-        query = Patient.query.filter(Patient.is_active == True)
-        
-        if term.isdigit():
-            # Busca por números (CPF, CNS, telefones)
-            query = query.filter(
-                or_(
-                    Patient.cpf.like(f'%{term}%'),
-                    Patient.cns.like(f'%{term}%'),
-                    Patient.cell_phone.like(f'%{term}%'),
-                    Patient.home_phone.like(f'%{term}%'),
-                    Patient.contact_phone.like(f'%{term}%')
-                )
-            )
-        else:
-            # ✅ BUSCA POR NOME, NOME DA MÃE OU EMAIL
-            query = query.filter(
-                or_(
-                    Patient.full_name.ilike(f'%{term}%'),
-                    Patient.mother_name.ilike(f'%{term}%'),
-                    Patient.email.ilike(f'%{term}%')
-                )
-            )
-        
-        local_patients = query.order_by(Patient.full_name).limit(10).all()
+        def load_local_results():
+            # ✅ BUSCA LOCAL EXPANDIDA (CPF/CNS, TELEFONES, DATA, EMAIL, NOME OU NOME DA MÃE)
+            local_results = []
+            for patient in PatientSearchService.search(term, limit=10):
+                primary_phone = PatientSearchService.primary_phone(patient)
+                
+                local_results.append({
+                    'id': patient.id,
+                    'name': patient.full_name,
+                    'cpf': format_cpf(patient.cpf),
+                    'cns': format_cns(patient.cns) if patient.cns else '',
+                    'age': PatientSearchService.age(patient),
+                    'phone': format_phone(primary_phone) if primary_phone else '',
+                    'mother_name': patient.mother_name or '',
+                    'source': PatientSearchService.source_display(patient),
+                    'type': 'local'
+                })
+            return local_results
         
-        # ✅ FORMATAR RESULTADOS LOCAIS
-        for patient in local_patients:
-            primary_phone = patient.cell_phone or patient.home_phone or patient.contact_phone
-            
-            results.append({
-                'id': patient.id,
-                'name': patient.full_name,
-                'cpf': format_cpf(patient.cpf),
-                'cns': format_cns(patient.cns) if patient.cns else '',
-                'age': patient.age,
-                'phone': format_phone(primary_phone) if primary_phone else '',
-                'mother_name': getattr(patient, 'mother_name', ''),
-                'source': getattr(patient, 'source_display', 'Local'),
-                'type': 'local'
-            })
+        # ✅ CACHE DE AUTOCOMPLETE (CHAVE = TERMO NORMALIZADO)
+        local_results = patient_search_cache.get_or_set(
+            PatientSearchService.cache_key(term, limit=10), load_local_results
+        )
+        results.extend(local_results)
         
         # ✅ BUSCA E-SUS SE SOLICITADO E SEM RESULTADOS LOCAIS
-        if include_esus and not local_patients:
+        if include_esus and not local_results:
             try:
-                # Usar busca integrada se disponível
-                if hasattr(Patient, 'search_integrated'):
-                    _, esus_results = Patient.search_integrated(term)
-                    
-                    for esus_patient in esus_results[:5]:
-                        results.append({
-                            'name': esus_patient.get('full_name'),
-                            'cpf': esus_patient.get('cpf'),
-                            'cns': esus_patient.get('cns', ''),
-                            'age': esus_patient.get('age'),
-                            'phone': esus_patient.get('primary_phone', ''),
-                            'mother_name': esus_patient.get('mother_name', ''),
-                            'source': 'e-SUS',
-                            'type': 'esus',
-                            'raw_data': esus_patient.get('raw_data')
-                        })
+                esus_results = PatientSearchService.search_esus(term)
+                
+                for esus_patient in esus_results[:5]:
+                    results.append({
+                        'name': esus_patient.get('full_name'),
+                        'cpf': esus_patient.get('cpf'),
+                        'cns': esus_patient.get('cns', ''),
+                        'age': esus_patient.get('age'),
+                        'phone': esus_patient.get('primary_phone', ''),
+                        'mother_name': esus_patient.get('mother_name', ''),
+                        'source': 'e-SUS',
+                        'type': 'esus',
+                        'raw_data': esus_patient.get('raw_data')
+                    })
             except Exception as e:
                 current_app.logger.warning(f"Erro na busca e-SUS: {e}")
         
@@ -5090,28 +4743,9 @@ def api_stock_alerts():
 @staff_required
 def api_dashboard_stats():
     """API para estatísticas do dashboard"""
-    today = date.today()
-    
-    stats = {
-        'today_dispensations': Dispensation.query.filter(
-            Dispensation.dispensation_date >= today
-        ).count(),
-        'total_patients': Patient.query.filter_by(is_active=True).count(),
-        'low_stock_medications': Medication.query.filter(
-            Medication.current_stock <= Medication.minimum_stock
-        ).count(),
-        'pending_evaluations': HighCostProcess.query.filter_by(
-            status=ProcessStatus.PENDING
-        ).count() if has_permission('evaluate_high_cost') else 0,
-        # ✅ ESTATÍSTICAS E-SUS
-        'esus_imported_today': Patient.query.filter(
-            and_(
-                Patient.source == 'imported',
-                Patient.created_at >= today
-            )
-        ).count(),
-        'esus_connection_status': test_esus_connection()[0] if get_esus_db_credentials() else False
-    }
+    stats = DashboardStatsService.api_stats(include_evaluations=has_permission('evaluate_high_cost'))
+    # ✅ STATUS E-SUS
+    stats['esus_connection_status'] = status_sampler.snapshot()['esus']['connected']
     
     return jsonify(stats)
 
@@ -5151,28 +4785,7 @@ def api_patients_list():
         
         # ✅ APLICAR BUSCA GLOBAL
         if search_value:
-            if search_type == 'name':
-                query = query.filter(Patient.full_name.ilike(f'%{search_value}%'))
-            elif search_type == 'cpf':
-                clean_cpf = re.sub(r'[^0-9]', '', search_value)
-                query = query.filter(Patient.cpf.like(f'%{clean_cpf}%'))
-            elif search_type == 'cns':
-                clean_cns = re.sub(r'[^0-9]', '', search_value)
-                query = query.filter(Patient.cns.like(f'%{clean_cns}%'))
-            elif search_type == 'phone':
-                clean_phone = re.sub(r'[^0-9]', '', search_value)
-                query = query.filter(
-                    or_(
-                        Patient.cell_phone.like(f'%{clean_phone}%'),
-                        Patient.home_phone.like(f'%{clean_phone}%'),
-                        Patient.contact_phone.like(f'%{clean_phone}%'),
-                        Patient.phone.like(f'%{clean_phone}%')
-                    )
-                )
-            elif search_type == 'email':
-                query = query.filter(Patient.email.ilike(f'%{search_value}%'))
-            elif search_type == 'mother':
-                query = query.filter(Patient.mother_name.ilike(f'%{search_value}%'))
+            query = query.filter(PatientSearchService.filter_clause(search_value, search_type))
         
         # ✅ TOTAL DE REGISTROS (SEM FILTROS)
         total_records = Patient.query.filter_by(is_active=True).count()
@@ -5338,21 +4951,20 @@ def after_request(response):
 @main.route('/health')
 def health_check():
     """Health check para monitoramento"""
-    # ✅ INCLUIR STATUS E-SUS
-    esus_configured = get_esus_db_credentials() is not None
-    esus_connected = False
-    
-    if esus_configured:
-        esus_connected, _ = test_esus_connection()
+    # ✅ INCLUIR STATUS E-SUS (último retrato do amostrador, sem abrir conexão)
+    snapshot = status_sampler.snapshot()
     
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
         'version': '1.0.0',
         'esus': {
-            'configured': esus_configured,
-            'connected': esus_connected
-        }
+            'configured': snapshot['esus']['configured'],
+            'connected': snapshot['esus']['connected'],
+            'circuit': esus_breaker.stats()['state']
+        },
+        'sampled_at': snapshot['sampled_at'].isoformat(),
+        'age_seconds': snapshot['age_seconds']
     })
 
 @main.route('/robots.txt')
@@ -5395,12 +5007,13 @@ def format_process_status(status):
 # ✅ NOVAS FUNÇÕES PARA E-SUS
 def get_esus_integration_stats():
     """Obter estatísticas de integração e-SUS"""
+    patients = DashboardStatsService.section('patients')
     return {
-        'total_patients': Patient.query.filter_by(is_active=True).count(),
-        'local_patients': Patient.query.filter_by(source='local').count(),
-        'imported_patients': Patient.query.filter_by(source='imported').count(),
-        'synced_patients': Patient.query.filter(Patient.esus_sync_date.isnot(None)).count(),
-        'connection_status': test_esus_connection()[0] if get_esus_db_credentials() else False
+        'total_patients': patients['active'],
+        'local_patients': patients['local'],
+        'imported_patients': patients['imported'],
+        'synced_patients': patients['synced'],
+        'connection_status': status_sampler.snapshot()['esus']['connected']
     }
 
 # Registrar funções nos templates
@@ -5422,31 +5035,18 @@ def utility_processor():
 
 def generate_high_cost_pdf(processes, stats, start_date, end_date):
     """Gerar PDF do relatório de alto custo"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
     # Título
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=1  # Center
-    )
-    
-    title = Paragraph("Relatório de Processos Alto Custo", title_style)
-    story.append(title)
+    document.centered_title("Relatório de Processos Alto Custo")
     
     # Período
     if start_date and end_date:
-        period = Paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}", styles['Normal'])
-        story.append(period)
-        story.append(Spacer(1, 12))
+        document.paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}")
+        document.spacer(12)
     
     # Estatísticas
-    stats_data = [
+    document.table([
         ['Estatística', 'Valor'],
         ['Total de Processos', str(stats['total'])],
         ['Aprovados', str(stats['approved'])],
@@ -5454,22 +5054,8 @@ def generate_high_cost_pdf(processes, stats, start_date, end_date):
         ['Pendentes', str(stats['pending'])],
         ['Em Avaliação', str(stats['under_evaluation'])],
         ['Dispensados', str(stats['dispensed'])]
-    ]
-    
-    stats_table = Table(stats_data)
-    stats_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 14),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(stats_table)
-    story.append(Spacer(1, 12))
+    ], header_size=14, header_padding=12, body='beige')
+    document.spacer(12)
     
     # Tabela de processos
     if processes:
@@ -5484,84 +5070,35 @@ def generate_high_cost_pdf(processes, stats, start_date, end_date):
                 format_date(process.request_date)
             ])
         
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(table)
+        document.table(data, header_size=10, header_padding=12, body='beige', body_size=8)
     
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_alto_custo_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_alto_custo_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_financial_pdf(dispensation_stats, stock_value, medication_costs, start_date, end_date):
     """Gerar PDF do relatório financeiro"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
     # Título
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=1
-    )
-    
-    title = Paragraph("Relatório Financeiro", title_style)
-    story.append(title)
+    document.centered_title("Relatório Financeiro")
     
     # Período
     if start_date and end_date:
-        period = Paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}", styles['Normal'])
-        story.append(period)
-        story.append(Spacer(1, 12))
+        document.paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}")
+        document.spacer(12)
     
     # Resumo financeiro
-    financial_data = [
+    document.table([
         ['Indicador', 'Valor'],
         ['Total Dispensado', f"R$ {dispensation_stats.total_basic_cost or 0:,.2f}"],
         ['Número de Dispensações', str(dispensation_stats.total_dispensations or 0)],
         ['Valor do Estoque', f"R$ {stock_value:,.2f}"]
-    ]
-    
-    financial_table = Table(financial_data)
-    financial_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 14),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(financial_table)
-    story.append(Spacer(1, 12))
+    ], header_size=14, header_padding=12, body='beige')
+    document.spacer(12)
     
     # Top medicamentos por custo
     if medication_costs:
-        subtitle = Paragraph("Top Medicamentos por Custo", styles['Heading2'])
-        story.append(subtitle)
-        story.append(Spacer(1, 12))
+        document.paragraph("Top Medicamentos por Custo", 'Heading2')
+        document.spacer(12)
         
         med_data = [['Medicamento', 'Custo Total', 'Quantidade']]
         
@@ -5572,46 +5109,20 @@ def generate_financial_pdf(dispensation_stats, stock_value, medication_costs, st
                 str(med.total_quantity)
             ])
         
-        med_table = Table(med_data)
-        med_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(med_table)
+        document.table(med_data, header_size=10, header_padding=12, body='beige', body_size=8)
     
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_financeiro_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_financeiro_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_stock_pdf(medications, total_value):
     """Gerar PDF do relatório de estoque"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
-    title = Paragraph("Relatório de Estoque", styles['Title'])
-    story.append(title)
-    story.append(Spacer(1, 12))
+    document.title("Relatório de Estoque")
+    document.spacer(12)
     
     # Resumo
-    summary = Paragraph(f"Valor Total do Estoque: R$ {total_value:,.2f}", styles['Heading2'])
-    story.append(summary)
-    story.append(Spacer(1, 12))
+    document.paragraph(f"Valor Total do Estoque: R$ {total_value:,.2f}", 'Heading2')
+    document.spacer(12)
     
     # Tabela de medicamentos
     data = [['Medicamento', 'Estoque Atual', 'Estoque Mínimo', 'Valor Unitário', 'Valor Total']]
@@ -5626,46 +5137,21 @@ def generate_stock_pdf(medications, total_value):
             f"R$ {valor_total:.2f}"
         ])
     
-    table = Table(data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 8)
-    ]))
-    
-    story.append(table)
-    doc.build(story)
-    buffer.seek(0)
+    document.table(data, header_size=10, header_padding=12, body='beige', body_size=8)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_estoque_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_estoque_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_expiry_pdf(near_expiry, expired):
     """Gerar PDF do relatório de vencimentos"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
-    title = Paragraph("Relatório de Vencimentos", styles['Title'])
-    story.append(title)
-    story.append(Spacer(1, 12))
+    document.title("Relatório de Vencimentos")
+    document.spacer(12)
     
     # Medicamentos vencidos
     if expired:
-        subtitle = Paragraph("Medicamentos Vencidos", styles['Heading2'])
-        story.append(subtitle)
-        story.append(Spacer(1, 12))
+        document.paragraph("Medicamentos Vencidos", 'Heading2')
+        document.spacer(12)
         
         data = [['Medicamento', 'Lote', 'Data de Vencimento', 'Estoque']]
         for med in expired:
@@ -5676,25 +5162,13 @@ def generate_expiry_pdf(near_expiry, expired):
                 str(med.current_stock)
             ])
         
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.red),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(table)
-        story.append(Spacer(1, 12))
+        document.table(data, header='red', header_size=10, body_size=8)
+        document.spacer(12)
     
     # Medicamentos próximos ao vencimento
     if near_expiry:
-        subtitle = Paragraph("Próximos ao Vencimento (30 dias)", styles['Heading2'])
-        story.append(subtitle)
-        story.append(Spacer(1, 12))
+        document.paragraph("Próximos ao Vencimento (30 dias)", 'Heading2')
+        document.spacer(12)
         
         data = [['Medicamento', 'Lote', 'Data de Vencimento', 'Dias Restantes', 'Estoque']]
         for med in near_expiry:
@@ -5707,44 +5181,20 @@ def generate_expiry_pdf(near_expiry, expired):
                 str(med.current_stock)
             ])
         
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.orange),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(table)
-    
-    doc.build(story)
-    buffer.seek(0)
+        document.table(data, header='orange', header_size=10, body_size=8)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_vencimentos_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_vencimentos_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_consumption_pdf(data, start_date, end_date):
     """Gerar PDF do relatório de consumo"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
-    title = Paragraph("Relatório de Consumo de Medicamentos", styles['Title'])
-    story.append(title)
+    document.title("Relatório de Consumo de Medicamentos")
     
     if start_date and end_date:
-        period = Paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}", styles['Normal'])
-        story.append(period)
+        document.paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}")
     
-    story.append(Spacer(1, 12))
+    document.spacer(12)
     
     # Tabela de consumo
     table_data = [['Medicamento', 'Genérico', 'Dosagem', 'Quantidade', 'Dispensações', 'Custo Total']]
@@ -5759,46 +5209,22 @@ def generate_consumption_pdf(data, start_date, end_date):
             f"R$ {item.total_cost:.2f}" if item.total_cost else "R$ 0,00"
         ])
     
-    table = Table(table_data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 9),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 8)
-    ]))
-    
-    story.append(table)
-    doc.build(story)
-    buffer.seek(0)
+    document.table(table_data, header_size=9, body_size=8)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_consumo_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_consumo_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_dispensations_pdf(dispensations, total_cost, total_items, start_date, end_date):
     """Gerar PDF do relatório de dispensações"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
-    title = Paragraph("Relatório de Dispensações", styles['Title'])
-    story.append(title)
+    document.title("Relatório de Dispensações")
     
     if start_date and end_date:
-        period = Paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}", styles['Normal'])
-        story.append(period)
+        document.paragraph(f"Período: {format_date(start_date)} a {format_date(end_date)}")
     
     # Resumo
-    summary = Paragraph(f"Total de Dispensações: {len(dispensations)} | Itens Dispensados: {total_items} | Custo Total: R$ {total_cost:.2f}", styles['Heading3'])
-    story.append(summary)
-    story.append(Spacer(1, 12))
+    document.paragraph(f"Total de Dispensações: {len(dispensations)} | Itens Dispensados: {total_items} | Custo Total: R$ {total_cost:.2f}", 'Heading3')
+    document.spacer(12)
     
     # Tabela de dispensações
     table_data = [['Data', 'Paciente', 'Atendente', 'Itens', 'Custo']]
@@ -5812,63 +5238,31 @@ def generate_dispensations_pdf(dispensations, total_cost, total_items, start_dat
             f"R$ {disp.total_cost:.2f}" if disp.total_cost else "R$ 0,00"
         ])
     
-    table = Table(table_data)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 8)
-    ]))
-    
-    story.append(table)
-    doc.build(story)
-    buffer.seek(0)
+    document.table(table_data, header_size=10, body_size=8)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_dispensacoes_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_dispensacoes_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_patients_pdf(patients, age_groups, esus_stats=None):
     """Gerar PDF do relatório de pacientes"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
-    title = Paragraph("Relatório de Pacientes", styles['Title'])
-    story.append(title)
-    story.append(Spacer(1, 12))
+    document.title("Relatório de Pacientes")
+    document.spacer(12)
     
     # Estatísticas por idade
     age_data = [['Faixa Etária', 'Quantidade']]
     for age_range, count in age_groups.items():
         age_data.append([age_range, str(count)])
     
-    age_table = Table(age_data)
-    age_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(age_table)
-    story.append(Spacer(1, 12))
+    document.table(age_data)
+    document.spacer(12)
     
     # ✅ ESTATÍSTICAS E-SUS SE DISPONÍVEIS
     if esus_stats:
-        esus_title = Paragraph("Estatísticas e-SUS", styles['Heading2'])
-        story.append(esus_title)
-        story.append(Spacer(1, 6))
+        document.paragraph("Estatísticas e-SUS", 'Heading2')
+        document.spacer(6)
         
-        esus_data = [
+        document.table([
             ['Origem', 'Quantidade'],
             ['Cadastro Local', str(esus_stats['local_source'])],
             ['Importado do e-SUS', str(esus_stats['imported_source'])],
@@ -5876,19 +5270,8 @@ def generate_patients_pdf(patients, age_groups, esus_stats=None):
             ['Com CNS', str(esus_stats['with_cns'])],
             ['Com Nome da Mãe', str(esus_stats['with_mother_name'])],
             ['Múltiplos Telefones', str(esus_stats['with_multiple_phones'])]
-        ]
-        
-        esus_table = Table(esus_data)
-        esus_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        story.append(esus_table)
-        story.append(Spacer(1, 12))
+        ], header='lightblue', header_text='black')
+        document.spacer(12)
     
     # Lista de pacientes
     patient_data = [['Nome', 'CPF', 'Idade', 'Telefone', 'Origem']]
@@ -5902,42 +5285,20 @@ def generate_patients_pdf(patients, age_groups, esus_stats=None):
             patient.source_display[:10]
         ])
     
-    patient_table = Table(patient_data)
-    patient_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 9),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 7)
-    ]))
-    
-    story.append(patient_table)
-    doc.build(story)
-    buffer.seek(0)
+    document.table(patient_data, header_size=9, body_size=7)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_pacientes_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_pacientes_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 def generate_esus_integration_pdf(stats, quality_stats, recent_imports):
     """✅ GERAR PDF DO RELATÓRIO DE INTEGRAÇÃO E-SUS"""
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    styles = getSampleStyleSheet()
-    story = []
+    document = PdfDocument()
     
     # Título
-    title = Paragraph("Relatório de Integração e-SUS", styles['Title'])
-    story.append(title)
-    story.append(Spacer(1, 12))
+    document.title("Relatório de Integração e-SUS")
+    document.spacer(12)
     
     # Estatísticas gerais
-    general_data = [
+    document.table([
         ['Indicador', 'Valor'],
         ['Total de Pacientes', str(stats['total_patients'])],
         ['Pacientes Locais', str(stats['local_patients'])],
@@ -5945,27 +5306,14 @@ def generate_esus_integration_pdf(stats, quality_stats, recent_imports):
         ['Pacientes e-SUS Direto', str(stats['esus_patients'])],
         ['Sincronizados', str(stats['synced_patients'])],
         ['Com CNS', str(stats['patients_with_cns'])]
-    ]
-    
-    general_table = Table(general_data)
-    general_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(general_table)
-    story.append(Spacer(1, 12))
+    ], header='lightblue', header_text='black', header_size=12)
+    document.spacer(12)
     
     # Qualidade dos dados
-    quality_title = Paragraph("Qualidade dos Dados", styles['Heading2'])
-    story.append(quality_title)
-    story.append(Spacer(1, 6))
+    document.paragraph("Qualidade dos Dados", 'Heading2')
+    document.spacer(6)
     
-    quality_data = [
+    document.table([
         ['Indicador', 'Quantidade', 'Percentual'],
         ['Endereço Completo', str(quality_stats['complete_address']), 
          f"{(quality_stats['complete_address']/stats['total_patients']*100):.1f}%" if stats['total_patients'] > 0 else "0%"],
@@ -5973,25 +5321,13 @@ def generate_esus_integration_pdf(stats, quality_stats, recent_imports):
          f"{(quality_stats['with_phone']/stats['total_patients']*100):.1f}%" if stats['total_patients'] > 0 else "0%"],
         ['Info dos Pais', str(quality_stats['with_parents_info']), 
          f"{(quality_stats['with_parents_info']/stats['total_patients']*100):.1f}%" if stats['total_patients'] > 0 else "0%"]
-    ]
-    
-    quality_table = Table(quality_data)
-    quality_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgreen),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(quality_table)
-    story.append(Spacer(1, 12))
+    ], header='lightgreen', header_text='black')
+    document.spacer(12)
     
     # Importações recentes
     if recent_imports:
-        imports_title = Paragraph("Importações Recentes (30 dias)", styles['Heading2'])
-        story.append(imports_title)
-        story.append(Spacer(1, 6))
+        document.paragraph("Importações Recentes (30 dias)", 'Heading2')
+        document.spacer(6)
         
         imports_data = [['Nome', 'CPF', 'Data Importação']]
         
@@ -6002,28 +5338,9 @@ def generate_esus_integration_pdf(stats, quality_stats, recent_imports):
                 format_date(patient.created_at)
             ])
         
-        imports_table = Table(imports_data)
-        imports_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTSIZE', (0, 1), (-1, -1), 8)
-        ]))
-        
-        story.append(imports_table)
-    
-    doc.build(story)
-    buffer.seek(0)
+        document.table(imports_data, header_size=10, body_size=8)
     
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f'relatorio_integracao_esus_{datetime.now().strftime("%Y%m%d")}.pdf',
-        mimetype='application/pdf'
-    )
+    return pdf_response(document, f'relatorio_integracao_esus_{datetime.now().strftime("%Y%m%d")}.pdf')
 
 # =================== FUNÇÕES DE GERAÇÃO DE EXCEL ===================
 
@@ -6352,158 +5669,179 @@ def generate_consumption_excel(data, start_date, end_date):
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
 
-def generate_dispensations_excel(dispensations, total_cost, total_items, start_date, end_date):
-    """Gerar Excel do relatório de dispensações"""
-    output = BytesIO()
-    
-    dispensation_data = []
-    for disp in dispensations:
-        dispensation_data.append({
-            'ID': disp.id,
-            'Data': disp.dispensation_date.strftime('%d/%m/%Y'),
-            'Hora': disp.dispensation_date.strftime('%H:%M'),
-            'Paciente': disp.patient.full_name,
-            'CPF': format_cpf(disp.patient.cpf),
-            'Idade': disp.patient.age,
-            'Atendente': disp.dispenser.full_name,
-            'Número de Itens': len(disp.items),
-            'Custo Total': float(disp.total_cost) if disp.total_cost else 0,
-            'Status': disp.status.value if hasattr(disp.status, 'value') else str(disp.status),
-            'Observações': disp.observations[:100] + '...' if disp.observations and len(disp.observations) > 100 else (disp.observations or '')
-        })
-    
-    df = pd.DataFrame(dispensation_data)
+DISPENSATION_EXPORT_HEADER = [
+    'ID', 'Data', 'Hora', 'Paciente', 'CPF', 'Idade', 'Atendente',
+    'Número de Itens', 'Custo Total', 'Status', 'Observações'
+]
+
+def stream_dispensations_export(start_date, end_date, format_type):
+    """✅ Excel (write-only) ou CSV das dispensações do período, em streaming"""
+    items_count = db.session.query(func.count(DispensationItem.id)).filter(
+        DispensationItem.dispensation_id == Dispensation.id
+    ).correlate(Dispensation).scalar_subquery()
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Dispensações', index=False)
-        
-        # Resumo
-        summary = pd.DataFrame([
-            {'Indicador': 'Total de Dispensações', 'Valor': len(dispensations)},
-            {'Indicador': 'Total de Itens Dispensados', 'Valor': total_items},
-            {'Indicador': 'Custo Total', 'Valor': float(total_cost)},
-            {'Indicador': 'Custo Médio por Dispensação', 'Valor': float(total_cost) / len(dispensations) if dispensations else 0},
-            {'Indicador': 'Itens Médios por Dispensação', 'Valor': total_items / len(dispensations) if dispensations else 0},
-            {'Indicador': 'Período Início', 'Valor': start_date.strftime('%d/%m/%Y') if start_date else 'N/A'},
-            {'Indicador': 'Período Fim', 'Valor': end_date.strftime('%d/%m/%Y') if end_date else 'N/A'}
-        ])
-        summary.to_excel(writer, sheet_name='Resumo', index=False)
-        
-        # Ajustar larguras
-        for sheet_name in writer.sheets:
-            worksheet = writer.sheets[sheet_name]
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+    query = db.session.query(
+        Dispensation.id, Dispensation.dispensation_date, Dispensation.total_cost,
+        Dispensation.status, Dispensation.observations,
+        Patient.full_name.label('patient_name'), Patient.cpf, Patient.birth_date,
+        User.full_name.label('dispenser_name'), items_count.label('items_count')
+    ).join(Patient, Patient.id == Dispensation.patient_id).join(
+        User, User.id == Dispensation.dispenser_id
+    )
     
-    output.seek(0)
+    if start_date:
+        query = query.filter(Dispensation.dispensation_date >= start_date)
+    if end_date:
+        query = query.filter(Dispensation.dispensation_date < end_date + timedelta(days=1))
+    
+    query = query.order_by(desc(Dispensation.dispensation_date))
+    totals = {'dispensations': 0, 'items': 0, 'cost': Decimal('0.00')}
+    
+    def rows():
+        for row in iter_query(query):
+            totals['dispensations'] += 1
+            totals['items'] += row.items_count or 0
+            totals['cost'] += row.total_cost or 0
+            observations = row.observations or ''
+            yield [
+                row.id,
+                row.dispensation_date.strftime('%d/%m/%Y'),
+                row.dispensation_date.strftime('%H:%M'),
+                row.patient_name,
+                format_cpf(row.cpf),
+                calculate_age(row.birth_date),
+                row.dispenser_name,
+                row.items_count or 0,
+                float(row.total_cost) if row.total_cost else 0,
+                row.status.value if hasattr(row.status, 'value') else str(row.status),
+                observations[:100] + '...' if len(observations) > 100 else observations
+            ]
     
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f'relatorio_dispensacoes_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+    if format_type == 'csv':
+        return csv_response(export_filename('relatorio_dispensacoes', 'csv'), DISPENSATION_EXPORT_HEADER, rows())
+    
+    workbook = StreamingWorkbook()
+    workbook.add_sheet('Dispensações', DISPENSATION_EXPORT_HEADER, rows(),
+                       widths=[8, 12, 8, 40, 16, 8, 30, 10, 12, 12, 50])
+    
+    # Resumo com os totais acumulados durante o streaming
+    count = totals['dispensations']
+    workbook.add_sheet('Resumo', ['Indicador', 'Valor'], [
+        ['Total de Dispensações', count],
+        ['Total de Itens Dispensados', totals['items']],
+        ['Custo Total', float(totals['cost'])],
+        ['Custo Médio por Dispensação', float(totals['cost']) / count if count else 0],
+        ['Itens Médios por Dispensação', totals['items'] / count if count else 0],
+        ['Período Início', start_date.strftime('%d/%m/%Y') if start_date else 'N/A'],
+        ['Período Fim', end_date.strftime('%d/%m/%Y') if end_date else 'N/A']
+    ], widths=[35, 20])
+    
+    return workbook.response(export_filename('relatorio_dispensacoes', 'xlsx'))
+
+PATIENT_EXPORT_HEADER = [
+    'ID', 'Nome', 'CPF', 'CNS', 'Data Nascimento', 'Idade', 'Sexo',
+    'Telefone Principal', 'Telefone Residencial', 'Telefone Celular', 'Telefone Contato',
+    'Email', 'Nome da Mãe', 'Nome do Pai', 'Endereço', 'Número', 'Bairro',
+    'Cidade', 'Estado', 'CEP', 'Origem', 'Data Cadastro', 'Última Atualização',
+    'Sincronização e-SUS'
+]
+
+def patient_export_row(patient):
+    """Linha do relatório de pacientes (mesma ordem de PATIENT_EXPORT_HEADER)"""
+    return [
+        patient.id,
+        patient.full_name,
+        format_cpf(patient.cpf),
+        format_cns(patient.cns) if patient.cns else 'N/A',
+        patient.birth_date.strftime('%d/%m/%Y') if patient.birth_date else 'N/A',
+        patient.age,
+        patient.gender_display,
+        patient.primary_phone or 'N/A',
+        patient.home_phone or 'N/A',
+        patient.cell_phone or 'N/A',
+        patient.contact_phone or 'N/A',
+        patient.email or 'N/A',
+        patient.mother_name or 'N/A',
+        patient.father_name or 'N/A',
+        patient.address or 'N/A',
+        patient.number or 'N/A',
+        patient.neighborhood or 'N/A',
+        patient.city or 'N/A',
+        patient.state or 'N/A',
+        patient.zip_code or 'N/A',
+        patient.source_display,
+        patient.created_at.strftime('%d/%m/%Y') if patient.created_at else 'N/A',
+        patient.updated_at.strftime('%d/%m/%Y') if patient.updated_at else 'N/A',
+        patient.esus_sync_date.strftime('%d/%m/%Y') if patient.esus_sync_date else 'N/A'
+    ]
 
-def generate_patients_excel(patients, age_groups, esus_stats=None):
-    """Gerar Excel do relatório de pacientes"""
-    output = BytesIO()
-    
-    patient_data = []
-    for patient in patients:
-        patient_data.append({
-            'ID': patient.id,
-            'Nome': patient.full_name,
-            'CPF': format_cpf(patient.cpf),
-            'CNS': format_cns(patient.cns) if patient.cns else 'N/A',
-            'Data Nascimento': patient.birth_date.strftime('%d/%m/%Y') if patient.birth_date else 'N/A',
-            'Idade': patient.age,
-            'Sexo': patient.gender_display,
-            'Telefone Principal': patient.primary_phone or 'N/A',
-            'Telefone Residencial': patient.home_phone or 'N/A',
-            'Telefone Celular': patient.cell_phone or 'N/A',
-            'Telefone Contato': patient.contact_phone or 'N/A',
-            'Email': patient.email or 'N/A',
-            'Nome da Mãe': patient.mother_name or 'N/A',
-            'Nome do Pai': patient.father_name or 'N/A',
-            'Endereço': patient.address or 'N/A',
-            'Número': patient.number or 'N/A',
-            'Bairro': patient.neighborhood or 'N/A',
-            'Cidade': patient.city or 'N/A',
-            'Estado': patient.state or 'N/A',
-            'CEP': patient.zip_code or 'N/A',
-            'Origem': patient.source_display,
-            'Data Cadastro': patient.created_at.strftime('%d/%m/%Y') if patient.created_at else 'N/A',
-            'Última Atualização': patient.updated_at.strftime('%d/%m/%Y') if patient.updated_at else 'N/A',
-            'Sincronização e-SUS': patient.esus_sync_date.strftime('%d/%m/%Y') if patient.esus_sync_date else 'N/A'
-        })
+def stream_patients_export(query, format_type):
+    """
+    ✅ Excel (write-only) ou CSV de pacientes em streaming, sem limite de registros
     
-    df = pd.DataFrame(patient_data)
+    Faixas etárias, estatísticas e-SUS e resumo são acumulados enquanto as
+    linhas são escritas e gravados nas abas seguintes.
+    """
+    patients = iter_query(query)
     
-    # Estatísticas por idade
-    age_df = pd.DataFrame([
-        {'Faixa Etária': faixa, 'Quantidade': quantidade}
-        for faixa, quantidade in age_groups.items()
-    ])
+    if format_type == 'csv':
+        return csv_response(
+            export_filename('relatorio_pacientes', 'csv'), PATIENT_EXPORT_HEADER,
+            (patient_export_row(patient) for patient in patients)
+        )
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Pacientes', index=False)
-        age_df.to_excel(writer, sheet_name='Faixas Etárias', index=False)
-        
-        # ✅ ABA COM ESTATÍSTICAS E-SUS
-        if esus_stats:
-            esus_df = pd.DataFrame([
-                {'Estatística e-SUS': 'Cadastro Local', 'Quantidade': esus_stats['local_source']},
-                {'Estatística e-SUS': 'Importado do e-SUS', 'Quantidade': esus_stats['imported_source']},
-                {'Estatística e-SUS': 'e-SUS Direto', 'Quantidade': esus_stats['esus_source']},
-                {'Estatística e-SUS': 'Com CNS', 'Quantidade': esus_stats['with_cns']},
-                {'Estatística e-SUS': 'Com Nome da Mãe', 'Quantidade': esus_stats['with_mother_name']},
-                {'Estatística e-SUS': 'Múltiplos Telefones', 'Quantidade': esus_stats['with_multiple_phones']}
-            ])
-            esus_df.to_excel(writer, sheet_name='Estatísticas e-SUS', index=False)
-        
-        # Resumo
-        summary = pd.DataFrame([
-            {'Indicador': 'Total de Pacientes', 'Valor': len(patients)},
-            {'Indicador': 'Pacientes Ativos', 'Valor': len([p for p in patients if p.is_active])},
-            {'Indicador': 'Idade Média', 'Valor': sum([p.age for p in patients]) / len(patients) if patients else 0},
-            {'Indicador': 'Pacientes com CNS', 'Valor': len([p for p in patients if p.cns])},
-            {'Indicador': 'Pacientes com Telefone', 'Valor': len([p for p in patients if p.primary_phone])},
-            {'Indicador': 'Pacientes com Email', 'Valor': len([p for p in patients if p.email])}
-        ])
-        summary.to_excel(writer, sheet_name='Resumo', index=False)
-        
-        # Ajustar larguras
-        for sheet_name in writer.sheets:
-            worksheet = writer.sheets[sheet_name]
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+    today = date.today()
+    age_groups = {label: 0 for label, _ in AGE_BUCKETS}
+    esus_stats = {
+        'local': 0, 'imported': 0, 'esus': 0,
+        'with_cns': 0, 'with_mother_name': 0, 'with_multiple_phones': 0
+    }
+    totals = {'patients': 0, 'active': 0, 'age_sum': 0, 'with_phone': 0, 'with_email': 0}
     
-    output.seek(0)
+    def rows():
+        for patient in patients:
+            age_groups[age_bucket(patient.birth_date, today)] += 1
+            if patient.source in ('local', 'imported', 'esus'):
+                esus_stats[patient.source] += 1
+            esus_stats['with_cns'] += 1 if patient.cns else 0
+            esus_stats['with_mother_name'] += 1 if patient.mother_name else 0
+            phones = [patient.home_phone, patient.cell_phone, patient.contact_phone]
+            esus_stats['with_multiple_phones'] += 1 if sum(1 for phone in phones if phone) > 1 else 0
+            
+            totals['patients'] += 1
+            totals['active'] += 1 if patient.is_active else 0
+            totals['age_sum'] += patient.age
+            totals['with_phone'] += 1 if patient.primary_phone else 0
+            totals['with_email'] += 1 if patient.email else 0
+            yield patient_export_row(patient)
+    
+    workbook = StreamingWorkbook()
+    workbook.add_sheet('Pacientes', PATIENT_EXPORT_HEADER, rows(),
+                       widths=[8, 40, 16, 20, 14, 8, 14] + [16] * 4 + [30, 40, 40, 40, 8, 25, 20, 8, 10, 18, 14, 16, 18])
+    workbook.add_sheet('Faixas Etárias', ['Faixa Etária', 'Quantidade'], age_groups.items(), widths=[20, 15])
+    
+    # ✅ ABA COM ESTATÍSTICAS E-SUS
+    workbook.add_sheet('Estatísticas e-SUS', ['Estatística e-SUS', 'Quantidade'], [
+        ['Cadastro Local', esus_stats['local']],
+        ['Importado do e-SUS', esus_stats['imported']],
+        ['e-SUS Direto', esus_stats['esus']],
+        ['Com CNS', esus_stats['with_cns']],
+        ['Com Nome da Mãe', esus_stats['with_mother_name']],
+        ['Múltiplos Telefones', esus_stats['with_multiple_phones']]
+    ], widths=[30, 15])
     
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f'relatorio_pacientes_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+    # Resumo
+    count = totals['patients']
+    workbook.add_sheet('Resumo', ['Indicador', 'Valor'], [
+        ['Total de Pacientes', count],
+        ['Pacientes Ativos', totals['active']],
+        ['Idade Média', totals['age_sum'] / count if count else 0],
+        ['Pacientes com CNS', esus_stats['with_cns']],
+        ['Pacientes com Telefone', totals['with_phone']],
+        ['Pacientes com Email', totals['with_email']]
+    ], widths=[30, 15])
+    
+    return workbook.response(export_filename('relatorio_pacientes', 'xlsx'))
 
 def generate_esus_integration_excel(stats, quality_stats, recent_imports):
     """✅ GERAR EXCEL DO RELATÓRIO DE INTEGRAÇÃO E-SUS"""
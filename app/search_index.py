@@ -0,0 +1,88 @@
+"""
+Módulo de Índice de Busca de Pacientes
+Normalização de nomes (sem acentos, maiúsculas) e geração de tokens
+usados pela tabela patient_name_tokens; sufixos de documentos e telefones
+usados pela tabela patient_digit_suffixes
+
+Funções puras (sem dependência de Flask/SQLAlchemy) para poderem ser
+usadas também pelo script de sincronização e-SUS.
+"""
+
+import re
+import unicodedata
+
+# Tamanho máximo de um token (coluna patient_name_tokens.token)
+MAX_TOKEN_LENGTH = 50
+
+# Menor sufixo numérico indexado (buscas mais curtas usam prefixo nas colunas)
+MIN_DIGIT_SUFFIX = 3
+
+_NON_ALNUM = re.compile(r'[^A-Z0-9]+')
+_NON_DIGIT = re.compile(r'[^0-9]+')
+
+# =================== NORMALIZAÇÃO DE NOMES ===================
+
+def fold_accents(text):
+    """Remover acentos: 'João Conceição' -> 'Joao Conceicao'"""
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def normalize_name(text):
+    """
+    Forma canônica de busca de um nome
+    
+    'João  da Silva-Júnior' -> 'JOAO DA SILVA JUNIOR'
+    """
+    if not text:
+        return ''
+    folded = fold_accents(text).upper()
+    return _NON_ALNUM.sub(' ', folded).strip()
+
+def name_tokens(text):
+    """Tokens distintos do nome normalizado, na ordem em que aparecem"""
+    tokens = []
+    for token in normalize_name(text).split():
+        token = token[:MAX_TOKEN_LENGTH]
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
+
+def token_rows(patient_id, full_name, mother_name):
+    """Linhas (patient_id, field, token) para patient_name_tokens"""
+    rows = []
+    for field, value in (('name', full_name), ('mother', mother_name)):
+        for token in name_tokens(value):
+            rows.append((patient_id, field, token))
+    return rows
+
+# =================== DOCUMENTOS E TELEFONES ===================
+
+def only_digits(text):
+    """'(19) 99876-5432' -> '19998765432'"""
+    if not text:
+        return ''
+    return _NON_DIGIT.sub('', str(text))
+
+def digit_suffixes(value):
+    """
+    Sufixos de um número com pelo menos MIN_DIGIT_SUFFIX dígitos
+    
+    Todo trecho de um número é prefixo de algum sufixo dele, então
+    "contém 8765" vira "algum sufixo começa com 8765" (busca por faixa).
+    """
+    digits = only_digits(value)
+    return [digits[start:] for start in range(len(digits) - MIN_DIGIT_SUFFIX + 1)]
+
+def digit_rows(patient_id, cpf, cns, phones):
+    """Linhas (patient_id, field, suffix) para patient_digit_suffixes"""
+    rows = []
+    for field, values in (('cpf', [cpf]), ('cns', [cns]), ('phone', phones)):
+        seen = set()
+        for value in values:
+            for suffix in digit_suffixes(value):
+                if suffix not in seen:
+                    seen.add(suffix)
+                    rows.append((patient_id, field, suffix))
+    return rows
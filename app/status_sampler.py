@@ -0,0 +1,184 @@
+"""
+Amostrador de Status em Segundo Plano
+Uma thread por processo atualiza, a cada STATUS_SAMPLE_INTERVAL segundos,
+a conectividade e-SUS, o retrato de CPU/memória/disco e as contagens das
+tabelas. /health, /api/dashboard/stats e admin_system_info leem o último
+retrato (com a idade em segundos) em vez de consultar tudo a cada chamada.
+"""
+
+import logging
+import platform
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import desc
+
+from app.database import db
+
+class StatusSampler:
+    """Retrato periódico de saúde do sistema, compartilhado pelo processo"""
+    
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._snapshot = None
+        self._sampled_at = None  # time.monotonic() do último retrato
+        self._thread = None
+        self._stop = threading.Event()
+    
+    # =================== THREAD ===================
+    
+    def start(self, app):
+        """Iniciar a thread (uma vez por processo)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self.interval = app.config.get('STATUS_SAMPLE_INTERVAL', self.interval)
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(app,), name='status-sampler', daemon=True
+            )
+            self._thread.start()
+        logging.info(f"Amostrador de status iniciado (intervalo {self.interval}s)")
+    
+    def stop(self):
+        self._stop.set()
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def _run(self, app):
+        # Primeira leitura de CPU só define a referência (psutil mede desde a chamada anterior)
+        psutil = _import_psutil()
+        if psutil:
+            psutil.cpu_percent(interval=None)
+        
+        while not self._stop.is_set():
+            with app.app_context():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logging.error(f"Erro no amostrador de status: {e}")
+                finally:
+                    db.session.remove()
+            self._stop.wait(self.interval)
+    
+    # =================== COLETA ===================
+    
+    def refresh(self):
+        """Coletar um retrato novo (precisa de app_context)"""
+        with self._refresh_lock:
+            snapshot = {
+                'sampled_at': datetime.now(),
+                'esus': self._sample_esus(),
+                'system': self._sample_system(),
+                'db': self._sample_db()
+            }
+            with self._lock:
+                self._snapshot = snapshot
+                self._sampled_at = time.monotonic()
+            return snapshot
+    
+    @staticmethod
+    def _sample_esus():
+        from app.esus_integration import get_esus_db_credentials, test_esus_connection, esus_breaker
+        
+        status = {'configured': False, 'connected': False, 'message': None, 'circuit': None}
+        try:
+            status['configured'] = get_esus_db_credentials() is not None
+            if status['configured']:
+                status['connected'], status['message'] = test_esus_connection()
+            status['circuit'] = esus_breaker.stats()
+        except Exception as e:
+            status['message'] = str(e)
+        return status
+    
+    @staticmethod
+    def _sample_system():
+        system = {
+            'platform': platform.platform(),
+            'python_version': platform.python_version(),
+            'cpu_percent': None,
+            'memory': None,
+            'disk': None,
+            'boot_time': None
+        }
+        psutil = _import_psutil()
+        if not psutil:
+            return system
+        
+        try:
+            # interval=None: sem espera, mede desde a amostra anterior
+            system['cpu_percent'] = psutil.cpu_percent(interval=None)
+            system['memory'] = psutil.virtual_memory()
+            system['disk'] = psutil.disk_usage('/')
+            system['boot_time'] = datetime.fromtimestamp(psutil.boot_time())
+        except Exception as e:
+            logging.error(f"Erro ao coletar dados do sistema: {e}")
+        return system
+    
+    @staticmethod
+    def _sample_db():
+        from app.models import Patient
+        from app.dashboard_stats import DashboardStatsService
+        
+        try:
+            counts = DashboardStatsService.database_totals()
+            last_sync = db.session.query(Patient.esus_sync_date).filter(
+                Patient.esus_sync_date.isnot(None)
+            ).order_by(desc(Patient.esus_sync_date)).limit(1).scalar()
+            counts['esus_last_sync'] = last_sync
+            return counts
+        except Exception as e:
+            logging.error(f"Erro ao coletar contagens do banco: {e}")
+            db.session.rollback()
+            return None
+    
+    # =================== LEITURA ===================
+    
+    def snapshot(self):
+        """
+        Último retrato + 'age_seconds'
+        
+        Sem retrato ainda (thread não iniciada ou primeira coleta em
+        andamento), coleta na hora - precisa de app_context.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            sampled_at = self._sampled_at
+        
+        if snapshot is None:
+            snapshot = self.refresh()
+            sampled_at = time.monotonic()
+        
+        result = dict(snapshot)
+        result['age_seconds'] = round(time.monotonic() - sampled_at, 1)
+        return result
+
+def _import_psutil():
+    try:
+        import psutil
+        return psutil
+    except ImportError:
+        return None
+
+# Instância global do amostrador
+status_sampler = StatusSampler()
+
+def init_status_sampler(app):
+    """
+    Iniciar o amostrador na primeira requisição do processo
+    
+    Assim só o processo que atende requisições tem a thread (não o processo
+    pai do reloader, nem scripts que apenas chamam create_app).
+    """
+    if app.config.get('TESTING') or not app.config.get('STATUS_SAMPLER_ENABLED', True):
+        return
+    
+    @app.before_request
+    def _start_status_sampler():
+        if not status_sampler.running:
+            status_sampler.start(app)
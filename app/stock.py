@@ -0,0 +1,66 @@
+"""
+Baixa de Estoque
+Saídas de estoque seguras com atendentes dispensando o mesmo medicamento
+ao mesmo tempo:
+
+- lock(): SELECT ... FOR UPDATE das linhas em ordem de id (ordem fixa
+  evita deadlock entre duas dispensações com os mesmos medicamentos)
+- decrement(): UPDATE atômico "current_stock = current_stock - :qtd"
+  com a condição "current_stock >= :qtd" (nunca fica negativo nem perde
+  uma baixa concorrente)
+
+O UPDATE não passa pelo ORM, então os caches/eventos de Medication são
+agendados aqui para o commit.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import update
+
+from app.cache import mark_caches_dirty, publish
+from app.database import db
+from app.models import Medication
+from app.report_cache import report_source_topic
+
+class InsufficientStockError(ValueError):
+    """Estoque menor que a quantidade pedida (a transação deve ser desfeita)"""
+
+class StockService:
+    """Bloqueio e baixa de estoque dentro da transação da dispensação"""
+    
+    @staticmethod
+    def lock(medication_ids):
+        """
+        Bloquear as linhas até o commit/rollback
+        
+        Returns:
+            dict {medication_id: current_stock} lido já com o bloqueio
+        """
+        rows = db.session.query(Medication.id, Medication.current_stock).filter(
+            Medication.id.in_(set(medication_ids))
+        ).order_by(Medication.id).with_for_update().all()
+        return {medication_id: current_stock for medication_id, current_stock in rows}
+    
+    @staticmethod
+    def decrement(medication, quantity):
+        """
+        Baixar quantity do estoque em um UPDATE atômico
+        
+        Raises:
+            InsufficientStockError: estoque atual menor que quantity
+        """
+        result = db.session.execute(
+            update(Medication).where(
+                Medication.id == medication.id,
+                Medication.current_stock >= quantity
+            ).values(
+                current_stock=Medication.current_stock - quantity,
+                updated_at=datetime.utcnow()
+            ).execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            raise InsufficientStockError(f"Estoque insuficiente para {medication.commercial_name}")
+        
+        # Mesmo efeito de uma gravação pelo ORM (autocomplete, dashboards e relatórios)
+        mark_caches_dirty(db.session, 'medication_search')
+        publish(db.session, 'medications', 'medication_alerts', report_source_topic(Medication))
@@ -308,18 +308,10 @@ USER_ROLES = {
 # Função para obter configurações do sistema
 def get_system_stats():
     """Retorna estatísticas gerais do sistema"""
-    from app.models import Patient, Medication, HighCostProcess, Dispensation
+    from app.dashboard_stats import DashboardStatsService
     
     try:
-        stats = {
-            'total_patients': Patient.query.filter_by(is_active=True).count(),
-            'total_medications': Medication.query.filter_by(is_active=True).count(),
-            'pending_high_cost': HighCostProcess.query.filter_by(status='pending').count(),
-            'today_dispensations': Dispensation.query.filter(
-                Dispensation.dispensation_date >= datetime.now().date()
-            ).count()
-        }
-        return stats
+        return DashboardStatsService.system_stats()
     except Exception as e:
         print(f"Erro ao obter estatísticas: {e}")
         return {
@@ -25,6 +25,64 @@ class Config:
     MEDICATIONS_PER_PAGE = 50
     PROCESSES_PER_PAGE = 15
     
+    # Integração e-SUS (pool de conexões PostgreSQL)
+    ESUS_POOL_MAX_SIZE = int(os.environ.get('ESUS_POOL_MAX_SIZE') or 5)
+    ESUS_POOL_IDLE_TIMEOUT = int(os.environ.get('ESUS_POOL_IDLE_TIMEOUT') or 300)  # segundos
+    ESUS_CONNECT_TIMEOUT = int(os.environ.get('ESUS_CONNECT_TIMEOUT') or 10)  # segundos
+    ESUS_SOCKET_TIMEOUT = int(os.environ.get('ESUS_SOCKET_TIMEOUT') or 10)  # segundos sem resposta do socket (keepalives/tcp_user_timeout)
+    ESUS_CREDENTIALS_CACHE_TTL = 300  # segundos
+    ESUS_SEARCH_CACHE_TTL = int(os.environ.get('ESUS_SEARCH_CACHE_TTL') or 120)  # segundos (com resultados)
+    ESUS_NEGATIVE_CACHE_TTL = int(os.environ.get('ESUS_NEGATIVE_CACHE_TTL') or 60)  # segundos (sem resultados)
+    
+    # Proteção do e-SUS no caminho das requisições
+    ESUS_STATEMENT_TIMEOUT = int(os.environ.get('ESUS_STATEMENT_TIMEOUT') or 15)  # segundos por consulta
+    ESUS_REQUEST_BUDGET = float(os.environ.get('ESUS_REQUEST_BUDGET') or 5)  # segundos de e-SUS por requisição
+    ESUS_BREAKER_FAILURES = int(os.environ.get('ESUS_BREAKER_FAILURES') or 3)  # falhas seguidas para abrir o circuito
+    ESUS_BREAKER_RESET_TIMEOUT = int(os.environ.get('ESUS_BREAKER_RESET_TIMEOUT') or 30)  # segundos até a chamada de teste
+    
+    # Cache do autocomplete (/api/patients/search e /api/medications/search)
+    TYPEAHEAD_CACHE_SIZE = int(os.environ.get('TYPEAHEAD_CACHE_SIZE') or 2048)  # entradas
+    TYPEAHEAD_CACHE_TTL = int(os.environ.get('TYPEAHEAD_CACHE_TTL') or 60)  # segundos
+    
+    # Cache dos contadores dos dashboards
+    DASHBOARD_STATS_TTL = int(os.environ.get('DASHBOARD_STATS_TTL') or 300)  # segundos (gravações locais invalidam na hora)
+    
+    # Amostrador de status (/health, dashboard e informações do sistema)
+    STATUS_SAMPLER_ENABLED = os.environ.get('STATUS_SAMPLER_ENABLED', 'true').lower() in ['true', 'on', '1']
+    STATUS_SAMPLE_INTERVAL = int(os.environ.get('STATUS_SAMPLE_INTERVAL') or 30)  # segundos
+    
+    # Fila de relatórios em segundo plano (PDF/Excel/CSV)
+    REPORT_JOBS_ENABLED = os.environ.get('REPORT_JOBS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS') or 2)  # relatórios gerados ao mesmo tempo
+    REPORT_JOB_TTL_HOURS = int(os.environ.get('REPORT_JOB_TTL_HOURS') or 24)  # horas até o arquivo expirar
+    
+    # Renderização de PDF em processos separados (0 = na própria thread)
+    PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS') or 2)
+    PDF_RENDER_TIMEOUT = int(os.environ.get('PDF_RENDER_TIMEOUT') or 120)  # segundos por PDF
+    
+    # Cache de relatórios prontos (PDF/Excel), invalidado pela versão dos dados
+    REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE') or 32)  # arquivos
+    REPORT_CACHE_TTL = int(os.environ.get('REPORT_CACHE_TTL') or 43200)  # segundos
+    REPORT_CACHE_MAX_BYTES = int(os.environ.get('REPORT_CACHE_MAX_BYTES') or 5 * 1024 * 1024)  # por arquivo
+    
+    # Chaves de idempotência (POST /dispensation/create repetido devolve a resposta guardada)
+    IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS') or 24)  # horas até a chave ser apagada
+    
+    # Log de auditoria em lotes (thread + arquivo de contingência se o banco cair)
+    AUDIT_LOG_ASYNC = os.environ.get('AUDIT_LOG_ASYNC', 'true').lower() in ['true', 'on', '1']
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE') or 100)  # registros por INSERT
+    AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL') or 2)  # segundos
+    AUDIT_MAX_BUFFER = int(os.environ.get('AUDIT_MAX_BUFFER') or 10000)  # acima disso vai direto para o arquivo
+    AUDIT_FALLBACK_FILE = os.environ.get('AUDIT_FALLBACK_FILE') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'logs', 'audit_fallback.jsonl'
+    )
+    
+    # Arquivamento de audit_logs e inventory_movements (scripts/archive_logs.py)
+    LOG_RETENTION_MONTHS = int(os.environ.get('LOG_RETENTION_MONTHS') or 12)  # meses mantidos no banco
+    ARCHIVE_FOLDER = os.environ.get('ARCHIVE_FOLDER') or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'archive'
+    )
+    
     # Sistema
     SYSTEM_NAME = "FarmaCuidar - Cosmópolis"
     MUNICIPALITY = "Cosmópolis - SP"
@@ -35,8 +93,14 @@ class DevelopmentConfig(Config):
 class ProductionConfig(Config):
     DEBUG = False
     
+class TestingConfig(Config):
+    TESTING = True
+    # Banco descartável (benchmarks e testes) - nunca o banco de produção
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite:///farmacuidar_test.db'
+    
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
+    'testing': TestingConfig,
     'default': DevelopmentConfig
 }
\ No newline at end of file
@@ -33,9 +33,12 @@ def create_database():
         with app.app_context():
             print("📊 Criando tabelas do banco...")
             
-            # Criar todas as tabelas
-            db.create_all()
+            # Criar todas as tabelas (e colunas/índices novos em bancos existentes)
+            from app.database import upgrade_schema
+            added = upgrade_schema()
             print("✅ Tabelas criadas com sucesso!")
+            for item in added:
+                print(f"   ➕ {item}")
             
             # Verificar se admin já existe
             existing_admin = User.query.filter_by(username='admin').first()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Arquivamento de audit_logs e inventory_movements
+Uso: python archive_logs.py [opções]
+
+Arquivar os meses anteriores ao período mantido (LOG_RETENTION_MONTHS):
+    python archive_logs.py
+
+Ver o que seria arquivado, sem gravar nem apagar:
+    python archive_logs.py --dry-run
+
+Só uma tabela, mantendo 6 meses:
+    python archive_logs.py --table audit_logs --keep-months 6
+
+Cada mês vira ARCHIVE_FOLDER/<tabela>/<tabela>_AAAA-MM.jsonl.gz (uma
+linha JSON por registro, leitura com zcat) e é apagado do banco. Rodar
+fora do horário de atendimento, de preferência depois do backup.
+"""
+
+import sys
+import os
+import argparse
+import time
+
+# Adicionar path do projeto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.database import upgrade_schema
+from app.log_archive import ARCHIVE_TABLES, LogArchiver
+
+def main():
+    parser = argparse.ArgumentParser(description='Arquivar logs antigos em arquivos compactados')
+    parser.add_argument('--table', choices=sorted(ARCHIVE_TABLES), action='append',
+                        help='Tabela a arquivar (padrão: todas)')
+    parser.add_argument('--keep-months', type=int, help='Meses mantidos no banco (padrão: LOG_RETENTION_MONTHS)')
+    parser.add_argument('--folder', help='Pasta dos arquivos (padrão: ARCHIVE_FOLDER)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Registros por leitura/exclusão')
+    parser.add_argument('--dry-run', action='store_true', help='Só contar os registros de cada mês')
+    
+    args = parser.parse_args()
+    
+    app = create_app()
+    with app.app_context():
+        for item in upgrade_schema():
+            print(f"   + {item}")
+        
+        keep_months = args.keep_months if args.keep_months is not None else app.config['LOG_RETENTION_MONTHS']
+        if keep_months < 1:
+            parser.error('--keep-months deve ser pelo menos 1')
+        
+        archiver = LogArchiver(args.folder or app.config['ARCHIVE_FOLDER'], batch_size=args.batch_size)
+        start = time.time()
+        total = 0
+        
+        for table_name in args.table or sorted(ARCHIVE_TABLES):
+            results = archiver.archive(table_name, keep_months, dry_run=args.dry_run)
+            if not results:
+                print(f"📭 {table_name}: nada anterior aos últimos {keep_months} meses")
+            for month, count, path in results:
+                total += count
+                if args.dry_run:
+                    print(f"🔎 {table_name} {month:%Y-%m}: {count} registro(s)")
+                elif path:
+                    print(f"📦 {table_name} {month:%Y-%m}: {count} registro(s) -> {path}")
+        
+        action = 'a arquivar' if args.dry_run else 'arquivados'
+        print(f"✅ {total} registro(s) {action} em {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark das Estatísticas de Pacientes (/api/patients/charts, /geographic e /stats)
+Compara carregar todos os pacientes ativos como objetos ORM (cálculo em Python)
+com as agregações no banco de PatientStatsService, em banco descartável.
+
+Uso (FLASK_ENV=testing, TEST_DATABASE_URL):
+    python benchmark_patient_stats.py --patients 100000
+"""
+
+import sys
+import os
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Adicionar path do projeto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.database import db, upgrade_schema
+from app.models import Patient
+from app.patient_stats import PatientStatsService
+
+from rebuild_search_index import seed
+
+def orm_stats():
+    """Abordagem anterior: todos os pacientes ativos em memória"""
+    patients = Patient.query.filter_by(is_active=True).all()
+    genders = {}
+    ages = {}
+    cities = {}
+    complete = 0
+    for patient in patients:
+        genders[patient.gender or 'N'] = genders.get(patient.gender or 'N', 0) + 1
+        ages[patient.age // 10] = ages.get(patient.age // 10, 0) + 1
+        cities[patient.city] = cities.get(patient.city, 0) + 1
+        if patient.address and patient.address.strip():
+            complete += 1
+    return len(patients)
+
+def sql_stats():
+    """Agregações no banco (mesmos dados das três APIs)"""
+    PatientStatsService.gender_counts()
+    PatientStatsService.age_counts()
+    PatientStatsService.monthly_registrations(months=6)
+    PatientStatsService.top_values(Patient.city)
+    PatientStatsService.top_values(Patient.state)
+    return PatientStatsService.completeness(datetime.now() - timedelta(days=30))['total']
+
+def measure(label, function, repeat):
+    """Tempo médio (ms) e pico de memória Python (MB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+        db.session.expunge_all()
+    elapsed = (time.perf_counter() - start) * 1000 / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<24} {elapsed:>10.1f} {peak / 1024**2:>12.1f} {result:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark das estatísticas de pacientes')
+    parser.add_argument('--patients', type=int, default=100000, help='Pacientes no banco descartável')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Pacientes por lote na carga')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetições por abordagem')
+    
+    args = parser.parse_args()
+    
+    app = create_app('testing')
+    with app.app_context():
+        upgrade_schema()
+        existing = Patient.query.count()
+        if existing < args.patients:
+            seed(args.patients - existing, args.batch_size)
+        
+        print(f"\n{'Abordagem':<24} {'Tempo (ms)':>10} {'Pico (MB)':>12} {'Pacientes':>10}")
+        measure('ORM + Python', orm_stats, args.repeat)
+        measure('Agregação SQL', sql_stats, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Agregados Diários de Dispensação (dispensation_daily_*)
+Uso: python rebuild_rollups.py [opções]
+
+Recalcular tudo (para corrigir divergências; as tabelas criadas pelo
+upgrade_schema/create_db.py em um banco existente já são preenchidas):
+    python rebuild_rollups.py
+
+Recalcular só um período:
+    python rebuild_rollups.py --start 2024-01-01 --end 2024-12-31
+
+Rodar fora do horário de atendimento: cada bloco de dias é apagado e
+recalculado em uma transação.
+"""
+
+import sys
+import os
+import argparse
+import time
+from datetime import datetime
+
+# Adicionar path do projeto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.database import upgrade_schema
+from app.rollups import rebuild_rollups
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def main():
+    parser = argparse.ArgumentParser(description='Recalcular agregados diários de dispensação')
+    parser.add_argument('--start', type=parse_date, help='Data inicial (AAAA-MM-DD)')
+    parser.add_argument('--end', type=parse_date, help='Data final (AAAA-MM-DD)')
+    parser.add_argument('--chunk-days', type=int, default=31, help='Dias por transação')
+    
+    args = parser.parse_args()
+    
+    app = create_app()
+    with app.app_context():
+        for item in upgrade_schema():
+            print(f"   + {item}")
+        
+        start = time.time()
+        days = rebuild_rollups(args.start, args.end, chunk_days=args.chunk_days)
+        print(f"✅ Agregados recalculados para {days} dias em {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
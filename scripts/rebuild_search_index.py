@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Índice de Busca de Pacientes (search_name, patient_name_tokens e patient_digit_suffixes)
+Uso: python rebuild_search_index.py [opções]
+
+Recalcular o índice de todos os pacientes (para corrigir divergências; as
+tabelas e colunas criadas pelo upgrade_schema/create_db.py em um banco
+existente já são preenchidas):
+    python rebuild_search_index.py
+
+Benchmark LIKE '%termo%' x índices em banco descartável (FLASK_ENV=testing):
+    python rebuild_search_index.py --benchmark 100000
+"""
+
+import sys
+import os
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+# Adicionar path do projeto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.database import db, upgrade_schema
+from app.models import Patient, PatientNameToken, PatientDigitSuffix
+from app.search_index import normalize_name, token_rows, digit_rows
+
+FIRST_NAMES = [
+    'João', 'José', 'Antônio', 'Francisco', 'Luís', 'Sebastião', 'Conceição', 'Márcia',
+    'Ana', 'Maria', 'Júlia', 'Lúcia', 'Letícia', 'Mônica', 'Inês', 'Cecília',
+    'Paulo', 'Pedro', 'Lucas', 'Gabriel', 'Rafael', 'Tiago', 'André', 'Vitória'
+]
+SURNAMES = [
+    'Silva', 'Santos', 'Oliveira', 'Souza', 'Conceição', 'Araújo', 'Gonçalves', 'Simões',
+    'Magalhães', 'Brandão', 'Falcão', 'Guimarães', 'Assunção', 'Estêvão', 'Lima', 'Pereira',
+    'Ferreira', 'Rodrigues', 'Almeida', 'Nascimento', 'Carvalho', 'Ribeiro', 'Gomes', 'Martins'
+]
+
+# Termos digitados na busca (sem acento, parciais, em qualquer caixa)
+BENCHMARK_TERMS = ['joao', 'conceicao', 'maria silva', 'GUIMA', 'ana lu', 'sebastiao araujo']
+
+# Trechos de CPF, CNS e telefone digitados no balcão
+BENCHMARK_DIGITS = ['12', '0000123', '4567', '99871', '7001234']
+
+def random_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(SURNAMES)} {rng.choice(SURNAMES)}"
+
+def rebuild(batch_size):
+    """Recalcular search_name, tokens e sufixos de todos os pacientes"""
+    added = upgrade_schema()
+    for item in added:
+        print(f"   + {item}")
+    
+    start = time.time()
+    total = Patient.rebuild_search_index(batch_size=batch_size)
+    print(f"✅ Índice recalculado para {total} pacientes em {time.time() - start:.1f}s")
+
+def seed(total, batch_size):
+    """Inserir pacientes sintéticos (com índice) no banco descartável"""
+    rng = random.Random(42)
+    patients_table = Patient.__table__
+    tokens_table = PatientNameToken.__table__
+    suffixes_table = PatientDigitSuffix.__table__
+    next_id = (db.session.query(db.func.max(Patient.id)).scalar() or 0) + 1
+    
+    for offset in range(0, total, batch_size):
+        patients = []
+        tokens = []
+        suffixes = []
+        for patient_id in range(next_id + offset, next_id + min(offset + batch_size, total)):
+            full_name = random_name(rng)
+            mother_name = random_name(rng)
+            cpf = f'{patient_id:011d}'
+            cns = f'7{rng.randint(0, 10**14 - 1):014d}'
+            cell_phone = f'1999{rng.randint(0, 10**7 - 1):07d}'
+            patients.append({
+                'id': patient_id,
+                'cpf': cpf,
+                'cns': cns,
+                'cell_phone': cell_phone,
+                'full_name': full_name,
+                'search_name': normalize_name(full_name),
+                'mother_name': mother_name,
+                'birth_date': date(1940, 1, 1) + timedelta(days=rng.randint(0, 30000)),
+                'city': 'Cosmópolis',
+                'state': 'SP',
+                'source': 'local',
+                'is_active': True
+            })
+            tokens.extend(
+                {'patient_id': row_id, 'field': field, 'token': token}
+                for row_id, field, token in token_rows(patient_id, full_name, mother_name)
+            )
+            suffixes.extend(
+                {'patient_id': row_id, 'field': field, 'suffix': suffix}
+                for row_id, field, suffix in digit_rows(patient_id, cpf, cns, [cell_phone])
+            )
+        
+        db.session.execute(patients_table.insert(), patients)
+        db.session.execute(tokens_table.insert(), tokens)
+        db.session.execute(suffixes_table.insert(), suffixes)
+        db.session.commit()
+    
+    print(f"✅ {total} pacientes sintéticos inseridos")
+
+def timed(query_factory, repeat):
+    """Tempo médio (ms) e número de resultados de uma consulta"""
+    count = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        count = query_factory().order_by(Patient.full_name).limit(50).count()
+    return (time.perf_counter() - start) * 1000 / repeat, count
+
+def _sqlite_case_sensitive_like(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA case_sensitive_like = ON')
+
+def benchmark(total, batch_size, repeat):
+    """Comparar LIKE '%termo%' com a busca pelos índices de tokens e de sufixos"""
+    if db.engine.dialect.name == 'sqlite':
+        # LIKE do sqlite ignora maiúsculas e por isso não usa índice em 'termo%'
+        # (varre a tabela toda); o MySQL usa faixa no índice. Os tokens e
+        # sufixos já são normalizados, então o resultado é o mesmo.
+        db.engine.dispose()
+        event.listen(db.engine, 'connect', _sqlite_case_sensitive_like)
+    
+    upgrade_schema()
+    
+    existing = Patient.query.count()
+    if existing < total:
+        seed(total - existing, batch_size)
+    
+    print(f"\n{'Termo':<20} {'LIKE (ms)':>10} {'achados':>8} {'Índice (ms)':>12} {'achados':>8}")
+    for term in BENCHMARK_TERMS:
+        like_ms, like_count = timed(lambda: Patient.query.filter(Patient.full_name.ilike(f'%{term}%')), repeat)
+        index_ms, index_count = timed(lambda: Patient.query.filter(Patient.name_filter(term)), repeat)
+        print(f"{term:<20} {like_ms:>10.1f} {like_count:>8} {index_ms:>12.1f} {index_count:>8}")
+    
+    print(f"\n{'Dígitos':<20} {'LIKE (ms)':>10} {'achados':>8} {'Índice (ms)':>12} {'achados':>8}")
+    for digits in BENCHMARK_DIGITS:
+        like_ms, like_count = timed(lambda: Patient.query.filter(db.or_(
+            Patient.cpf.like(f'%{digits}%'),
+            Patient.cns.like(f'%{digits}%'),
+            Patient.cell_phone.like(f'%{digits}%'),
+            Patient.home_phone.like(f'%{digits}%'),
+            Patient.contact_phone.like(f'%{digits}%')
+        )), repeat)
+        index_ms, index_count = timed(lambda: Patient.query.filter(Patient.digits_filter(digits)), repeat)
+        print(f"{digits:<20} {like_ms:>10.1f} {like_count:>8} {index_ms:>12.1f} {index_count:>8}")
+    
+    print("\nObs.: LIKE não encontra termos sem acento ('joao' x 'João'); o índice encontra.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Índices de busca de pacientes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Pacientes por lote')
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help='Benchmark com N pacientes sintéticos (usa FLASK_ENV=testing)')
+    parser.add_argument('--repeat', type=int, default=20, help='Repetições por consulta no benchmark')
+    
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        app = create_app('testing')
+        with app.app_context():
+            benchmark(args.benchmark, args.batch_size, args.repeat)
+    else:
+        app = create_app()
+        with app.app_context():
+            rebuild(args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,22 @@
 """
 Script de Sincronização e-SUS → Sistema Local
 Uso: python sync_esus_patients.py [opções]
+
+Sincronização em pipeline com 8 gravadores (retoma automaticamente se interrompida):
+    python sync_esus_patients.py --full --workers 8
+
+Benchmark de leitura (vazão por lote, sem gravar no MySQL):
+    python sync_esus_patients.py --benchmark keyset
+    python sync_esus_patients.py --benchmark offset --benchmark-batches 30
 """
 
 import sys
 import os
 import argparse
+import hashlib
+import queue
+import threading
+import time
 from datetime import datetime, timedelta
 import mysql.connector
 import psycopg2
@@ -16,8 +27,35 @@ import logging
 # Adicionar path do projeto
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from app.search_index import normalize_name, token_rows, digit_rows
+
+class SyncCheckpoint:
+    """
+    Ponto de retomada para gravações fora de ordem.
+    
+    Os lotes são numerados na ordem de leitura; committed_key só avança até a
+    última chave de um lote cujos anteriores também já foram gravados.
+    """
+    
+    def __init__(self, start_key=None):
+        self.committed_key = start_key
+        self._next_seq = 0
+        self._done = {}
+    
+    def complete(self, seq, last_key):
+        self._done[seq] = last_key
+        while self._next_seq in self._done:
+            self.committed_key = self._done.pop(self._next_seq)
+            self._next_seq += 1
+        return self.committed_key
+
 class ESUSSync:
-    def __init__(self):
+    def __init__(self, batch_size=1000, workers=4, resume=True):
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.resume = resume
+        self._esus_has_update_column = None
+        
         # Primeiro configurar logging
         self.setup_logging()
         
@@ -152,10 +190,153 @@ class ESUSSync:
         """Conectar ao MySQL local"""
         return mysql.connector.connect(**self.mysql_config)
     
+    def get_writer_connection(self):
+        """
+        Conexão de um gravador do pipeline
+        
+        READ COMMITTED: sem gap locks nas leituras com bloqueio e nos DELETEs,
+        que em REPEATABLE READ fazem gravadores paralelos travarem entre si.
+        """
+        conn = self.get_mysql_connection()
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        cursor.close()
+        return conn
+    
+    def ensure_sync_schema(self, mysql_conn):
+        """Criar tabela de estado da sincronização e coluna de hash se não existirem"""
+        cursor = mysql_conn.cursor()
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS esus_sync_state (
+                id INT PRIMARY KEY AUTO_INCREMENT,
+                sync_name VARCHAR(50) NOT NULL UNIQUE,
+                last_watermark DATETIME NULL,
+                last_run_at DATETIME NULL,
+                last_status VARCHAR(20) NULL,
+                rows_processed INT NOT NULL DEFAULT 0,
+                rows_written INT NOT NULL DEFAULT 0,
+                rows_skipped INT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """)
+        
+        # Índice de busca por nome (mesma estrutura do modelo PatientNameToken)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS patient_name_tokens (
+                id INT PRIMARY KEY AUTO_INCREMENT,
+                patient_id INT NOT NULL,
+                field ENUM('name', 'mother') NOT NULL,
+                token VARCHAR(50) NOT NULL,
+                INDEX ix_patient_name_tokens_patient_id (patient_id),
+                INDEX ix_patient_name_tokens_lookup (field, token, patient_id),
+                FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """)
+        
+        # Índice de busca por documentos e telefones (modelo PatientDigitSuffix)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS patient_digit_suffixes (
+                id INT PRIMARY KEY AUTO_INCREMENT,
+                patient_id INT NOT NULL,
+                field ENUM('cpf', 'cns', 'phone') NOT NULL,
+                suffix VARCHAR(15) NOT NULL,
+                INDEX ix_patient_digit_suffixes_patient_id (patient_id),
+                INDEX ix_patient_digit_suffixes_lookup (suffix, field, patient_id),
+                FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """)
+        
+        self._ensure_column(cursor, 'patients', 'esus_hash', 'CHAR(64) NULL AFTER esus_sync_date')
+        self._ensure_column(cursor, 'patients', 'search_name', 'VARCHAR(100) NULL AFTER full_name')
+        self._ensure_index(cursor, 'patients', 'ix_patients_search_name', 'search_name')
+        self._ensure_column(cursor, 'esus_sync_state', 'last_key', 'BIGINT NULL AFTER last_watermark')
+        
+        mysql_conn.commit()
+        cursor.close()
+    
+    def _ensure_column(self, cursor, table, column, definition):
+        """ALTER TABLE ADD COLUMN se a coluna ainda não existir"""
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        if not cursor.fetchone()[0]:
+            self.logger.info(f"Adicionando coluna {table}.{column}...")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    def _ensure_index(self, cursor, table, index_name, columns):
+        """CREATE INDEX se o índice ainda não existir"""
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, index_name))
+        if not cursor.fetchone()[0]:
+            self.logger.info(f"Criando índice {index_name}...")
+            cursor.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+    
+    def get_sync_state(self, mysql_conn, sync_name='patients'):
+        """Ler estado persistido da última sincronização"""
+        cursor = mysql_conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM esus_sync_state WHERE sync_name = %s", (sync_name,))
+        state = cursor.fetchone()
+        cursor.close()
+        return state
+    
+    def save_sync_state(self, mysql_conn, status, watermark, totals, last_key=None, sync_name='patients'):
+        """Persistir marca d'água, ponto de retomada e contadores da execução"""
+        cursor = mysql_conn.cursor()
+        cursor.execute("""
+            INSERT INTO esus_sync_state (
+                sync_name, last_watermark, last_key, last_run_at, last_status,
+                rows_processed, rows_written, rows_skipped
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                last_watermark = COALESCE(VALUES(last_watermark), last_watermark),
+                last_key = VALUES(last_key),
+                last_run_at = VALUES(last_run_at),
+                last_status = VALUES(last_status),
+                rows_processed = VALUES(rows_processed),
+                rows_written = VALUES(rows_written),
+                rows_skipped = VALUES(rows_skipped)
+        """, (
+            sync_name, watermark, last_key, datetime.now(), status,
+            totals['processed'], totals['imported'] + totals['updated'], totals['skipped']
+        ))
+        mysql_conn.commit()
+        cursor.close()
+    
+    def esus_has_update_column(self, esus_conn):
+        """Verificar se tb_cidadao possui dt_atualizado (usado como marca d'água)"""
+        if self._esus_has_update_column is None:
+            with esus_conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*) FROM information_schema.columns
+                    WHERE table_name = 'tb_cidadao' AND column_name = 'dt_atualizado'
+                """)
+                self._esus_has_update_column = cursor.fetchone()[0] > 0
+            esus_conn.rollback()
+        return self._esus_has_update_column
+    
     def sync_full(self):
         """Sincronização completa"""
         self.logger.info("Iniciando sincronização completa...")
+        return self.run_sync(since=None, skip_unchanged=False, label='completa')
+    
+    def run_sync(self, since=None, skip_unchanged=False, label='completa'):
+        """
+        Executar a sincronização em pipeline.
         
+        Uma thread leitora percorre o e-SUS (iter_esus_batches) e entrega os
+        lotes numa fila limitada; self.workers gravadores, cada um com sua
+        conexão MySQL, consomem a fila. A cada lote gravado o maior
+        co_seq_cidadao com todos os lotes anteriores já confirmados é salvo em
+        esus_sync_state.last_key - uma execução interrompida (Ctrl+C, kill,
+        queda) continua desse ponto na próxima vez (ver --restart).
+        
+        since: só lê cidadãos com dt_atualizado >= since (None = tabela toda)
+        skip_unchanged: não grava pacientes cujo hash de conteúdo não mudou
+        """
         # Verificar configurações
         if not self.esus_config:
             self.logger.error("Configuração e-SUS não disponível")
@@ -170,61 +351,79 @@ class ESUSSync:
             esus_conn = self.get_esus_connection()
             mysql_conn = self.get_mysql_connection()
             
+            self.ensure_sync_schema(mysql_conn)
+            
+            if since is not None and not self.esus_has_update_column(esus_conn):
+                self.logger.warning("tb_cidadao sem dt_atualizado - lendo tabela toda, gravando apenas alterados")
+                since = None
+            
+            # Retomar execução interrompida ou que falhou (leitor/gravador) do checkpoint salvo
+            start_key = None
+            state = self.get_sync_state(mysql_conn)
+            if self.resume and state and state.get('last_status') in ('running', 'interrupted', 'failed') and state.get('last_key'):
+                start_key = state['last_key']
+                self.logger.info(f"Retomando sincronização ({state['last_status']}) a partir de co_seq_cidadao > {start_key}")
+            
             # Contar total no e-SUS
+            conditions = []
+            params = []
+            if since is not None:
+                conditions.append("AND dt_atualizado >= %s")
+                params.append(since)
+            if start_key is not None:
+                conditions.append("AND co_seq_cidadao > %s")
+                params.append(start_key)
+            
             with esus_conn.cursor() as cursor:
-                cursor.execute("""
+                cursor.execute(f"""
                     SELECT COUNT(*) FROM tb_cidadao 
                     WHERE nu_cpf IS NOT NULL 
                     AND no_cidadao IS NOT NULL
                     AND LENGTH(TRIM(no_cidadao)) > 0
-                """)
+                    {' '.join(conditions)}
+                """, params or None)
                 total_esus = cursor.fetchone()[0]
+            esus_conn.rollback()
+            
+            self.logger.info(f"Total de pacientes a processar no e-SUS: {total_esus:,}")
             
-            self.logger.info(f"Total de pacientes no e-SUS: {total_esus:,}")
+            totals = {'processed': 0, 'imported': 0, 'updated': 0, 'skipped': 0, 'errors': 0}
             
             if total_esus == 0:
+                if since is not None or start_key is not None:
+                    self.logger.info("Nenhum paciente pendente desde a última sincronização")
+                    self.save_sync_state(mysql_conn, 'success', None, totals)
+                    return True
                 self.logger.warning("Nenhum paciente encontrado no e-SUS")
                 return False
             
-            # Processar em lotes
-            batch_size = 1000
-            processed = 0
-            imported = 0
-            updated = 0
-            errors = 0
+            self.save_sync_state(mysql_conn, 'running', None, totals, last_key=start_key)
             
             start_time = datetime.now()
+            pipeline = self.run_pipeline(esus_conn, mysql_conn, totals, total_esus, start_key, since, skip_unchanged, start_time)
             
-            for offset in range(0, total_esus, batch_size):
-                batch_result = self.process_batch(esus_conn, mysql_conn, batch_size, offset)
-                processed += batch_result['processed']
-                imported += batch_result['imported']
-                updated += batch_result['updated']
-                errors += batch_result['errors']
-                
-                # Progresso
-                progress = (processed / total_esus) * 100
-                elapsed = datetime.now() - start_time
-                
-                if processed > 0:
-                    avg_time = elapsed.total_seconds() / processed
-                    remaining = (total_esus - processed) * avg_time
-                    eta = datetime.now() + timedelta(seconds=remaining)
-                    
-                    self.logger.info(f"Progresso: {progress:.1f}% ({processed:,}/{total_esus:,}) - ETA: {eta.strftime('%H:%M:%S')}")
-                else:
-                    self.logger.info(f"Progresso: {progress:.1f}% ({processed:,}/{total_esus:,})")
+            if pipeline['status'] != 'success':
+                self.save_sync_state(mysql_conn, pipeline['status'], None, totals, last_key=pipeline['last_key'])
+                self.logger.warning(f"Sincronização {label} interrompida - checkpoint salvo em co_seq_cidadao {pipeline['last_key']}")
+                if pipeline['status'] == 'interrupted':
+                    raise KeyboardInterrupt
+                return False
+            
+            self.save_sync_state(mysql_conn, 'success', pipeline['watermark'], totals)
             
             # Resultado final
             elapsed = datetime.now() - start_time
-            self.logger.info(f"Sincronização completa em {elapsed}")
-            self.logger.info(f"Importados: {imported:,}")
-            self.logger.info(f"Atualizados: {updated:,}")
-            self.logger.info(f"Erros: {errors:,}")
-            self.logger.info(f"Total processados: {processed:,}")
+            self.logger.info(f"Sincronização {label} em {elapsed}")
+            self.logger.info(f"Importados: {totals['imported']:,}")
+            self.logger.info(f"Atualizados: {totals['updated']:,}")
+            self.logger.info(f"Sem alteração (ignorados): {totals['skipped']:,}")
+            self.logger.info(f"Erros: {totals['errors']:,}")
+            self.logger.info(f"Total processados: {totals['processed']:,}")
             
             return True
             
+        except KeyboardInterrupt:
+            raise
         except Exception as e:
             self.logger.error(f"Erro na sincronização: {e}")
             return False
@@ -237,135 +436,558 @@ class ESUSSync:
             except:
                 pass
     
-    def process_batch(self, esus_conn, mysql_conn, batch_size, offset):
-        """Processar um lote de pacientes"""
-        with esus_conn.cursor(cursor_factory=RealDictCursor) as esus_cursor:
-            # Query para buscar lote
-            esus_cursor.execute("""
-                SELECT 
-                    nu_cpf, nu_cns, no_cidadao, dt_nascimento,
-                    no_mae, no_pai, no_sexo,
-                    ds_logradouro, nu_numero, no_bairro, ds_cep,
-                    nu_telefone_residencial, nu_telefone_celular, nu_telefone_contato
-                FROM tb_cidadao 
-                WHERE nu_cpf IS NOT NULL 
-                AND no_cidadao IS NOT NULL
-                AND LENGTH(TRIM(no_cidadao)) > 0
-                ORDER BY no_cidadao
-                LIMIT %s OFFSET %s
-            """, (batch_size, offset))
-            
-            patients = esus_cursor.fetchall()
-        
-        # Importar para MySQL
-        imported = 0
-        updated = 0
-        errors = 0
+    def run_pipeline(self, esus_conn, state_conn, totals, total_esus, start_key, since, skip_unchanged, start_time):
+        """Leitor (thread) → fila limitada → N gravadores; retorna status, checkpoint e marca d'água"""
+        batch_queue = queue.Queue(maxsize=self.workers * 2)
+        stop_event = threading.Event()
+        lock = threading.Lock()
+        checkpoint = SyncCheckpoint(start_key)
+        failures = []
+        result = {'watermark': None}
         
-        with mysql_conn.cursor() as mysql_cursor:
-            for patient in patients:
-                result = self.import_patient(mysql_cursor, patient)
-                if result == 'imported':
-                    imported += 1
-                elif result == 'updated':
-                    updated += 1
-                elif result == 'error':
-                    errors += 1
+        def reader():
+            try:
+                batches = self.iter_esus_batches(esus_conn, self.batch_size, after_key=start_key, since=since)
+                for seq, patients in enumerate(batches):
+                    while not stop_event.is_set():
+                        try:
+                            batch_queue.put((seq, patients), timeout=1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop_event.is_set():
+                        break
+            except Exception as e:
+                self.logger.error(f"Erro na leitura do e-SUS: {e}")
+                failures.append(e)
+                stop_event.set()
+            finally:
+                for _ in range(self.workers):
+                    batch_queue.put(None)
+        
+        def writer(number):
+            conn = None
+            try:
+                conn = self.get_writer_connection()
+                while True:
+                    item = batch_queue.get()
+                    if item is None:
+                        break
+                    if stop_event.is_set():
+                        continue  # apenas drenar a fila
+                    
+                    seq, patients = item
+                    try:
+                        batch_result = self.process_batch(conn, patients, skip_unchanged=skip_unchanged)
+                    except Exception as e:
+                        self.logger.error(f"Gravador {number}: erro no lote {seq}: {e}")
+                        failures.append(e)
+                        stop_event.set()
+                        continue
+                    
+                    with lock:
+                        for key in totals:
+                            totals[key] += batch_result[key]
+                        
+                        batch_watermark = max((p['dt_atualizado'] for p in patients if p.get('dt_atualizado')), default=None)
+                        if batch_watermark and (result['watermark'] is None or batch_watermark > result['watermark']):
+                            result['watermark'] = batch_watermark
+                        
+                        committed_key = checkpoint.complete(seq, patients[-1]['co_seq_cidadao'])
+                        self.save_sync_state(state_conn, 'running', None, totals, last_key=committed_key)
+                        self.log_progress(totals['processed'], total_esus, start_time)
+            except Exception as e:
+                self.logger.error(f"Gravador {number}: {e}")
+                failures.append(e)
+                stop_event.set()
+                # Continuar drenando para o leitor não ficar bloqueado na fila
+                while batch_queue.get() is not None:
+                    pass
+            finally:
+                if conn:
+                    conn.close()
+        
+        threads = [threading.Thread(target=reader, name='esus-reader', daemon=True)]
+        threads += [
+            threading.Thread(target=writer, args=(n,), name=f'esus-writer-{n}', daemon=True)
+            for n in range(1, self.workers + 1)
+        ]
+        for thread in threads:
+            thread.start()
+        
+        interrupted = False
+        while any(thread.is_alive() for thread in threads):
+            try:
+                for thread in threads:
+                    thread.join(0.5)
+            except KeyboardInterrupt:
+                if not interrupted:
+                    self.logger.warning("Interrompido - aguardando os lotes em gravação terminarem...")
+                interrupted = True
+                stop_event.set()
+        
+        if interrupted:
+            status = 'interrupted'
+        elif failures:
+            status = 'failed'
+        else:
+            status = 'success'
+        
+        return {'status': status, 'last_key': checkpoint.committed_key, 'watermark': result['watermark']}
+    
+    def log_progress(self, processed, total_esus, start_time):
+        """Registrar progresso, vazão e ETA"""
+        progress = (processed / total_esus) * 100
+        elapsed = (datetime.now() - start_time).total_seconds()
+        
+        if processed > 0 and elapsed > 0:
+            avg_time = elapsed / processed
+            remaining = max(total_esus - processed, 0) * avg_time
+            eta = datetime.now() + timedelta(seconds=remaining)
             
-            mysql_conn.commit()
+            self.logger.info(f"Progresso: {progress:.1f}% ({processed:,}/{total_esus:,}) - {processed / elapsed:,.0f} reg/s - ETA: {eta.strftime('%H:%M:%S')}")
+        else:
+            self.logger.info(f"Progresso: {progress:.1f}% ({processed:,}/{total_esus:,})")
+    
+    def iter_esus_batches(self, esus_conn, batch_size, after_key=None, since=None):
+        """
+        Ler tb_cidadao em lotes ordenados pela chave primária (co_seq_cidadao).
+        
+        Cada lote é uma busca por faixa no índice da PK (WHERE chave > última
+        chave lida), então o custo por lote é constante em qualquer ponto da
+        tabela e inserções/remoções no e-SUS durante a execução não fazem
+        registros serem pulados ou repetidos, como acontecia com OFFSET.
+        Apenas um lote fica em memória por vez.
+        
+        since: filtra por dt_atualizado >= since (sincronização incremental)
+        """
+        last_key = after_key
+        with_update_column = since is not None or self.esus_has_update_column(esus_conn)
+        
+        while True:
+            conditions = []
+            params = []
+            if since is not None:
+                conditions.append("AND dt_atualizado >= %s")
+                params.append(since)
+            if last_key is not None:
+                conditions.append("AND co_seq_cidadao > %s")
+                params.append(last_key)
+            params.append(batch_size)
+            
+            with esus_conn.cursor(cursor_factory=RealDictCursor) as esus_cursor:
+                esus_cursor.execute(f"""
+                    SELECT 
+                        co_seq_cidadao,{' dt_atualizado,' if with_update_column else ''}
+                        nu_cpf, nu_cns, no_cidadao, dt_nascimento,
+                        no_mae, no_pai, no_sexo,
+                        ds_logradouro, nu_numero, no_bairro, ds_cep,
+                        nu_telefone_residencial, nu_telefone_celular, nu_telefone_contato
+                    FROM tb_cidadao 
+                    WHERE nu_cpf IS NOT NULL 
+                    AND no_cidadao IS NOT NULL
+                    AND LENGTH(TRIM(no_cidadao)) > 0
+                    {' '.join(conditions)}
+                    ORDER BY co_seq_cidadao
+                    LIMIT %s
+                """, params)
+                
+                patients = esus_cursor.fetchall()
+            
+            # Fechar a transação de leitura entre lotes (não segurar snapshot)
+            esus_conn.rollback()
+            
+            if not patients:
+                break
+            
+            yield patients
+            
+            last_key = patients[-1]['co_seq_cidadao']
+            if len(patients) < batch_size:
+                break
+    
+    def process_batch(self, mysql_conn, patients, skip_unchanged=False):
+        """
+        Processar um lote de pacientes
+        
+        Deadlock (1213) ou espera de lock esgotada (1205) com outro gravador:
+        a transação é desfeita e o lote inteiro é gravado de novo.
+        """
+        for attempt in range(1, self.LOCK_RETRIES + 1):
+            try:
+                # Importar para MySQL (um upsert multi-linha por lote)
+                with mysql_conn.cursor() as mysql_cursor:
+                    result = self.upsert_batch(mysql_cursor, patients, skip_unchanged=skip_unchanged)
+                    mysql_conn.commit()
+                break
+            except mysql.connector.Error as e:
+                mysql_conn.rollback()
+                if e.errno not in self.LOCK_ERRNOS or attempt == self.LOCK_RETRIES:
+                    raise
+                self.logger.warning(f"Conflito de lock no lote ({e.errno}) - tentativa {attempt + 1} de {self.LOCK_RETRIES}")
+                time.sleep(0.2 * attempt)
         
         return {
             'processed': len(patients),
-            'imported': imported,
-            'updated': updated,
-            'errors': errors
+            'imported': result['imported'],
+            'updated': result['updated'],
+            'skipped': result['skipped'],
+            'errors': result['errors']
         }
     
+    def benchmark_read(self, mode='keyset', batch_size=None, max_batches=None):
+        """
+        Medir a vazão de leitura do e-SUS (sem gravar no MySQL).
+        
+        mode='keyset' usa iter_esus_batches; mode='offset' reproduz a paginação
+        antiga (LIMIT/OFFSET) para comparação. Registra reg/s por lote - na
+        paginação por chave a vazão deve ficar estável do início ao fim da tabela.
+        """
+        batch_size = batch_size or self.batch_size
+        
+        if not self.esus_config:
+            self.logger.error("Configuração e-SUS não disponível")
+            return False
+        
+        esus_conn = self.get_esus_connection()
+        
+        def offset_batches():
+            offset = 0
+            while True:
+                with esus_conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute("""
+                        SELECT 
+                            nu_cpf, nu_cns, no_cidadao, dt_nascimento,
+                            no_mae, no_pai, no_sexo,
+                            ds_logradouro, nu_numero, no_bairro, ds_cep,
+                            nu_telefone_residencial, nu_telefone_celular, nu_telefone_contato
+                        FROM tb_cidadao 
+                        WHERE nu_cpf IS NOT NULL 
+                        AND no_cidadao IS NOT NULL
+                        AND LENGTH(TRIM(no_cidadao)) > 0
+                        ORDER BY no_cidadao
+                        LIMIT %s OFFSET %s
+                    """, (batch_size, offset))
+                    rows = cursor.fetchall()
+                esus_conn.rollback()
+                if not rows:
+                    break
+                yield rows
+                offset += batch_size
+        
+        batches = self.iter_esus_batches(esus_conn, batch_size) if mode == 'keyset' else offset_batches()
+        
+        self.logger.info(f"Benchmark de leitura e-SUS - modo: {mode}, lote: {batch_size}")
+        
+        rates = []
+        total_rows = 0
+        start_time = time.perf_counter()
+        batch_start = start_time
+        
+        try:
+            for number, rows in enumerate(batches, start=1):
+                now = time.perf_counter()
+                rate = len(rows) / max(now - batch_start, 1e-6)
+                rates.append(rate)
+                total_rows += len(rows)
+                self.logger.info(f"Lote {number}: {total_rows:,} registros lidos - {rate:,.0f} reg/s")
+                
+                if max_batches and number >= max_batches:
+                    break
+                batch_start = time.perf_counter()
+        finally:
+            esus_conn.close()
+        
+        if not rates:
+            self.logger.warning("Nenhum registro lido")
+            return False
+        
+        elapsed = time.perf_counter() - start_time
+        tenth = max(len(rates) // 10, 1)
+        first = sum(rates[:tenth]) / tenth
+        last = sum(rates[-tenth:]) / tenth
+        
+        self.logger.info(f"Total: {total_rows:,} registros em {elapsed:.1f}s ({total_rows / elapsed:,.0f} reg/s)")
+        self.logger.info(f"Vazão média - primeiros 10% dos lotes: {first:,.0f} reg/s | últimos 10%: {last:,.0f} reg/s ({last / first:.2f}x)")
+        return True
+    
     def safe_strip(self, value):
         """Fazer strip seguro em valores que podem ser None"""
         if value is None:
             return None
         return str(value).strip() if str(value).strip() else None
     
+    # Sobreposição aplicada à marca d'água na sincronização incremental
+    WATERMARK_OVERLAP_MINUTES = 10
+    
+    # Deadlock / lock wait timeout entre gravadores: regravar o lote
+    LOCK_ERRNOS = (1213, 1205)
+    LOCK_RETRIES = 3
+    
+    # Colunas gravadas pelo import (na ordem dos placeholders)
+    INSERT_COLUMNS = (
+        'cpf', 'cns', 'full_name', 'search_name', 'birth_date', 'mother_name', 'father_name',
+        'gender', 'address', 'number', 'neighborhood', 'zip_code', 'city', 'state',
+        'cell_phone', 'home_phone', 'contact_phone', 'source', 'esus_sync_date',
+        'esus_hash', 'is_active', 'created_at', 'updated_at'
+    )
+    
+    # Colunas atualizadas quando o CPF já existe localmente
+    UPDATE_COLUMNS = (
+        'cns', 'full_name', 'search_name', 'birth_date', 'mother_name', 'father_name', 'gender',
+        'address', 'number', 'neighborhood', 'zip_code', 'city', 'state',
+        'cell_phone', 'home_phone', 'contact_phone', 'esus_sync_date', 'esus_hash', 'updated_at'
+    )
+    
+    # Campos que compõem o hash de conteúdo (dados vindos do e-SUS)
+    HASH_COLUMNS = (
+        'cpf', 'cns', 'full_name', 'birth_date', 'mother_name', 'father_name', 'gender',
+        'address', 'number', 'neighborhood', 'zip_code', 'city', 'state',
+        'cell_phone', 'home_phone', 'contact_phone'
+    )
+    
+    def content_hash(self, data):
+        """SHA-256 dos campos mapeados - muda apenas quando o e-SUS muda o cadastro"""
+        values = []
+        for column in self.HASH_COLUMNS:
+            value = data.get(column)
+            if value is None:
+                values.append('')
+            elif hasattr(value, 'isoformat'):
+                values.append(value.isoformat())
+            else:
+                values.append(str(value))
+        return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+    
+    def map_patient(self, patient_data):
+        """Converter registro do e-SUS para colunas locais (None se inválido)"""
+        # Limpar e validar dados
+        cpf = self.clean_cpf(patient_data.get('nu_cpf'))
+        if not cpf:
+            return None
+        
+        full_name = self.safe_strip(patient_data.get('no_cidadao'))
+        if not full_name:
+            return None
+        
+        now = datetime.now()
+        
+        # Preparar dados com valores seguros
+        data = {
+            'cpf': cpf,
+            'cns': self.clean_cns(patient_data.get('nu_cns')),
+            'full_name': full_name,
+            'birth_date': patient_data.get('dt_nascimento'),
+            'mother_name': self.safe_strip(patient_data.get('no_mae')),
+            'father_name': self.safe_strip(patient_data.get('no_pai')),
+            'gender': self.map_gender(patient_data.get('no_sexo')),
+            'address': self.safe_strip(patient_data.get('ds_logradouro')),
+            'number': self.safe_strip(patient_data.get('nu_numero')),
+            'neighborhood': self.safe_strip(patient_data.get('no_bairro')),
+            'zip_code': self.clean_cep(patient_data.get('ds_cep')),
+            'city': 'Cosmópolis',  # Valor fixo para resolver o erro
+            'state': 'SP',  # Valor fixo
+            'cell_phone': self.clean_phone(patient_data.get('nu_telefone_celular')),
+            'home_phone': self.clean_phone(patient_data.get('nu_telefone_residencial')),
+            'contact_phone': self.clean_phone(patient_data.get('nu_telefone_contato')),
+            'source': 'imported',
+            'esus_sync_date': now,
+            'is_active': True,
+            'created_at': now,
+            # UTC como o onupdate do modelo: MAX(updated_at) versiona o cache de relatórios
+            'updated_at': datetime.utcnow()
+        }
+        data['esus_hash'] = self.content_hash(data)
+        data['search_name'] = normalize_name(full_name)[:100] or None
+        return data
+    
+    def upsert_sql(self, row_count):
+        """INSERT ... ON DUPLICATE KEY UPDATE para row_count linhas"""
+        placeholders = '(' + ', '.join(['%s'] * len(self.INSERT_COLUMNS)) + ')'
+        updates = ', '.join(f"{column} = VALUES({column})" for column in self.UPDATE_COLUMNS)
+        return f"""
+            INSERT INTO patients ({', '.join(self.INSERT_COLUMNS)})
+            VALUES {', '.join([placeholders] * row_count)}
+            ON DUPLICATE KEY UPDATE {updates}
+        """
+    
+    def upsert_batch(self, cursor, patients, skip_unchanged=False):
+        """
+        Gravar um lote inteiro com um único INSERT ... ON DUPLICATE KEY UPDATE.
+        
+        Uma consulta prévia (CPF/CNS IN (...)) separa inserções de atualizações
+        e descarta linhas cujo CNS já pertence a outro CPF - no upsert elas
+        atualizariam o paciente errado pela chave única de cns. Se o comando em
+        lote falhar, o lote é regravado linha a linha para isolar o erro.
+        
+        skip_unchanged: pacientes cujo esus_hash local é igual ao hash do
+        registro atual do e-SUS não são gravados (custo zero de escrita).
+        """
+        imported = 0
+        updated = 0
+        skipped = 0
+        errors = 0
+        
+        # Mapear e remover CPFs repetidos dentro do lote (vale o último)
+        rows = {}
+        for patient in patients:
+            data = self.map_patient(patient)
+            if data:
+                rows[data['cpf']] = data
+        
+        if not rows:
+            return {'imported': 0, 'updated': 0, 'skipped': 0, 'errors': 0}
+        
+        cpfs = list(rows)
+        cnss = list({data['cns'] for data in rows.values() if data['cns']})
+        
+        conditions = [f"cpf IN ({', '.join(['%s'] * len(cpfs))})"]
+        params = list(cpfs)
+        if cnss:
+            conditions.append(f"cns IN ({', '.join(['%s'] * len(cnss))})")
+            params.extend(cnss)
+        
+        cursor.execute(f"SELECT cpf, cns, esus_hash FROM patients WHERE {' OR '.join(conditions)}", params)
+        existing_cpfs = set()
+        existing_hashes = {}
+        cns_owner = {}
+        for cpf, cns, esus_hash in cursor.fetchall():
+            existing_cpfs.add(cpf)
+            existing_hashes[cpf] = esus_hash
+            if cns:
+                cns_owner[cns] = cpf
+        
+        valid = []
+        for data in rows.values():
+            if skip_unchanged and existing_hashes.get(data['cpf']) == data['esus_hash']:
+                skipped += 1
+                continue
+            
+            owner = cns_owner.get(data['cns']) if data['cns'] else None
+            if owner and owner != data['cpf']:
+                self.logger.error(f"Erro ao importar paciente {data['full_name']}: CNS {data['cns']} já cadastrado para outro CPF")
+                errors += 1
+                continue
+            if data['cns']:
+                cns_owner[data['cns']] = data['cpf']
+            valid.append(data)
+        
+        if not valid:
+            return {'imported': 0, 'updated': 0, 'skipped': skipped, 'errors': errors}
+        
+        try:
+            params = [data[column] for data in valid for column in self.INSERT_COLUMNS]
+            cursor.execute(self.upsert_sql(len(valid)), params)
+            
+            for data in valid:
+                if data['cpf'] in existing_cpfs:
+                    updated += 1
+                else:
+                    imported += 1
+            written = valid
+                    
+        except Exception as e:
+            if getattr(e, 'errno', None) in self.LOCK_ERRNOS:
+                raise  # transação desfeita pelo InnoDB: process_batch regrava o lote
+            self.logger.warning(f"Falha no upsert em lote ({e}) - regravando linha a linha")
+            
+            written = []
+            for data in valid:
+                try:
+                    cursor.execute(self.upsert_sql(1), [data[column] for column in self.INSERT_COLUMNS])
+                    if data['cpf'] in existing_cpfs:
+                        updated += 1
+                    else:
+                        imported += 1
+                    written.append(data)
+                except Exception as row_error:
+                    if getattr(row_error, 'errno', None) in self.LOCK_ERRNOS:
+                        raise
+                    self.logger.error(f"Erro ao importar paciente {data['full_name']}: {row_error}")
+                    errors += 1
+        
+        self.write_search_index(cursor, written, existing_cpfs)
+        
+        return {'imported': imported, 'updated': updated, 'skipped': skipped, 'errors': errors}
+    
+    def write_search_index(self, cursor, written, existing_cpfs):
+        """
+        Regravar patient_name_tokens e patient_digit_suffixes dos pacientes gravados no lote
+        
+        Só os pacientes que já existiam têm tokens antigos a apagar: um DELETE
+        pelos ids recém-inseridos não encontra nada e, em REPEATABLE READ, deixa
+        gap locks que travam (1213) os INSERTs dos outros gravadores.
+        """
+        if not written:
+            return
+        
+        cpfs = [data['cpf'] for data in written]
+        cursor.execute(
+            f"SELECT id, cpf, phone FROM patients WHERE cpf IN ({', '.join(['%s'] * len(cpfs))})",
+            cpfs
+        )
+        # phone não vem do e-SUS - o valor local continua indexado
+        local = {cpf: (patient_id, phone) for patient_id, cpf, phone in cursor.fetchall()}
+        if not local:
+            return
+        
+        ids = [patient_id for cpf, (patient_id, _) in local.items() if cpf in existing_cpfs]
+        if ids:
+            placeholders = ', '.join(['%s'] * len(ids))
+            cursor.execute(f"DELETE FROM patient_name_tokens WHERE patient_id IN ({placeholders})", ids)
+            cursor.execute(f"DELETE FROM patient_digit_suffixes WHERE patient_id IN ({placeholders})", ids)
+        
+        tokens = []
+        suffixes = []
+        for data in written:
+            if data['cpf'] not in local:
+                continue
+            patient_id, phone = local[data['cpf']]
+            tokens.extend(token_rows(patient_id, data['full_name'], data['mother_name']))
+            suffixes.extend(digit_rows(
+                patient_id, data['cpf'], data['cns'],
+                [data['cell_phone'], data['home_phone'], data['contact_phone'], phone]
+            ))
+        
+        if tokens:
+            cursor.executemany(
+                "INSERT INTO patient_name_tokens (patient_id, field, token) VALUES (%s, %s, %s)",
+                tokens
+            )
+        if suffixes:
+            cursor.executemany(
+                "INSERT INTO patient_digit_suffixes (patient_id, field, suffix) VALUES (%s, %s, %s)",
+                suffixes
+            )
+    
     def import_patient(self, cursor, patient_data):
         """Importar um paciente para MySQL"""
         try:
-            # Limpar e validar dados
-            cpf = self.clean_cpf(patient_data.get('nu_cpf'))
-            if not cpf:
-                return 'skipped'
-            
-            full_name = self.safe_strip(patient_data.get('no_cidadao'))
-            if not full_name:
+            data = self.map_patient(patient_data)
+            if not data:
                 return 'skipped'
             
             # Verificar se já existe
-            cursor.execute("SELECT id FROM patients WHERE cpf = %s", (cpf,))
+            cursor.execute("SELECT id FROM patients WHERE cpf = %s", (data['cpf'],))
             existing = cursor.fetchone()
             
-            # Preparar dados com valores seguros
-            data = {
-                'cpf': cpf,
-                'cns': self.clean_cns(patient_data.get('nu_cns')),
-                'full_name': full_name,
-                'birth_date': patient_data.get('dt_nascimento'),
-                'mother_name': self.safe_strip(patient_data.get('no_mae')),
-                'father_name': self.safe_strip(patient_data.get('no_pai')),
-                'gender': self.map_gender(patient_data.get('no_sexo')),
-                'address': self.safe_strip(patient_data.get('ds_logradouro')),
-                'number': self.safe_strip(patient_data.get('nu_numero')),
-                'neighborhood': self.safe_strip(patient_data.get('no_bairro')),
-                'zip_code': self.clean_cep(patient_data.get('ds_cep')),
-                'city': 'Cosmópolis',  # Valor fixo para resolver o erro
-                'state': 'SP',  # Valor fixo
-                'cell_phone': self.clean_phone(patient_data.get('nu_telefone_celular')),
-                'home_phone': self.clean_phone(patient_data.get('nu_telefone_residencial')),
-                'contact_phone': self.clean_phone(patient_data.get('nu_telefone_contato')),
-                'source': 'imported',
-                'esus_sync_date': datetime.now()
-            }
-            
             if existing:
                 # Atualizar
-                update_sql = """
-                    UPDATE patients SET
-                        cns = %s, full_name = %s, birth_date = %s,
-                        mother_name = %s, father_name = %s, gender = %s,
-                        address = %s, number = %s, neighborhood = %s, 
-                        zip_code = %s, city = %s, state = %s,
-                        cell_phone = %s, home_phone = %s, contact_phone = %s,
-                        esus_sync_date = %s
-                    WHERE cpf = %s
-                """
-                cursor.execute(update_sql, (
-                    data['cns'], data['full_name'], data['birth_date'],
-                    data['mother_name'], data['father_name'], data['gender'],
-                    data['address'], data['number'], data['neighborhood'], 
-                    data['zip_code'], data['city'], data['state'],
-                    data['cell_phone'], data['home_phone'], data['contact_phone'],
-                    data['esus_sync_date'], cpf
-                ))
+                assignments = ', '.join(f"{column} = %s" for column in self.UPDATE_COLUMNS)
+                cursor.execute(
+                    f"UPDATE patients SET {assignments} WHERE cpf = %s",
+                    [data[column] for column in self.UPDATE_COLUMNS] + [data['cpf']]
+                )
+                self.write_search_index(cursor, [data], {data['cpf']})
                 return 'updated'
             else:
                 # Inserir
-                insert_sql = """
-                    INSERT INTO patients (
-                        cpf, cns, full_name, birth_date, mother_name, father_name,
-                        gender, address, number, neighborhood, zip_code, city, state,
-                        cell_phone, home_phone, contact_phone, source, esus_sync_date,
-                        is_active, created_at
-                    ) VALUES (
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                    )
-                """
-                cursor.execute(insert_sql, (
-                    data['cpf'], data['cns'], data['full_name'], data['birth_date'],
-                    data['mother_name'], data['father_name'], data['gender'],
-                    data['address'], data['number'], data['neighborhood'], 
-                    data['zip_code'], data['city'], data['state'],
-                    data['cell_phone'], data['home_phone'], data['contact_phone'],
-                    data['source'], data['esus_sync_date'], True, datetime.now()
-                ))
+                placeholders = ', '.join(['%s'] * len(self.INSERT_COLUMNS))
+                cursor.execute(
+                    f"INSERT INTO patients ({', '.join(self.INSERT_COLUMNS)}) VALUES ({placeholders})",
+                    [data[column] for column in self.INSERT_COLUMNS]
+                )
+                self.write_search_index(cursor, [data], set())
                 return 'imported'
                 
         except Exception as e:
@@ -373,22 +995,37 @@ class ESUSSync:
             return 'error'
     
     def sync_incremental(self, days=1):
-        """Sincronização incremental (últimos X dias)"""
-        self.logger.info(f"Sincronização incremental (últimos {days} dias)...")
+        """
+        Sincronização incremental.
+        
+        Lê apenas cidadãos com dt_atualizado a partir da marca d'água salva em
+        esus_sync_state (ou dos últimos X dias, na primeira execução) e grava
+        somente pacientes cujo hash de conteúdo mudou.
+        """
+        self.logger.info(f"Sincronização incremental (últimos {days} dias se não houver marca d'água)...")
         
         if not self.esus_config:
             self.logger.error("Configuração e-SUS não disponível")
             return False
         
         try:
-            # Calcular data limite
-            cutoff_date = datetime.now() - timedelta(days=days)
+            mysql_conn = self.get_mysql_connection()
+            try:
+                self.ensure_sync_schema(mysql_conn)
+                state = self.get_sync_state(mysql_conn)
+            finally:
+                mysql_conn.close()
+            
+            if state and state.get('last_watermark'):
+                # Pequena sobreposição para registros gravados no e-SUS com atraso;
+                # o hash evita regravar o que já foi sincronizado
+                since = state['last_watermark'] - timedelta(minutes=self.WATERMARK_OVERLAP_MINUTES)
+            else:
+                since = datetime.now() - timedelta(days=days)
             
-            self.logger.info(f"Buscando pacientes alterados desde {cutoff_date.strftime('%d/%m/%Y %H:%M')}")
+            self.logger.info(f"Buscando pacientes alterados desde {since.strftime('%d/%m/%Y %H:%M')}")
             
-            # Implementar lógica incremental se houver campo de data de atualização
-            # Por enquanto, fazer sync completa com limite menor
-            return self.sync_full()
+            return self.run_sync(since=since, skip_unchanged=True, label='incremental')
             
         except Exception as e:
             self.logger.error(f"Erro na sincronização incremental: {e}")
@@ -437,13 +1074,21 @@ def main():
     parser.add_argument('--full', action='store_true', help='Sincronização completa')
     parser.add_argument('--incremental', type=int, metavar='DAYS', help='Sincronização incremental (últimos X dias)')
     parser.add_argument('--test', action='store_true', help='Testar conexões')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Tamanho do lote (padrão: 1000)')
+    parser.add_argument('--workers', type=int, default=4, help='Gravadores MySQL em paralelo (padrão: 4)')
+    parser.add_argument('--restart', action='store_true', help='Ignorar checkpoint de execução interrompida e começar do início')
+    parser.add_argument('--benchmark', choices=['keyset', 'offset'], help='Medir vazão de leitura do e-SUS (sem gravar)')
+    parser.add_argument('--benchmark-batches', type=int, metavar='N', help='Limitar o benchmark a N lotes')
     
     args = parser.parse_args()
     
     try:
-        sync = ESUSSync()
+        sync = ESUSSync(batch_size=args.batch_size, workers=args.workers, resume=not args.restart)
         
-        if args.test:
+        if args.benchmark:
+            success = sync.benchmark_read(args.benchmark, max_batches=args.benchmark_batches)
+            sys.exit(0 if success else 1)
+        elif args.test:
             print("Testando conexões...")
             success = sync.test_connections()
             sys.exit(0 if success else 1)
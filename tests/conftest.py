@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+# Banco em memória (TestingConfig lê a variável na importação de config)
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite://')
+
+from app import create_app
+from app.database import db as _db
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+        _db.drop_all()
+
+@pytest.fixture
+def db(app):
+    return _db
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def login(client, user):
+    """Sessão do Flask-Login para o usuário, sem passar pela tela de login"""
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
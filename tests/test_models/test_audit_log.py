@@ -0,0 +1,33 @@
+import json
+
+from app.audit_log import AuditLogWriter
+from app.models import AuditLog
+
+def _writer(app, tmp_path):
+    writer = AuditLogWriter()
+    writer.init_app(app)
+    writer.fallback_path = str(tmp_path / 'audit_fallback.jsonl')
+    return writer
+
+def test_sync_write_goes_to_database(app, db, tmp_path):
+    writer = _writer(app, tmp_path)
+    assert not writer.enabled  # TESTING: gravação na hora
+    
+    writer.enqueue({'action': 'LOGIN', 'table_name': 'users', 'record_id': 1})
+    
+    assert [(log.action, log.table_name) for log in AuditLog.query.all()] == [('LOGIN', 'users')]
+
+def test_sync_write_failure_spills_to_fallback_file(app, db, tmp_path):
+    writer = _writer(app, tmp_path)
+    AuditLog.__table__.drop(db.engine)
+    
+    writer.enqueue({'action': 'LOGIN', 'table_name': 'users', 'record_id': 1})
+    
+    with open(writer.fallback_path, encoding='utf-8') as file:
+        records = [json.loads(line) for line in file]
+    assert [(record['action'], record['record_id']) for record in records] == [('LOGIN', 1)]
+    
+    # Banco de volta: o arquivo é regravado na tabela
+    AuditLog.__table__.create(db.engine)
+    assert writer.replay_fallback() == 1
+    assert AuditLog.query.count() == 1
@@ -0,0 +1,77 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from app.cache import MISSING, TTLCache, dashboard_stats_cache, patient_search_cache
+from app.dashboard_stats import DashboardStatsService
+from app.models import Medication, Patient
+
+@pytest.fixture(autouse=True)
+def empty_caches(db):
+    patient_search_cache.clear()
+    dashboard_stats_cache.clear()
+
+def _patient(cpf='12345678901'):
+    return Patient(cpf=cpf, full_name='Paciente', birth_date=date(1980, 1, 1))
+
+def test_ttl_cache_expires_and_evicts_least_recently_used():
+    cache = TTLCache('test', maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    
+    cache.set('expired', 4, ttl=-1)
+    assert cache.get('expired') is MISSING
+
+def test_get_or_set_ignores_value_computed_before_clear():
+    cache = TTLCache('test')
+    
+    def compute():
+        cache.clear()  # gravação commitada enquanto o valor era calculado
+        return 'antigo'
+    
+    assert cache.get_or_set('key', compute) == 'antigo'
+    assert cache.get('key') is MISSING
+
+def test_model_write_clears_typeahead_cache_only_after_commit(db):
+    patient_search_cache.set('paciente', ['resultado antigo'])
+    
+    db.session.add(_patient())
+    db.session.flush()
+    assert patient_search_cache.get('paciente') == ['resultado antigo']
+    
+    db.session.commit()
+    assert patient_search_cache.get('paciente') is MISSING
+
+def test_rollback_keeps_typeahead_cache(db):
+    patient_search_cache.set('paciente', ['resultado'])
+    
+    db.session.add(_patient())
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    
+    assert patient_search_cache.get('paciente') == ['resultado']
+
+def test_dashboard_section_invalidated_only_by_its_columns(db):
+    medication = Medication(commercial_name='Losartana', generic_name='losartana', dosage='50mg',
+                            pharmaceutical_form='comprimido', current_stock=10, unit_cost=Decimal('1.50'))
+    db.session.add(medication)
+    db.session.commit()
+    DashboardStatsService.section('medications')
+    DashboardStatsService.section('patients')
+    key = ('medications', date.today())
+    
+    medication.generic_name = 'losartana potássica'
+    db.session.commit()
+    assert dashboard_stats_cache.get(key) is not MISSING
+    
+    medication.current_stock = 0
+    db.session.commit()
+    assert dashboard_stats_cache.get(key) is MISSING
+    assert dashboard_stats_cache.get(('patients', date.today())) is not MISSING  # outra tabela
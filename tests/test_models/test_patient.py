@@ -0,0 +1,58 @@
+from datetime import date
+
+from app.database import upgrade_schema
+from app.models import Patient, PatientDigitSuffix, PatientNameToken
+
+def _patients(db):
+    db.session.add_all([
+        Patient(cpf='12345678901', full_name='João da Silva', mother_name='Maria Conceição',
+                birth_date=date(1960, 5, 1), cell_phone='19998765432'),
+        Patient(cpf='98765432100', full_name='Ana Lúcia Souza', mother_name='Inês Souza',
+                birth_date=date(1985, 9, 12))
+    ])
+    db.session.commit()
+
+def _names(term, fields=('name',)):
+    return sorted(patient.full_name for patient in Patient.query.filter(Patient.name_filter(term, fields)))
+
+def test_name_filter_ignores_accents_and_matches_prefixes(db):
+    _patients(db)
+    
+    assert _names('joao sil') == ['João da Silva']
+    assert _names('LUCIA') == ['Ana Lúcia Souza']
+    assert _names('conceicao', fields=('mother',)) == ['João da Silva']
+    assert _names('silva souza') == []
+
+def test_upgrade_schema_backfills_new_name_index(db):
+    """Banco existente: patient_name_tokens criada agora já nasce preenchida"""
+    _patients(db)
+    PatientNameToken.__table__.drop(db.engine)
+    db.session.execute(Patient.__table__.update().values(search_name=None))
+    db.session.commit()
+    
+    added = upgrade_schema()
+    
+    assert any(item.startswith('rebuild_search_index') for item in added)
+    assert _names('joao') == ['João da Silva']
+    assert Patient.query.filter(Patient.search_name == 'JOAO DA SILVA').count() == 1
+
+def _cpfs(term, fields=('cpf', 'cns', 'phone')):
+    return sorted(patient.cpf for patient in Patient.query.filter(Patient.digits_filter(term, fields)))
+
+def test_digits_filter_matches_any_part_of_the_number(db):
+    _patients(db)
+    
+    assert _cpfs('456.789') == ['12345678901']
+    assert _cpfs('8765') == ['12345678901', '98765432100']
+    assert _cpfs('8765', fields=('phone',)) == ['12345678901']
+    assert _cpfs('98') == ['98765432100']  # menos de 3 dígitos: prefixo
+
+def test_upgrade_schema_backfills_new_digit_index(db):
+    """Banco existente: patient_digit_suffixes criada agora já nasce preenchida"""
+    _patients(db)
+    PatientDigitSuffix.__table__.drop(db.engine)
+    
+    added = upgrade_schema()
+    
+    assert any(item.startswith('rebuild_search_index') for item in added)
+    assert _cpfs('5432') == ['12345678901', '98765432100']
@@ -0,0 +1,95 @@
+from datetime import date
+from decimal import Decimal
+
+from app.models import (
+    Dispensation, DispensationItem, DispensationStatus, Medication, Patient, User,
+    DispensationDailyMedication, DispensationDailyDispenser, DispensationDailyPatientBucket
+)
+from app.database import upgrade_schema
+from app.rollups import ROLLUP_MODELS, age_bucket
+
+def _fixtures(db):
+    user = User(username='atendente', email='atendente@example.com', password_hash='x', full_name='Atendente')
+    patient = Patient(cpf='12345678901', full_name='Paciente', birth_date=date(1980, 1, 1), gender='F')
+    medications = [
+        Medication(commercial_name=f'Med {n}', generic_name=f'med {n}', dosage='10mg',
+                   pharmaceutical_form='comprimido', current_stock=100, unit_cost=Decimal('2.50'))
+        for n in range(2)
+    ]
+    db.session.add_all([user, patient] + medications)
+    db.session.commit()
+    return user, patient, medications
+
+def _dispense(db, user, patient, medications, quantities):
+    dispensation = Dispensation(patient_id=patient.id, dispenser_id=user.id, status=DispensationStatus.COMPLETED)
+    db.session.add(dispensation)
+    db.session.flush()
+    for medication, quantity in zip(medications, quantities):
+        db.session.add(DispensationItem(
+            dispensation_id=dispensation.id, medication_id=medication.id, quantity_dispensed=quantity,
+            unit_cost=medication.unit_cost, total_cost=medication.unit_cost * quantity
+        ))
+    db.session.commit()
+    return dispensation
+
+def test_dispensation_create_flush_fills_rollups(db):
+    """Mesma sequência de dispensation_create: objetos criados só com os ids"""
+    user, patient, medications = _fixtures(db)
+    
+    dispensation = Dispensation(patient_id=patient.id, dispenser_id=user.id, status=DispensationStatus.COMPLETED)
+    db.session.add(dispensation)
+    db.session.flush()
+    
+    total = Decimal('0.00')
+    for medication, quantity in zip(medications, (3, 5)):
+        cost = medication.unit_cost * quantity
+        total += cost
+        db.session.add(DispensationItem(
+            dispensation_id=dispensation.id, medication_id=medication.id,
+            quantity_dispensed=quantity, unit_cost=medication.unit_cost, total_cost=cost
+        ))
+        db.session.flush()
+    
+    dispensation.total_cost = total
+    db.session.commit()
+    
+    day = dispensation.dispensation_date.date()
+    
+    rows = {row.medication_id: row for row in DispensationDailyMedication.query.all()}
+    assert set(rows) == {medication.id for medication in medications}
+    assert [(rows[m.id].day, rows[m.id].dispenser_id, rows[m.id].quantity, rows[m.id].total_cost, rows[m.id].items_count)
+            for m in medications] == [
+        (day, user.id, 3, Decimal('7.50'), 1),
+        (day, user.id, 5, Decimal('12.50'), 1)
+    ]
+    
+    dispensers = DispensationDailyDispenser.query.all()
+    assert [(r.day, r.dispenser_id, r.dispensations_count, r.completed_count, r.completed_cost) for r in dispensers] == [
+        (day, user.id, 1, 1, Decimal('20.00'))
+    ]
+    
+    buckets = DispensationDailyPatientBucket.query.all()
+    assert [(r.day, r.age_bucket, r.gender, r.dispensations_count, r.total_cost) for r in buckets] == [
+        (day, age_bucket(patient.birth_date, day), 'F', 1, Decimal('20.00'))
+    ]
+
+def test_upgrade_schema_backfills_new_rollup_tables(db):
+    """Banco existente: tabelas de agregados criadas agora já nascem preenchidas"""
+    user, patient, medications = _fixtures(db)
+    _dispense(db, user, patient, medications, (3, 5))
+    _dispense(db, user, patient, medications[:1], (2,))
+    first, second = (medication.id for medication in medications)
+    db.session.remove()
+    
+    for model in ROLLUP_MODELS:
+        model.__table__.drop(db.engine)
+    
+    added = upgrade_schema()
+    
+    assert any(item.startswith('rebuild_rollups') for item in added)
+    quantities = {row.medication_id: row.quantity for row in DispensationDailyMedication.query.all()}
+    assert quantities == {first: 5, second: 5}
+    assert [row.dispensations_count for row in DispensationDailyDispenser.query.all()] == [2]
+
+def test_upgrade_schema_without_new_tables_skips_backfill(db):
+    assert not any(item.startswith('rebuild_rollups') for item in upgrade_schema())
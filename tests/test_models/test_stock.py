@@ -0,0 +1,52 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from app.cache import MISSING, dashboard_stats_cache, medication_search_cache
+from app.dashboard_stats import DashboardStatsService
+from app.models import Medication
+from app.stock import InsufficientStockError, StockService
+
+@pytest.fixture
+def medication(db):
+    medication = Medication(commercial_name='Losartana', generic_name='losartana', dosage='50mg',
+                            pharmaceutical_form='comprimido', current_stock=10, minimum_stock=3,
+                            unit_cost=Decimal('1.50'))
+    db.session.add(medication)
+    db.session.commit()
+    dashboard_stats_cache.clear()
+    medication_search_cache.clear()
+    return medication
+
+def _stock(db, medication_id):
+    db.session.expire_all()
+    return db.session.get(Medication, medication_id).current_stock
+
+def test_lock_reads_current_stock(db, medication):
+    assert StockService.lock([medication.id]) == {medication.id: 10}
+
+def test_decrement_is_atomic_and_guarded(db, medication):
+    StockService.decrement(medication, 4)
+    db.session.commit()
+    assert _stock(db, medication.id) == 6
+    
+    with pytest.raises(InsufficientStockError, match='Losartana'):
+        StockService.decrement(medication, 7)
+    db.session.rollback()
+    assert _stock(db, medication.id) == 6
+
+def test_decrement_invalidates_caches_after_commit(db, medication):
+    """O UPDATE não passa pelo ORM: caches e eventos são agendados pelo serviço"""
+    before = DashboardStatsService.section('medications')
+    medication_search_cache.set('losartana', ['Losartana'])
+    
+    StockService.decrement(medication, 8)
+    # Antes do commit o bloco continua em cache (outra thread ainda vê o estoque antigo)
+    assert dashboard_stats_cache.get(('medications', date.today())) is not MISSING
+    db.session.commit()
+    
+    assert dashboard_stats_cache.get(('medications', date.today())) is MISSING
+    
+    assert medication_search_cache.get('losartana') is MISSING
+    assert DashboardStatsService.section('medications')['low_stock'] == before['low_stock'] + 1
@@ -0,0 +1,114 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+from app.models import (
+    Dispensation, IdempotencyKey, InventoryMovement, Medication, Patient, User, UserRole
+)
+from app.stock import StockService
+from tests.conftest import login
+
+@pytest.fixture
+def staff(db):
+    user = User(username='atendente', email='atendente@example.com', password_hash='x',
+                full_name='Atendente', role=UserRole.ATTENDANT)
+    patient = Patient(cpf='12345678901', full_name='Paciente', birth_date=date(1980, 1, 1))
+    medication = Medication(commercial_name='Losartana', generic_name='losartana', dosage='50mg',
+                            pharmaceutical_form='comprimido', current_stock=10, unit_cost=Decimal('1.50'))
+    db.session.add_all([user, patient, medication])
+    db.session.commit()
+    return user, patient, medication
+
+def _payload(patient, medication, quantity):
+    return {
+        'patient_id': patient.id,
+        'medications': [{
+            'medication_id': medication.id,
+            'quantity': quantity,
+            'interval_control': {
+                'enabled': True,
+                'interval_days': 30,
+                'next_allowed_date': (date.today() + timedelta(days=30)).isoformat()
+            }
+        }]
+    }
+
+def _stock(db, medication_id):
+    db.session.expire_all()
+    return db.session.get(Medication, medication_id).current_stock
+
+def test_dispensation_decrements_stock(client, db, staff):
+    user, patient, medication = staff
+    login(client, user)
+    
+    response = client.post('/dispensation/create', json=_payload(patient, medication, 4))
+    
+    assert response.status_code == 200, response.get_json()
+    assert _stock(db, medication.id) == 6
+    movement = InventoryMovement.query.one()
+    assert (movement.previous_stock, movement.new_stock, movement.quantity) == (10, 6, 4)
+
+def test_insufficient_stock_returns_409_and_keeps_stock(client, db, staff):
+    user, patient, medication = staff
+    login(client, user)
+    
+    response = client.post('/dispensation/create', json=_payload(patient, medication, 11))
+    
+    assert response.status_code == 409
+    assert 'Estoque insuficiente' in response.get_json()['error']
+    assert _stock(db, medication.id) == 10
+    assert Dispensation.query.count() == 0
+    assert InventoryMovement.query.count() == 0
+
+def test_repeated_idempotency_key_replays_response(client, db, staff):
+    user, patient, medication = staff
+    login(client, user)
+    headers = {'Idempotency-Key': 'page-load-0001'}
+    
+    first = client.post('/dispensation/create', json=_payload(patient, medication, 3), headers=headers)
+    second = client.post('/dispensation/create', json=_payload(patient, medication, 3), headers=headers)
+    
+    assert first.status_code == second.status_code == 200
+    assert second.headers.get('Idempotent-Replayed') == 'true'
+    assert second.get_json() == first.get_json()
+    assert Dispensation.query.count() == 1
+    assert _stock(db, medication.id) == 7
+
+def test_idempotency_key_reused_with_other_body_is_rejected(client, db, staff):
+    user, patient, medication = staff
+    login(client, user)
+    headers = {'Idempotency-Key': 'page-load-0002'}
+    
+    client.post('/dispensation/create', json=_payload(patient, medication, 3), headers=headers)
+    response = client.post('/dispensation/create', json=_payload(patient, medication, 5), headers=headers)
+    
+    assert response.status_code == 422
+    assert _stock(db, medication.id) == 7
+
+def test_failed_request_releases_idempotency_key(client, db, staff):
+    user, patient, medication = staff
+    login(client, user)
+    headers = {'Idempotency-Key': 'page-load-0003'}
+    
+    failed = client.post('/dispensation/create', json=_payload(patient, medication, 11), headers=headers)
+    assert failed.status_code == 409
+    assert IdempotencyKey.query.count() == 0
+    
+    retried = client.post('/dispensation/create', json=_payload(patient, medication, 2), headers=headers)
+    assert retried.status_code == 200
+    assert _stock(db, medication.id) == 8
+
+def test_concurrent_stock_change_is_caught_by_guarded_decrement(client, db, staff, monkeypatch):
+    """Outra dispensação baixou o estoque depois da leitura: o UPDATE condicionado barra"""
+    user, patient, medication = staff
+    login(client, user)
+    db.session.execute(Medication.__table__.update().values(current_stock=2))
+    db.session.commit()
+    monkeypatch.setattr(StockService, 'lock', staticmethod(lambda ids: {medication_id: 10 for medication_id in ids}))
+    
+    response = client.post('/dispensation/create', json=_payload(patient, medication, 4))
+    
+    assert response.status_code == 409
+    assert _stock(db, medication.id) == 2
+    assert Dispensation.query.count() == 0
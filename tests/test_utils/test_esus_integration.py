@@ -0,0 +1,278 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+from flask import g
+
+from app import esus_integration
+from app.cache import MISSING
+from app.esus_integration import (
+    ESUSCircuitBreaker, ESUSConnectionPool, esus_connection,
+    esus_search_cache, esus_search_cache_key, search_patient_in_esus
+)
+
+CREDENTIALS = {'dbname': 'esus', 'user': 'leitura', 'password': 'x', 'host': 'esus.local', 'port': 5432}
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        if sql == 'SELECT 1' and self.conn.check_delay is not None:
+            # Socket derrubado: falha depois de check_delay segundos
+            time.sleep(self.conn.check_delay)
+            raise esus_integration.psycopg2.OperationalError('server closed the connection unexpectedly')
+    
+    def fetchone(self):
+        return (1,)
+
+class FakeConnection:
+    """Conexão psycopg2 falsa; check_delay != None faz o SELECT 1 falhar"""
+    
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.closed = 0
+        self.check_delay = None
+        self.executed = []
+    
+    def cursor(self):
+        return FakeCursor(self)
+    
+    def set_session(self, **kwargs):
+        pass
+    
+    def rollback(self):
+        pass
+    
+    def fileno(self):
+        return -1
+    
+    def close(self):
+        self.closed = 1
+
+@pytest.fixture
+def connections(monkeypatch):
+    """psycopg2.connect falso; lista das conexões abertas"""
+    opened = []
+    
+    def connect(**kwargs):
+        conn = FakeConnection(**kwargs)
+        opened.append(conn)
+        return conn
+    
+    monkeypatch.setattr(esus_integration.psycopg2, 'connect', connect)
+    return opened
+
+def _stale(pool, conn):
+    """Deixar a conexão ociosa há mais que health_check_after (verificação obrigatória)"""
+    pool._idle = [(idle, last_used - pool.health_check_after - 1) for idle, last_used in pool._idle
+                  if idle is conn] + [item for item in pool._idle if item[0] is not conn]
+
+# =================== POOL ===================
+
+def test_pool_reuses_released_connection_with_socket_timeouts(connections):
+    pool = ESUSConnectionPool(max_size=2, socket_timeout=10)
+    
+    conn = pool.acquire(CREDENTIALS, connect_timeout=5, socket_timeout=3)
+    pool.release(conn)
+    
+    assert pool.acquire(CREDENTIALS) is conn
+    assert len(connections) == 1
+    options = connections[0].kwargs
+    assert options['connect_timeout'] == 5
+    assert options['keepalives'] == 1
+    assert options['tcp_user_timeout'] == 3000  # limitado pelo socket_timeout do empréstimo
+
+def test_pool_exhausted_returns_none_after_wait(connections):
+    pool = ESUSConnectionPool(max_size=1)
+    pool.acquire(CREDENTIALS)
+    
+    started = time.monotonic()
+    assert pool.acquire(CREDENTIALS, wait_timeout=0.1) is None
+    assert time.monotonic() - started >= 0.1
+
+def test_pool_credentials_change_closes_idle_connections(connections):
+    pool = ESUSConnectionPool()
+    old = pool.acquire(CREDENTIALS)
+    pool.release(old)
+    
+    new = pool.acquire(dict(CREDENTIALS, password='nova'))
+    
+    assert new is not old
+    assert old.closed
+
+def test_health_check_runs_outside_the_pool_lock(connections, monkeypatch):
+    monkeypatch.setattr(esus_integration, 'HEALTH_CHECK_SLOW', 10)
+    pool = ESUSConnectionPool(max_size=2)
+    conn = pool.acquire(CREDENTIALS)
+    pool.release(conn)
+    _stale(pool, conn)
+    conn.check_delay = 0.3
+    
+    checkout = threading.Thread(target=pool.acquire, args=(CREDENTIALS,))
+    checkout.start()
+    time.sleep(0.1)
+    
+    started = time.monotonic()
+    stats = pool.stats()  # precisa do lock
+    assert time.monotonic() - started < 0.05
+    assert stats['in_use'] == 1  # vaga reservada durante a verificação
+    checkout.join()
+
+def test_fast_health_check_failure_opens_new_connection(connections):
+    pool = ESUSConnectionPool(max_size=1)
+    dead = pool.acquire(CREDENTIALS)
+    pool.release(dead)
+    _stale(pool, dead)
+    dead.check_delay = 0
+    
+    conn = pool.acquire(CREDENTIALS)
+    
+    assert conn is not dead and dead.closed
+    assert pool.stats()['in_use'] == 1
+
+def test_slow_health_check_failure_raises_and_frees_slot(connections, monkeypatch):
+    monkeypatch.setattr(esus_integration, 'HEALTH_CHECK_SLOW', 0.05)
+    pool = ESUSConnectionPool(max_size=1)
+    dead = pool.acquire(CREDENTIALS)
+    pool.release(dead)
+    _stale(pool, dead)
+    dead.check_delay = 0.1
+    
+    with pytest.raises(esus_integration.psycopg2.OperationalError):
+        pool.acquire(CREDENTIALS)
+    
+    assert dead.closed
+    assert pool.stats()['in_use'] == 0
+    assert len(connections) == 1  # não gastou mais tempo abrindo outra conexão
+
+# =================== DISJUNTOR ===================
+
+def test_breaker_opens_after_threshold_and_probes_after_reset():
+    breaker = ESUSCircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure('timeout')
+    assert breaker.allow_request()
+    breaker.record_failure('timeout')
+    
+    assert breaker.is_open
+    assert not breaker.allow_request()
+    
+    time.sleep(0.1)
+    assert breaker.allow_request()  # chamada de teste
+    assert not breaker.allow_request()  # só uma por vez
+    
+    breaker.record_success()
+    assert breaker.stats()['state'] == ESUSCircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+def test_breaker_failed_probe_reopens():
+    breaker = ESUSCircuitBreaker(failure_threshold=3, reset_timeout=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.05)
+    assert breaker.allow_request()
+    
+    breaker.record_failure('ainda fora')
+    
+    assert breaker.is_open
+    assert breaker.stats()['last_error'] == 'ainda fora'
+
+# =================== ESUS_CONNECTION (POOL + DISJUNTOR + ORÇAMENTO) ===================
+
+@pytest.fixture
+def esus(app, connections, monkeypatch):
+    """Pool e disjuntor novos, credenciais válidas e psycopg2 falso"""
+    pool = ESUSConnectionPool()
+    breaker = ESUSCircuitBreaker()
+    monkeypatch.setattr(esus_integration, 'esus_pool', pool)
+    monkeypatch.setattr(esus_integration, 'esus_breaker', breaker)
+    monkeypatch.setattr(esus_integration, '_valid_esus_credentials', lambda: dict(CREDENTIALS))
+    app.config.update(ESUS_BREAKER_FAILURES=2, ESUS_REQUEST_BUDGET=5, ESUS_SOCKET_TIMEOUT=10)
+    return pool, breaker
+
+def test_esus_connection_sets_statement_timeout_and_returns_connection(app, esus, connections):
+    pool, breaker = esus
+    with esus_connection() as conn:
+        assert conn is connections[0]
+    
+    assert conn.executed == ['SET statement_timeout = %s']
+    assert pool.stats()['idle'] == 1
+    assert breaker.stats()['failures'] == 0
+
+def test_esus_connection_socket_timeout_limited_by_request_budget(app, esus, connections):
+    with app.test_request_context():
+        g.esus_time_spent = 3  # restam 2 dos 5 segundos
+        with esus_connection() as conn:
+            assert conn is not None
+    
+    assert connections[0].kwargs['tcp_user_timeout'] == 2000
+
+def test_esus_connection_skipped_when_budget_spent(app, esus, connections):
+    with app.test_request_context():
+        g.esus_time_spent = 4.5
+        with esus_connection() as conn:
+            assert conn is None
+    
+    assert connections == []
+
+def test_slow_health_check_opens_breaker(app, esus, connections, monkeypatch):
+    monkeypatch.setattr(esus_integration, 'HEALTH_CHECK_SLOW', 0.05)
+    app.config['ESUS_BREAKER_FAILURES'] = 1
+    pool, breaker = esus
+    with esus_connection() as conn:
+        pass
+    _stale(pool, conn)
+    conn.check_delay = 0.1
+    
+    with esus_connection() as conn:
+        assert conn is None
+    
+    assert breaker.is_open
+    assert pool.stats()['in_use'] == 0
+    
+    # Circuito aberto: a próxima chamada nem tenta conectar
+    with esus_connection() as conn:
+        assert conn is None
+    assert len(connections) == 1
+
+@pytest.fixture
+def esus_search(app, monkeypatch):
+    """Busca e-SUS sem PostgreSQL: conexão falsa e resultado fixo"""
+    calls = []
+    
+    @contextmanager
+    def fake_connection(force=False):
+        yield object()
+    
+    def fake_search(conn, query, search_type):
+        calls.append(query)
+        return [{'nu_cpf': '12345678901', 'no_cidadao': 'PACIENTE'}]
+    
+    monkeypatch.setattr(esus_integration, 'esus_connection', fake_connection)
+    monkeypatch.setattr(esus_integration, '_search_patient_in_esus', fake_search)
+    esus_search_cache.clear()
+    yield calls
+    esus_search_cache.clear()
+
+def test_search_result_is_cached(esus_search):
+    assert search_patient_in_esus('paciente') == search_patient_in_esus('paciente')
+    assert esus_search == ['paciente']
+
+def test_search_does_not_cache_result_when_cache_cleared_meanwhile(esus_search, monkeypatch):
+    def search_while_cache_is_cleared(conn, query, search_type):
+        esus_search.append(query)
+        esus_search_cache.clear()  # ex.: credenciais trocadas pelo administrador
+        return [{'nu_cpf': '12345678901', 'no_cidadao': 'ANTIGO'}]
+    
+    monkeypatch.setattr(esus_integration, '_search_patient_in_esus', search_while_cache_is_cleared)
+    
+    assert search_patient_in_esus('paciente')[0]['no_cidadao'] == 'ANTIGO'
+    assert esus_search_cache.get(esus_search_cache_key('paciente')) is MISSING
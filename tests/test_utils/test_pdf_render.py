@@ -0,0 +1,55 @@
+from concurrent.futures import Future
+
+import pytest
+
+from app.pdf_render import PdfDocument, PdfRenderer, PdfRenderTimeout
+
+class StuckExecutor:
+    """Executor cujo trabalho nunca termina (running=True: já começou)"""
+    
+    def __init__(self, running):
+        self.running = running
+        self.shut_down = False
+    
+    def submit(self, function, *args):
+        future = Future()
+        if self.running:
+            future.set_running_or_notify_cancel()
+        return future
+    
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+def _document(rows=50):
+    document = PdfDocument()
+    document.title('Relatório')
+    document.table([['Medicamento', 'Quantidade']] + [[f'Med {n}', n] for n in range(rows)])
+    return document
+
+def _renderer(executor):
+    renderer = PdfRenderer(workers=1, timeout=0.01)
+    renderer._executor = executor
+    return renderer
+
+def test_render_in_thread_without_workers():
+    assert PdfRenderer(workers=0).render(_document(rows=200)).startswith(b'%PDF')
+
+def test_timeout_while_running_recycles_pool():
+    executor = StuckExecutor(running=True)
+    renderer = _renderer(executor)
+    
+    with pytest.raises(PdfRenderTimeout, match='grande demais'):
+        renderer.render(_document())
+    
+    assert executor.shut_down
+    assert renderer._executor is None  # próximo PDF sobe um pool novo
+
+def test_timeout_while_queued_cancels_without_recycling():
+    executor = StuckExecutor(running=False)
+    renderer = _renderer(executor)
+    
+    with pytest.raises(PdfRenderTimeout):
+        renderer.render(_document())
+    
+    assert not executor.shut_down
+    assert renderer._executor is executor